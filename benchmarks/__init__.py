@@ -0,0 +1,6 @@
+"""Benchmarks for the OPC UA Values REST client.
+
+The benchmarks run the real client code against an in-process mock of
+the OPC UA Values REST API, see :mod:`benchmarks.mock_server`. Run them
+with ``python -m benchmarks --help``.
+"""
@@ -0,0 +1,218 @@
+"""An in-process mock of the OPC UA Values REST API.
+
+The server implements the endpoints used by
+:class:`pyprediktormapclient.opc_ua.OPC_UA`, generates synthetic data on
+the fly and runs in a background thread with its own event loop, so both
+the sync and the async client methods can be pointed at it.
+
+Example:
+    >>> from benchmarks.mock_server import MockServerConfig, MockValuesServer
+    >>>
+    >>> config = MockServerConfig(sample_interval_ms=1000, latency_ms=20)
+    >>> with MockValuesServer(config) as server:
+    ...     opc = OPC_UA(rest_url=server.url, opcua_url="opc.tcp://mock")
+"""
+
+import asyncio
+import json
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from aiohttp import web
+from pydantic import BaseModel, Field
+
+from pyprediktormapclient.transport import GOOD_STATUS, history_body
+
+
+class MockServerConfig(BaseModel):
+    """Configuration of the data and the behaviour of the mock server.
+
+    Variables:
+        sample_interval_ms: int - Distance between raw samples, i.e. the data density
+        latency_ms: float - Fixed latency added to every response
+        latency_jitter_ms: float - Random latency added on top of latency_ms
+        error_rate: float - Share of requests (0-1) answered with error_status
+        error_status: int - HTTP status used for injected errors
+        string_payload_bytes: int - Return strings of this size instead of doubles when above 0
+        max_points_per_node: Optional[int] - Truncate each node to this number of points, as servers with a point limit do
+        seed: int - Seed for the random generator, to make runs repeatable
+    """
+
+    sample_interval_ms: int = Field(default=60000, gt=0)
+    latency_ms: float = Field(default=0.0, ge=0)
+    latency_jitter_ms: float = Field(default=0.0, ge=0)
+    error_rate: float = Field(default=0.0, ge=0, le=1)
+    error_status: int = 500
+    string_payload_bytes: int = Field(default=0, ge=0)
+    max_points_per_node: Optional[int] = Field(default=None, gt=0)
+    seed: int = 0
+
+
+def _format_time(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class MockValuesServer:
+    """The mock server. Use it as a context manager or call start() and stop().
+
+    Args:
+        config (MockServerConfig): The server configuration, defaults to MockServerConfig()
+        host (str): The interface to bind to
+        port (int): The port to bind to, 0 picks a free port
+
+    Attributes:
+        stats (Counter): Number of requests per endpoint, plus "errors" and "bytes_sent"
+    """
+
+    def __init__(
+        self,
+        config: MockServerConfig = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.config = config or MockServerConfig()
+        self.host = host
+        self.port = port
+        self.stats = Counter()
+        self._random = random.Random(self.config.seed)
+        self._loop = None
+        self._thread = None
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        """The REST url to give to the client, with the trailing slash."""
+        return f"http://{self.host}:{self.port}/"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self) -> None:
+        """Start the server in a background thread and wait until it accepts
+        connections."""
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._serve, args=(started,), daemon=True
+        )
+        self._thread.start()
+        started.wait()
+
+    def stop(self) -> None:
+        """Stop the server and its thread."""
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._runner.cleanup(), self._loop
+        ).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._thread = None
+
+    def reset_stats(self) -> None:
+        self.stats.clear()
+
+    def _serve(self, started: threading.Event) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._setup())
+        started.set()
+        self._loop.run_forever()
+
+    async def _setup(self) -> None:
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_post("/values/historical", self._historical)
+        app.router.add_post(
+            "/values/historicalaggregated", self._historical_aggregated
+        )
+        app.router.add_post("/values/get", self._get)
+        app.router.add_post("/values/set", self._set)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def _respond(self, endpoint: str, payload) -> web.Response:
+        self.stats[endpoint] += 1
+        delay_ms = self.config.latency_ms
+        if self.config.latency_jitter_ms:
+            delay_ms += self._random.random() * self.config.latency_jitter_ms
+        if delay_ms:
+            await asyncio.sleep(delay_ms / 1000)
+
+        if self._random.random() < self.config.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(
+                status=self.config.error_status, text="Injected error"
+            )
+
+        body = json.dumps(payload).encode()
+        self.stats["bytes_sent"] += len(body)
+        return web.Response(body=body, content_type="application/json")
+
+    def _value(self) -> Dict:
+        if self.config.string_payload_bytes:
+            return {
+                "Type": 12,
+                "Body": "x" * self.config.string_payload_bytes,
+            }
+        return {"Type": 11, "Body": self._random.random() * 100}
+
+    def _history(
+        self, body: Dict, interval_ms: int, status: Dict = None
+    ) -> Dict:
+        return history_body(
+            body,
+            timedelta(milliseconds=interval_ms),
+            value=lambda num: self._value(),
+            status=status,
+            max_points=self.config.max_points_per_node,
+        )
+
+    async def _historical(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return await self._respond(
+            "values/historical",
+            self._history(body, self.config.sample_interval_ms),
+        )
+
+    async def _historical_aggregated(
+        self, request: web.Request
+    ) -> web.Response:
+        body = await request.json()
+        return await self._respond(
+            "values/historicalaggregated",
+            self._history(body, int(body["ProcessingInterval"]), GOOD_STATUS),
+        )
+
+    async def _get(self, request: web.Request) -> web.Response:
+        body = (await request.json())[0]
+        now = _format_time(datetime.now(timezone.utc))
+        values: List[Dict] = [
+            {
+                "NodeId": node_id,
+                "Value": self._value(),
+                "SourceTimestamp": now,
+                "ServerTimestamp": now,
+                "StatusCode": GOOD_STATUS,
+            }
+            for node_id in body.get("NodeIds", [])
+        ]
+        return await self._respond(
+            "values/get", [{"Success": True, "Values": values}]
+        )
+
+    async def _set(self, request: web.Request) -> web.Response:
+        body = (await request.json())[0]
+        status_codes = [GOOD_STATUS for _ in body.get("WriteValues", [])]
+        return await self._respond(
+            "values/set", {"Success": True, "StatusCodes": status_codes}
+        )
@@ -0,0 +1,304 @@
+"""Benchmark runner for the OPC UA Values REST client.
+
+Every combination of scenario, batch size and concurrency level is a
+case. A case starts a :class:`~benchmarks.mock_server.MockValuesServer`,
+runs the client against it and reports rows/s, requests/s, p50/p99
+request latency and the peak RSS of the process. The results are
+written as JSON so they can be stored and compared between runs.
+
+Batch size means ``max_data_points`` for the historical scenarios and
+the number of nodes per call for ``get_values`` and ``write_values``.
+Concurrency means ``max_concurrent_requests`` for the historical
+scenarios and the number of threads for the others.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from pyprediktormapclient import __version__
+from pyprediktormapclient.opc_ua import OPC_UA
+
+from .mock_server import MockServerConfig, MockValuesServer
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+SCENARIOS = [
+    "historical_raw",
+    "historical_aggregated",
+    "get_values",
+    "write_values",
+]
+START_TIME = datetime(2024, 1, 1)
+
+
+class _TimedOPC_UA(OPC_UA):
+    """OPC_UA that records the latency of every history request."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    async def _make_request(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super()._make_request(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MiB, None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    divisor = 1024**2 if sys.platform == "darwin" else 1024
+    return round(peak / divisor, 1)
+
+
+def _percentile(values: List[float], percentile: int) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return round(values[0], 3)
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return round(quantiles[percentile - 1], 3)
+
+
+def _variables(nodes: int) -> List[Dict]:
+    return [
+        {"Id": f"SSO.BENCH.Signal{num}", "Namespace": 2, "IdType": 1}
+        for num in range(nodes)
+    ]
+
+
+def _write_variables(nodes: int) -> List[Dict]:
+    timestamp = START_TIME.replace(tzinfo=timezone.utc).isoformat()
+    return [
+        {
+            "NodeId": variable,
+            "Value": {
+                "Value": {"Type": 11, "Body": 1.0},
+                "SourceTimestamp": timestamp,
+                "StatusCode": {"Code": 0, "Symbol": "Good"},
+            },
+        }
+        for variable in _variables(nodes)
+    ]
+
+
+def _run_historical(opc: _TimedOPC_UA, case: Dict) -> int:
+    kwargs = dict(
+        start_time=START_TIME,
+        end_time=START_TIME + timedelta(hours=case["hours"]),
+        variable_list=_variables(case["nodes"]),
+        max_data_points=case["batch_size"],
+        max_concurrent_requests=case["concurrency"],
+        max_retries=case["max_retries"],
+        retry_delay=case["retry_delay"],
+    )
+    if case["scenario"] == "historical_aggregated":
+        result = opc.get_historical_aggregated_values(
+            pro_interval=case["pro_interval"], agg_name="Average", **kwargs
+        )
+    else:
+        result = opc.get_historical_raw_values(**kwargs)
+    return len(result)
+
+
+def _run_live(opc: _TimedOPC_UA, case: Dict) -> int:
+    if case["scenario"] == "get_values":
+        variables, call = _variables(case["nodes"]), opc.get_values
+    else:
+        variables, call = _write_variables(case["nodes"]), opc.write_values
+    chunks = [
+        variables[i : i + case["batch_size"]]
+        for i in range(0, len(variables), case["batch_size"])
+    ]
+
+    def timed_call(chunk):
+        started = time.perf_counter()
+        rows = len(call(chunk))
+        opc.latencies.append(time.perf_counter() - started)
+        return rows
+
+    with ThreadPoolExecutor(max_workers=case["concurrency"]) as executor:
+        return sum(executor.map(timed_call, chunks))
+
+
+def run_case(case: Dict) -> Dict:
+    """Run one benchmark case and return its measurements.
+
+    Args:
+        case (dict): scenario, nodes, hours, batch_size, concurrency, pro_interval, max_retries, retry_delay and server (a MockServerConfig as dict)
+    Returns:
+        dict: The case extended with the measurements
+    """
+    config = MockServerConfig(**case["server"])
+    with MockValuesServer(config) as server:
+        opc = _TimedOPC_UA(rest_url=server.url, opcua_url="opc.tcp://mock")
+        started = time.perf_counter()
+        error = None
+        try:
+            if case["scenario"].startswith("historical"):
+                rows = _run_historical(opc, case)
+            else:
+                rows = _run_live(opc, case)
+        except Exception as e:
+            rows, error = 0, str(e)
+        elapsed = time.perf_counter() - started
+        stats = dict(server.stats)
+
+    requests = sum(
+        count
+        for endpoint, count in stats.items()
+        if endpoint.startswith("values/")
+    )
+    latencies_ms = sorted(latency * 1000 for latency in opc.latencies)
+    return {
+        **case,
+        "rows": rows,
+        "requests": requests,
+        "server_errors": stats.get("errors", 0),
+        "bytes_received": stats.get("bytes_sent", 0),
+        "elapsed_s": round(elapsed, 4),
+        "rows_per_s": round(rows / elapsed, 1) if elapsed else None,
+        "requests_per_s": round(requests / elapsed, 1) if elapsed else None,
+        "latency_p50_ms": _percentile(latencies_ms, 50),
+        "latency_p99_ms": _percentile(latencies_ms, 99),
+        "peak_rss_mb": _peak_rss_mb(),
+        "error": error,
+    }
+
+
+def _run_isolated(case: Dict) -> Dict:
+    """Run a case in a fresh process so that peak RSS is per case."""
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_case, (case,))
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmark the OPC UA Values REST client against "
+        "an in-process mock server.",
+    )
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help="Comma separated list from: " + ", ".join(SCENARIOS),
+    )
+    parser.add_argument("--batch-sizes", type=_int_list, default="10000")
+    parser.add_argument("--concurrency", type=_int_list, default="1,10,30")
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument(
+        "--pro-interval",
+        type=int,
+        default=60000,
+        help="ProcessingInterval in ms for historical_aggregated",
+    )
+    parser.add_argument("--sample-interval-ms", type=int, default=60000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--string-payload-bytes", type=int, default=0)
+    parser.add_argument("--max-points-per-node", type=int, default=None)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--retry-delay", type=float, default=0)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--isolate",
+        action="store_true",
+        help="Run every case in its own process to get peak RSS per case",
+    )
+    parser.add_argument(
+        "--output", default="-", help="JSON output file, - for stdout"
+    )
+    return parser.parse_args(argv)
+
+
+def build_cases(args: argparse.Namespace) -> List[Dict]:
+    server = MockServerConfig(
+        sample_interval_ms=args.sample_interval_ms,
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        string_payload_bytes=args.string_payload_bytes,
+        max_points_per_node=args.max_points_per_node,
+    ).model_dump()
+    scenarios = [item for item in args.scenarios.split(",") if item]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    return [
+        {
+            "scenario": scenario,
+            "nodes": args.nodes,
+            "hours": args.hours,
+            "batch_size": batch_size,
+            "concurrency": concurrency,
+            "pro_interval": args.pro_interval,
+            "max_retries": args.max_retries,
+            "retry_delay": args.retry_delay,
+            "repeat": repeat,
+            "server": server,
+        }
+        for scenario, batch_size, concurrency, repeat in itertools.product(
+            scenarios, args.batch_sizes, args.concurrency, range(args.repeat)
+        )
+    ]
+
+
+def main(argv: List[str] = None) -> Dict:
+    args = parse_args(argv)
+    run = _run_isolated if args.isolate else run_case
+    results = []
+    for case in build_cases(args):
+        result = run(case)
+        results.append(result)
+        print(
+            f"{result['scenario']:<22} batch={result['batch_size']:<7} "
+            f"concurrency={result['concurrency']:<4} "
+            f"rows/s={result['rows_per_s']} "
+            f"requests/s={result['requests_per_s']} "
+            f"p50={result['latency_p50_ms']} p99={result['latency_p99_ms']} "
+            f"rss={result['peak_rss_mb']}",
+            file=sys.stderr,
+        )
+
+    report = {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "package_version": __version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "isolated": args.isolate,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+    return report
@@ -1,14 +1,30 @@
 import datetime
+import hashlib
 import json
+import logging
+import os
 import re
-from typing import Optional
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
 import requests
 from dateutil.parser import ParserError, parse
 from dateutil.tz import tzutc
 from pydantic import AnyUrl, BaseModel, ConfigDict, field_validator
 
+from pyprediktormapclient import tracing
 from pyprediktormapclient.shared import request_from_api
+from pyprediktormapclient.transport import Transport
+
+if os.name == "nt":  # pragma: no cover - depends on the platform
+    import msvcrt
+else:
+    import fcntl
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
 
 
 class Ory_Login_Structure(BaseModel):
@@ -39,6 +55,104 @@ class Token(BaseModel):
         return v
 
 
+def _default_cache_directory() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "pyprediktormapclient", "tokens")
+
+
+@contextmanager
+def _file_lock(path: str) -> Iterator[None]:
+    """Hold an exclusive lock on a file, across processes."""
+    with open(path, "a+b") as lock_file:
+        if os.name == "nt":  # pragma: no cover - depends on the platform
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":  # pragma: no cover - depends on the platform
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _has_expired(token: Optional[Token], margin: float = 0) -> bool:
+    """Check if a token is missing, has no expiry or expires within margin
+    seconds."""
+    if token is None or token.expires_at is None:
+        return True
+    return datetime.datetime.now(
+        datetime.timezone.utc
+    ) > token.expires_at - datetime.timedelta(seconds=margin)
+
+
+class TokenCache:
+    """On-disk cache of Ory tokens shared by processes.
+
+    Tokens are stored per Ory URL and username in files only the
+    current user can read (mode 0600 in a 0700 directory). A lock file
+    per entry makes processes that need a token at the same time wait
+    for each other, so only one of them logs in.
+
+    Args:
+        directory (str): The cache directory, defaults to $XDG_CACHE_HOME/pyprediktormapclient/tokens or ~/.cache/pyprediktormapclient/tokens
+    """
+
+    def __init__(self, directory: str = None):
+        self.directory = directory or _default_cache_directory()
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    @staticmethod
+    def key(rest_url: str, username: str) -> str:
+        """The cache key of a user at an Ory server."""
+        return hashlib.sha256(f"{rest_url}\n{username}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """Hold the lock of a cache entry."""
+        with _file_lock(os.path.join(self.directory, f"{key}.lock")):
+            yield
+
+    def load(self, key: str) -> Optional[Token]:
+        """The cached token, None if there is none or it cannot be read."""
+        try:
+            with open(self._path(key), encoding="utf-8") as cache_file:
+                return Token.model_validate_json(cache_file.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable token cache entry: %s", e)
+            return None
+
+    def store(self, key: str, token: Token) -> None:
+        """Write a token to the cache, replacing the file atomically."""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            os.chmod(temp_path, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as cache_file:
+                cache_file.write(token.model_dump_json())
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def clear(self, key: str) -> None:
+        """Remove a cached token."""
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
 class AUTH_CLIENT:
     """Helper functions to authenticate with Ory.
 
@@ -51,23 +165,50 @@ class AUTH_CLIENT:
         Object
     """
 
-    def __init__(self, rest_url: AnyUrl, username: str, password: str):
+    # Seconds to wait before the background refresh tries again after a
+    # failed login
+    AUTO_REFRESH_RETRY_DELAY = 30
+
+    def __init__(
+        self,
+        rest_url: AnyUrl,
+        username: str,
+        password: str,
+        refresh_margin: float = 60,
+        token_cache: TokenCache = None,
+        transport: Transport = None,
+    ):
         """Class initializer.
 
         Args:
             rest_url (str): The complete url of the Ory server. E.g. "http://127.0.0.1:9099/"
             username (str): The username of the user
             password (str): The password of the user
+            refresh_margin (float): Seconds before expires_at that refresh_token() and the background refresh get a new token
+            token_cache (TokenCache): Optional on-disk cache, request_new_ory_token() takes a valid token from it before logging in and stores new tokens in it
+            transport (Transport): Optional HTTP access shared with other clients, e.g. an HTTPTransport with pooled connections. Used for the login requests
         Returns:
             Object: The initialized class object
         """
         self.rest_url = rest_url
         self.username = username
         self.password = password
+        self.refresh_margin = refresh_margin
+        self.token_cache = token_cache
         self.id = None
         self.token = None
         self.headers = {"Content-Type": "application/json"}
-        self.session = requests.Session()
+        self.transport = transport
+        # One session for all login requests, so they reuse a connection
+        self.session = (
+            transport.session
+            if transport is not None and transport.session is not None
+            else requests.Session()
+        )
+        self._refresh_lock = threading.Lock()
+        self._timer_lock = threading.Lock()
+        self._refresh_timer = None
+        self._auto_refresh = False
 
     def get_login_id(self) -> None:
         """Request login token from Ory."""
@@ -77,6 +218,7 @@ class AUTH_CLIENT:
             endpoint="self-service/login/api",
             headers=self.headers,
             extended_timeout=True,
+            session=self.session,
         )
         if "error" in content:
             # Handle the error appropriately
@@ -106,6 +248,7 @@ class AUTH_CLIENT:
             params=params,
             headers=self.headers,
             extended_timeout=True,
+            session=self.session,
         )
 
         if content.get("Success") is False:
@@ -128,17 +271,126 @@ class AUTH_CLIENT:
 
         self.token = Token(session_token=session_token, expires_at=expires_at)
 
-    def check_if_token_has_expired(self) -> bool:
-        """Check if token has expired."""
-        if self.token is None or self.token.expires_at is None:
-            return True
+    def check_if_token_has_expired(self, margin: float = 0) -> bool:
+        """Check if token has expired.
 
-        return (
-            datetime.datetime.now(datetime.timezone.utc)
-            > self.token.expires_at
-        )
+        Args:
+            margin (float): Also count the token as expired if it expires within this many seconds
+        """
+        return _has_expired(self.token, margin)
+
+    @tracing.traced("AUTH_CLIENT.request_new_ory_token")
+    def request_new_ory_token(self, replaces: Optional[Token] = None) -> None:
+        """Request Ory token.
+
+        Concurrent calls are collapsed into one login. The token to
+        replace is compared under the lock, so callers that wait for a
+        running login, or come after it, use its token instead of
+        logging in again. If that login fails, the next waiting caller
+        tries itself.
+
+        Args:
+            replaces (Token): The token the caller found expired or rejected, by default the current one
+        """
+        if replaces is None:
+            replaces = self.token
+        with self._refresh_lock:
+            if self.token is not replaces:
+                return
+            if self.token_cache is None:
+                self._login()
+            else:
+                self._login_with_cache()
+        self._schedule_refresh()
 
-    def request_new_ory_token(self) -> None:
-        """Request Ory token."""
+    def _login(self) -> None:
         self.get_login_id()
         self.get_login_token()
+
+    def _login_with_cache(self) -> None:
+        """Use a cached token that is valid and not the one being replaced,
+        otherwise log in and cache the new token."""
+        key = TokenCache.key(str(self.rest_url), self.username)
+        with self.token_cache.lock(key):
+            cached = self.token_cache.load(key)
+            current = self.token
+            if (
+                cached is not None
+                and cached.expires_at is not None
+                and datetime.datetime.now(datetime.timezone.utc)
+                < cached.expires_at
+                - datetime.timedelta(seconds=self.refresh_margin)
+                and (
+                    current is None
+                    or cached.session_token != current.session_token
+                )
+            ):
+                logger.debug("Using cached token for %s", self.username)
+                self.token = cached
+                return
+            self._login()
+            if self.token is not None:
+                self.token_cache.store(key, self.token)
+
+    def refresh_token(self) -> None:
+        """Request a new token if the current one has expired or expires within
+        refresh_margin seconds."""
+        token = self.token
+        if _has_expired(token, self.refresh_margin):
+            self.request_new_ory_token(token)
+
+    def start_auto_refresh(self) -> None:
+        """Refresh the token in a background thread refresh_margin seconds
+        before it expires, so requests never see an expired token.
+
+        Without a token the first login starts right away. Tokens
+        without expires_at are not refreshed in the background.
+        """
+        self._auto_refresh = True
+        self._schedule_refresh()
+
+    def stop_auto_refresh(self) -> None:
+        """Stop the background refresh."""
+        self._auto_refresh = False
+        with self._timer_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+
+    def _schedule_refresh(self, delay: float = None) -> None:
+        if not self._auto_refresh:
+            return
+        token = self.token
+        if delay is None:
+            if token is None:
+                delay = 0
+            elif token.expires_at is None:
+                logger.debug("Token has no expiry, not refreshing it")
+                return
+            else:
+                delay = max(
+                    0.0,
+                    (
+                        token.expires_at
+                        - datetime.datetime.now(datetime.timezone.utc)
+                    ).total_seconds()
+                    - self.refresh_margin,
+                )
+        timer = threading.Timer(delay, self._auto_refresh_token, (token,))
+        timer.daemon = True
+        with self._timer_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+            self._refresh_timer = timer
+        timer.start()
+
+    def _auto_refresh_token(self, token: Optional[Token] = None) -> None:
+        try:
+            self.request_new_ory_token(token)
+        except Exception as e:
+            logger.warning(
+                "Background token refresh failed, retrying in %s seconds: %s",
+                self.AUTO_REFRESH_RETRY_DELAY,
+                e,
+            )
+            self._schedule_refresh(self.AUTO_REFRESH_RETRY_DELAY)
@@ -0,0 +1,494 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from pydantic import BaseModel, ConfigDict, Field
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class BatchSpec(BaseModel):
+    """One history request of a historical read plan.
+
+    Variables:
+        index: int - Position of the batch in the plan
+        read_value_ids: List[Dict[str, Any]] - The ReadValueIds of the request
+        start_time: datetime - Start of the time window
+        end_time: datetime - End of the time window
+    """
+
+    index: int
+    read_value_ids: List[Dict[str, Any]]
+    start_time: datetime
+    end_time: datetime
+
+
+class FailedBatch(BaseModel):
+    """A batch that failed in a historical read with on_error="collect".
+
+    Variables:
+        spec: BatchSpec - The failed batch, i.e. its nodes and time window
+        error: str - The error message
+        exception: Optional[BaseException] - The exception itself, left out when the report is serialised
+        attempts: int - The number of requests made for the batch
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    spec: BatchSpec
+    error: str
+    exception: Optional[BaseException] = Field(default=None, exclude=True)
+    attempts: int = 1
+
+
+class HistoryReadReport(BaseModel):
+    """The outcome of a historical read with on_error="collect".
+
+    Pass plan() as the plan of a new call with the same method and
+    parameters to fetch only the failed batches again.
+
+    Variables:
+        endpoint: str - The endpoint, e.g. values/historical
+        batches: int - The number of batches in the plan
+        failed: List[FailedBatch] - The batches that failed, in plan order
+        bad_nodes: List[Dict[str, Any]] - The NodeIds of results whose status was not Good after the retries, once per result
+    """
+
+    endpoint: str
+    batches: int
+    failed: List[FailedBatch] = Field(default_factory=list)
+    bad_nodes: List[Dict[str, Any]] = Field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        """True if no batch failed."""
+        return not self.failed
+
+    def plan(self) -> List[BatchSpec]:
+        """The failed batches as a new plan."""
+        return [
+            failure.spec.model_copy(update={"index": index})
+            for index, failure in enumerate(self.failed)
+        ]
+
+
+class BatchEstimate(BaseModel):
+    """The expected size of one batch of a historical read.
+
+    Variables:
+        index: int - Position of the batch in the plan
+        start_time: datetime - Start of the time window
+        end_time: datetime - End of the time window
+        nodes: int - The number of nodes in the request
+        estimated_points: int - The expected number of values
+        estimated_bytes: int - The expected size of the response
+    """
+
+    index: int
+    start_time: datetime
+    end_time: datetime
+    nodes: int
+    estimated_points: int
+    estimated_bytes: int
+
+
+class HistoryReadExplanation(BaseModel):
+    """The plan of a historical read with its expected size.
+
+    Variables:
+        endpoint: str - The endpoint, e.g. values/historical
+        requests: int - The number of requests in the plan
+        nodes: int - The number of distinct nodes read
+        estimated_points: int - The expected number of values in total
+        estimated_bytes: int - The expected size of all responses
+        batches: List[BatchEstimate] - The batches in plan order
+    """
+
+    endpoint: str
+    requests: int
+    nodes: int
+    estimated_points: int
+    estimated_bytes: int
+    batches: List[BatchEstimate] = Field(default_factory=list)
+
+    @property
+    def largest_batch(self) -> Optional[BatchEstimate]:
+        """The batch with the most expected values, which sets the tail of the
+        read."""
+        if not self.batches:
+            return None
+        return max(self.batches, key=lambda batch: batch.estimated_points)
+
+
+# Calendar units raw windows are aligned to, the largest one that is not
+# longer than the planned window is used
+CALENDAR_STEPS = (
+    timedelta(seconds=1),
+    timedelta(minutes=1),
+    timedelta(minutes=5),
+    timedelta(minutes=15),
+    timedelta(hours=1),
+    timedelta(hours=6),
+    timedelta(days=1),
+)
+
+
+def calendar_step(window: timedelta) -> timedelta:
+    """The largest calendar unit that is not longer than window."""
+    steps = [step for step in CALENDAR_STEPS if step <= window]
+    return steps[-1] if steps else CALENDAR_STEPS[0]
+
+
+def align_time(value: datetime, step: timedelta, origin: datetime) -> datetime:
+    """Round a time to the nearest multiple of step after origin."""
+    multiples, rest = divmod(value - origin, step)
+    if rest * 2 >= step:
+        multiples += 1
+    return origin + step * multiples
+
+
+class HistoryReadPlan:
+    """Splits a historical read into batches of node groups and time windows so
+    that every request stays around max_data_points.
+
+    The batches are generated lazily when iterating, so the size of the
+    plan does not affect memory use.
+
+    With align the window boundaries are rounded to multiples of align
+    after origin, e.g. the processing interval after the start of an
+    aggregated read so no aggregate bucket is split between two
+    requests. Without origin they are rounded to multiples after the
+    Unix epoch, which gives calendar aligned windows that are the same
+    for overlapping reads.
+
+    Args:
+        start_time (datetime): Start of the read
+        end_time (datetime): End of the read
+        read_value_ids (list): The ReadValueIds to read
+        max_data_points (int): The target number of data points per request
+        align (timedelta): Optional step the window boundaries are aligned to
+        origin (datetime): The time the steps are counted from, the Unix epoch by default
+    """
+
+    def __init__(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        read_value_ids: List[Dict[str, Any]],
+        max_data_points: int,
+        align: Optional[timedelta] = None,
+        origin: Optional[datetime] = None,
+    ):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.read_value_ids = read_value_ids
+
+        self.total_time_range_ms = (
+            end_time - start_time
+        ).total_seconds() * 1000
+        estimated_intervals = self.total_time_range_ms / max_data_points
+        self.max_variables_per_batch = max(
+            1, int(max_data_points / estimated_intervals)
+        )
+        self.max_time_batches = max(
+            1, int(estimated_intervals / max_data_points)
+        )
+        self.time_batch_size_ms = (
+            self.total_time_range_ms / self.max_time_batches
+        )
+        self.variable_batches = -(
+            -len(read_value_ids) // self.max_variables_per_batch
+        )
+        self.align = align
+        self.origin = origin
+        self._windows = None
+        if align is not None:
+            self._windows = self._aligned_windows(align, origin)
+
+    @classmethod
+    def calendar_aligned(
+        cls,
+        start_time: datetime,
+        end_time: datetime,
+        read_value_ids: List[Dict[str, Any]],
+        max_data_points: int,
+    ) -> "HistoryReadPlan":
+        """A plan with its windows aligned to the largest calendar unit that is
+        not longer than the planned window, e.g. whole hours."""
+        plan = cls(start_time, end_time, read_value_ids, max_data_points)
+        step = calendar_step(timedelta(milliseconds=plan.time_batch_size_ms))
+        return cls(start_time, end_time, read_value_ids, max_data_points, step)
+
+    def _aligned_windows(
+        self, align: timedelta, origin: Optional[datetime]
+    ) -> List[Tuple[datetime, datetime]]:
+        if origin is None:
+            origin = datetime(1970, 1, 1, tzinfo=self.start_time.tzinfo)
+        boundaries = [self.start_time]
+        for time_batch in range(1, self.max_time_batches):
+            boundary = align_time(
+                self.start_time
+                + timedelta(milliseconds=time_batch * self.time_batch_size_ms),
+                align,
+                origin,
+            )
+            if boundaries[-1] < boundary < self.end_time:
+                boundaries.append(boundary)
+        boundaries.append(self.end_time)
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def windows(self) -> Iterator[Tuple[datetime, datetime]]:
+        """The start and end of the time windows of every node group."""
+        if self._windows is not None:
+            yield from self._windows
+            return
+        for time_batch in range(self.max_time_batches):
+            batch_start_ms = time_batch * self.time_batch_size_ms
+            batch_end_ms = min(
+                (time_batch + 1) * self.time_batch_size_ms,
+                self.total_time_range_ms,
+            )
+            yield (
+                self.start_time + timedelta(milliseconds=batch_start_ms),
+                self.start_time + timedelta(milliseconds=batch_end_ms),
+            )
+
+    def __len__(self) -> int:
+        time_batches = (
+            self.max_time_batches
+            if self._windows is None
+            else len(self._windows)
+        )
+        return self.variable_batches * time_batches
+
+    def __iter__(self) -> Iterator[BatchSpec]:
+        index = 0
+        for first in range(
+            0, len(self.read_value_ids), self.max_variables_per_batch
+        ):
+            read_value_ids = self.read_value_ids[
+                first : first + self.max_variables_per_batch
+            ]
+            for start_time, end_time in self.windows():
+                yield BatchSpec(
+                    index=index,
+                    read_value_ids=read_value_ids,
+                    start_time=start_time,
+                    end_time=end_time,
+                )
+                index += 1
+
+
+class BisectPolicy(BaseModel):
+    """How far batches are split when the server cannot handle them.
+
+    A batch that times out, is rejected with 413 or comes back truncated
+    is split in two, and the halves are requested in its place. Halving
+    goes on until a batch works or it is at min_window and min_nodes.
+
+    Variables:
+        min_window: timedelta - The shortest time window a batch is split to
+        min_nodes: int - The smallest node group a batch is split to
+        point_limit: Optional[int] - The number of values per node at which the server cuts off a result, None to rely on its continuation points
+    """
+
+    min_window: timedelta = timedelta(minutes=1)
+    min_nodes: int = Field(default=1, ge=1)
+    point_limit: Optional[int] = Field(default=None, ge=1)
+
+
+class Bisector:
+    """Splits the batches of one plan and remembers how far.
+
+    Once a batch had to be split, later batches of the plan are split as
+    far right away instead of failing first.
+
+    Args:
+        policy (BisectPolicy): The limits of the splitting
+    """
+
+    def __init__(self, policy: BisectPolicy):
+        self.policy = policy
+        self.max_window: Optional[timedelta] = None
+        self.max_nodes: Optional[int] = None
+        self.splits = 0
+
+    def split(
+        self, spec: BatchSpec, nodes_first: bool = False
+    ) -> Optional[List[BatchSpec]]:
+        """Halve the time window of a batch, or its node group when the window
+        is at the minimum.
+
+        Args:
+            spec (BatchSpec): The batch
+            nodes_first (bool): Halve the node group before the window, e.g. when the request body was too large
+        Returns:
+            list: The two halves, None if the batch is at the minimum size
+        """
+        order = (
+            (self._split_nodes, self._split_window)
+            if nodes_first
+            else (self._split_window, self._split_nodes)
+        )
+        for split in order:
+            halves = split(spec)
+            if halves is not None:
+                self.splits += 1
+                return halves
+        return None
+
+    def _split_window(self, spec: BatchSpec) -> Optional[List[BatchSpec]]:
+        half = (spec.end_time - spec.start_time) / 2
+        if half < self.policy.min_window:
+            return None
+        if self.max_window is None or half < self.max_window:
+            self.max_window = half
+        middle = spec.start_time + half
+        return [
+            spec.model_copy(update={"end_time": middle}),
+            spec.model_copy(update={"start_time": middle}),
+        ]
+
+    def _split_nodes(self, spec: BatchSpec) -> Optional[List[BatchSpec]]:
+        nodes = len(spec.read_value_ids)
+        half = -(-nodes // 2)
+        if nodes < 2 or nodes - half < self.policy.min_nodes:
+            return None
+        if self.max_nodes is None or half < self.max_nodes:
+            self.max_nodes = half
+        return [
+            spec.model_copy(
+                update={"read_value_ids": spec.read_value_ids[:half]}
+            ),
+            spec.model_copy(
+                update={"read_value_ids": spec.read_value_ids[half:]}
+            ),
+        ]
+
+    def presplit(self, spec: BatchSpec) -> List[BatchSpec]:
+        """Split a batch as far as earlier batches of the plan had to be split.
+
+        Args:
+            spec (BatchSpec): The batch
+        Returns:
+            list: The parts, in node group and time order
+        """
+        groups = [spec.read_value_ids]
+        if self.max_nodes is not None and len(spec.read_value_ids) > (
+            self.max_nodes
+        ):
+            groups = [
+                spec.read_value_ids[first : first + self.max_nodes]
+                for first in range(0, len(spec.read_value_ids), self.max_nodes)
+            ]
+        window = spec.end_time - spec.start_time
+        windows = 1
+        if self.max_window is not None and window > self.max_window:
+            windows = -(-window // self.max_window)
+        step = window / windows
+        return [
+            spec.model_copy(
+                update={
+                    "read_value_ids": group,
+                    "start_time": spec.start_time + step * num,
+                    "end_time": (
+                        spec.end_time
+                        if num == windows - 1
+                        else spec.start_time + step * (num + 1)
+                    ),
+                }
+            )
+            for group in groups
+            for num in range(windows)
+        ]
+
+
+_DONE = object()
+
+
+async def run_batches(
+    plan: Iterable[BatchSpec],
+    process: Callable[[BatchSpec], Awaitable[Any]],
+    workers: int,
+    consume: Callable[[BatchSpec, Any], None],
+) -> int:
+    """Run the batches of a plan with a fixed pool of workers.
+
+    A producer feeds the batches lazily into a bounded queue, the workers
+    process them and put the results into a second bounded queue that is
+    drained by consume. When consume is slow the workers wait, and when
+    the workers are busy the producer waits, so memory use depends on
+    the number of workers and not on the size of the plan.
+
+    Args:
+        plan (Iterable[BatchSpec]): The batches to run
+        process (Callable): Coroutine function that processes one batch
+        workers (int): The number of concurrent workers
+        consume (Callable): Called with every batch and its result, in completion order
+    Returns:
+        int: The number of processed batches
+    Raises:
+        Exception: The first exception raised by process, after all outstanding batches have been cancelled
+    """
+    if hasattr(plan, "__len__"):
+        workers = min(workers, len(plan))
+    workers = max(1, workers)
+    jobs: asyncio.Queue = asyncio.Queue(maxsize=workers)
+    results: asyncio.Queue = asyncio.Queue(maxsize=workers)
+
+    async def produce():
+        try:
+            for spec in plan:
+                await jobs.put(spec)
+        except Exception as e:
+            await results.put((None, e, True))
+            return
+        for _ in range(workers):
+            await jobs.put(_DONE)
+
+    async def work():
+        while True:
+            spec = await jobs.get()
+            if spec is _DONE:
+                await results.put(_DONE)
+                return
+            try:
+                result = await process(spec)
+            except Exception as e:
+                await results.put((spec, e, True))
+                return
+            await results.put((spec, result, False))
+
+    tasks = [asyncio.ensure_future(produce())] + [
+        asyncio.ensure_future(work()) for _ in range(workers)
+    ]
+    processed = 0
+    finished_workers = 0
+    try:
+        while finished_workers < workers:
+            item = await results.get()
+            if item is _DONE:
+                finished_workers += 1
+                continue
+            spec, value, failed = item
+            if failed:
+                raise value
+            consume(spec, value)
+            processed += 1
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return processed
@@ -0,0 +1,190 @@
+"""Process-local cache of aggregated history buckets.
+
+An aggregated read returns one value per node and processing interval.
+Once an interval lies completely in the past its aggregate does not
+change, so AggregateCache keeps the rows of such buckets and
+get_historical_aggregated_values only requests the buckets it does not
+have. The bucket that is still open, and any partial bucket at the end
+of a read, are always requested again.
+
+The buckets lie on a grid of the processing interval from the Unix
+epoch, so reads with any start time share them, e.g. the last 24 hours
+and the last 7 days at one hour averages.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from pyprediktormapclient.density import node_key
+
+# Rough size of the key and bookkeeping of a cache entry
+_ENTRY_BYTES = 200
+
+EPOCH = datetime(1970, 1, 1)
+
+BucketKey = Tuple[str, str, int, datetime]
+Rows = Tuple[Dict[str, Any], ...]
+
+
+def _rows_bytes(rows: Rows) -> int:
+    return _ENTRY_BYTES + sum(
+        sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values())
+        for row in rows
+    )
+
+
+class AggregateCache:
+    """LRU cache of aggregated buckets with a budget in bytes.
+
+    A bucket is identified by the node, the aggregate, the processing
+    interval in milliseconds and the start of the interval, and holds
+    the rows the server returned for it, possibly none. The size of the
+    rows is estimated with sys.getsizeof, and the least recently used
+    buckets are evicted when the estimate exceeds max_bytes.
+
+    Use one cache per server.
+
+    Args:
+        max_bytes (int): The budget for the cached rows
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        if max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._buckets: "OrderedDict[BucketKey, Tuple[Rows, int]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    @staticmethod
+    def key(
+        node_id: Dict[str, Any],
+        aggregate: str,
+        interval: int,
+        start: datetime,
+    ) -> BucketKey:
+        """The identity of a bucket."""
+        return (node_key(node_id), aggregate, int(interval), start)
+
+    def lookup(
+        self,
+        node_id: Dict[str, Any],
+        aggregate: str,
+        interval: int,
+        starts: List[datetime],
+    ) -> Tuple[Dict[datetime, Rows], List[datetime]]:
+        """The cached buckets of a node and the ones that are missing.
+
+        Args:
+            node_id (dict): The NodeId
+            aggregate (str): The aggregate name
+            interval (int): The processing interval in milliseconds
+            starts (list): The bucket starts to look up
+        Returns:
+            tuple: The rows of the cached buckets by start, and the starts of the missing buckets
+        """
+        found: Dict[datetime, Rows] = {}
+        missing = []
+        with self._lock:
+            for start in starts:
+                key = self.key(node_id, aggregate, interval, start)
+                entry = self._buckets.get(key)
+                if entry is None:
+                    missing.append(start)
+                    continue
+                self._buckets.move_to_end(key)
+                found[start] = entry[0]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def put(
+        self,
+        node_id: Dict[str, Any],
+        aggregate: str,
+        interval: int,
+        start: datetime,
+        rows: Rows,
+    ) -> None:
+        """Store the rows of a completed bucket."""
+        key = self.key(node_id, aggregate, interval, start)
+        size = _rows_bytes(rows)
+        with self._lock:
+            old = self._buckets.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._buckets[key] = (tuple(rows), size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._buckets.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all buckets."""
+        with self._lock:
+            self._buckets.clear()
+            self.bytes = 0
+
+
+def first_bucket(start_time: datetime, interval: timedelta) -> datetime:
+    """The first bucket start at or after start_time on the grid of the
+    interval from the Unix epoch.
+
+    Args:
+        start_time (datetime): Start of the read, naive times are UTC
+        interval (timedelta): The processing interval
+    Returns:
+        datetime: The bucket start, naive for a naive start_time and in UTC otherwise
+    """
+    epoch = (
+        EPOCH
+        if start_time.tzinfo is None
+        else EPOCH.replace(tzinfo=timezone.utc)
+    )
+    return epoch - ((epoch - start_time) // interval) * interval
+
+
+def completed_buckets(
+    start_time: datetime,
+    end_time: datetime,
+    interval: timedelta,
+    now: Optional[datetime] = None,
+) -> List[datetime]:
+    """The starts of the buckets of a read that are complete, i.e. end within
+    the read and not after now.
+
+    Args:
+        start_time (datetime): Start of the read
+        end_time (datetime): End of the read
+        interval (timedelta): The processing interval
+        now (datetime): The current time, naive times are UTC
+    Returns:
+        list: The bucket starts in time order
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    elif now.tzinfo is None:
+        now = now.replace(tzinfo=timezone.utc)
+    if start_time.tzinfo is None:
+        now = now.astimezone(timezone.utc).replace(tzinfo=None)
+    limit = min(end_time, now)
+    starts = []
+    start = start_time
+    while start + interval <= limit:
+        starts.append(start)
+        start += interval
+    return starts
@@ -0,0 +1,175 @@
+"""On-disk checkpoints for long running historical reads.
+
+Every finished batch is written to a spool directory and recorded in a
+manifest. Running the same read again with the same directory loads the
+finished batches from disk and only requests the rest. The batches are
+stored as Parquet when pyarrow is installed
+(``pip install pyPrediktorMapClient[arrow]``).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+import pandas as pd
+
+from pyprediktormapclient.batching import BatchSpec
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - depends on the environment
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Checkpoint:
+    """Spool directory with the finished batches of a historical read.
+
+    Batches are identified by the servers, the endpoint, the request
+    parameters, the nodes and the time window, not by their position in
+    the plan, so a directory can be shared by reads that overlap. The
+    frame of every batch is written to a temporary file that is renamed
+    into place, and only then the batch is appended to manifest.jsonl.
+    An interrupted run therefore never leaves a half written batch
+    behind, and a torn last manifest line is ignored.
+
+    Frames are written as Parquet when pyarrow is installed. Without
+    pyarrow, and for frames Parquet cannot hold such as columns that mix
+    numbers and text, they are pickled. Only load directories written
+    by yourself, as loading a pickle can run code.
+
+    Args:
+        directory (str): The spool directory, created if missing
+        endpoint (str): The endpoint of the read, e.g. values/historical
+        params (dict): The extra request parameters, e.g. ProcessingInterval and AggregateName
+        rest_url (str): The URL of the REST API the batches are read from
+        opcua_url (str): The URL of the OPC UA server the batches are read from
+    """
+
+    MANIFEST = "manifest.jsonl"
+
+    def __init__(
+        self,
+        directory: str,
+        endpoint: str,
+        params: Optional[Dict[str, Any]] = None,
+        rest_url: Optional[str] = None,
+        opcua_url: Optional[str] = None,
+    ):
+        self.directory = directory
+        self.endpoint = endpoint
+        self.params = params or {}
+        self.rest_url = None if rest_url is None else str(rest_url)
+        self.opcua_url = None if opcua_url is None else str(opcua_url)
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, self.MANIFEST)
+        self.completed: Dict[str, str] = self._read_manifest()
+
+    def _read_manifest(self) -> Dict[str, str]:
+        completed = {}
+        if not os.path.exists(self.manifest_path):
+            return completed
+        with open(self.manifest_path, encoding="utf-8") as manifest:
+            for line in manifest:
+                try:
+                    entry = json.loads(line)
+                    completed[entry["key"]] = entry["file"]
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(
+                        "Ignoring broken line in %s", self.manifest_path
+                    )
+        return completed
+
+    def key(self, spec: BatchSpec) -> str:
+        """The identity of a batch."""
+        identity = json.dumps(
+            {
+                "rest_url": self.rest_url,
+                "opcua_url": self.opcua_url,
+                "endpoint": self.endpoint,
+                "params": self.params,
+                "read_value_ids": spec.read_value_ids,
+                "start_time": spec.start_time.isoformat(),
+                "end_time": spec.end_time.isoformat(),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def __contains__(self, spec: BatchSpec) -> bool:
+        return self.key(spec) in self.completed
+
+    def __len__(self) -> int:
+        return len(self.completed)
+
+    def load(self, spec: BatchSpec) -> Optional[pd.DataFrame]:
+        """The stored frame of a finished batch.
+
+        Args:
+            spec (BatchSpec): The batch
+        Returns:
+            pd.DataFrame: The frame, None if the batch had no results
+        Raises:
+            KeyError: If the batch is not finished
+        """
+        file_name = self.completed[self.key(spec)]
+        path = os.path.join(self.directory, file_name)
+        if file_name.endswith(".parquet"):
+            if pq is None:
+                raise ImportError(
+                    "The checkpoint is stored as Parquet, install pyarrow "
+                    "with pip install pyPrediktorMapClient[arrow]"
+                )
+            df = pq.read_table(path).to_pandas()
+        else:
+            df = pd.read_pickle(path)
+        return None if df.empty and len(df.columns) == 0 else df
+
+    @staticmethod
+    def _write(df: pd.DataFrame, temp) -> str:
+        """Write a frame to an open file, the file extension to use."""
+        if pa is not None:
+            try:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+            except pa.ArrowException as e:
+                logger.debug("Pickling a batch Parquet cannot hold: %s", e)
+            else:
+                pq.write_table(table, temp)
+                return ".parquet"
+        df.to_pickle(temp)
+        return ".pkl"
+
+    def save(self, spec: BatchSpec, df: Optional[pd.DataFrame]) -> None:
+        """Store the frame of a finished batch and add it to the manifest.
+
+        Args:
+            spec (BatchSpec): The batch
+            df (pd.DataFrame): The frame, None if the batch had no results
+        """
+        key = self.key(spec)
+        if df is None:
+            df = pd.DataFrame()
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp:
+                file_name = key + self._write(df, temp)
+                temp.flush()
+                os.fsync(temp.fileno())
+            os.replace(temp_path, os.path.join(self.directory, file_name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with open(self.manifest_path, "a", encoding="utf-8") as manifest:
+            manifest.write(json.dumps({"key": key, "file": file_name}) + "\n")
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        self.completed[key] = file_name
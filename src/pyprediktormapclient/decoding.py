@@ -0,0 +1,207 @@
+"""Columnar decoding of history responses.
+
+The values of a HistoryReadResults item are flattened into one list per
+column ("Value.Body", "StatusCode.Code", ...) instead of a DataFrame per
+item, and history_frame() builds a single DataFrame from the columns of
+all items.
+
+decode_history_stream() fills the same structure straight from a
+response stream with ijson (``pip install pyPrediktorMapClient[stream]``),
+so neither the raw body nor the object tree of the whole response is
+ever held in memory.
+"""
+
+from functools import partial
+from typing import Any, Dict, List, Optional, Sequence
+
+import pandas as pd
+
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:  # pragma: no cover - depends on the environment
+    ijson = None
+    ObjectBuilder = None
+
+ITEM_PREFIX = "HistoryReadResults."
+NODE_ID_PREFIX = f"{ITEM_PREFIX}NodeId."
+
+_RESULTS = "HistoryReadResults"
+_ITEM = "HistoryReadResults.item"
+_VALUE = "HistoryReadResults.item.DataValues.item"
+# Fill value of columns a data value does not have, as in pd.json_normalize
+_MISSING = float("nan")
+
+# Timestamps of one response can differ in their fractional seconds,
+# pandas 2 needs to be told they are ISO 8601 to not infer one format
+_TIMESTAMP_FORMAT = (
+    {"format": "ISO8601"} if int(pd.__version__.split(".")[0]) >= 2 else {}
+)
+
+
+def parse_timestamps(values: Any) -> pd.Series:
+    """Parse OPC UA timestamps to UTC, unparsable ones give NaT."""
+    return pd.to_datetime(
+        values, utc=True, errors="coerce", **_TIMESTAMP_FORMAT
+    )
+
+
+def _flatten(value: Dict[str, Any], into: Dict[str, Any], prefix: str = ""):
+    """Flatten nested dictionaries with dotted keys, like pd.json_normalize."""
+    nested = []
+    # json_normalize puts the plain keys before the flattened nested ones
+    for key, item in value.items():
+        if isinstance(item, dict):
+            nested.append((key, item))
+        else:
+            into[f"{prefix}{key}"] = item
+    for key, item in nested:
+        _flatten(item, into, f"{prefix}{key}.")
+    return into
+
+
+class DecodedItem(dict):
+    """A HistoryReadResults item with its DataValues as columns.
+
+    It has the keys of the item except DataValues, so code looking at
+    NodeId or StatusCode works on decoded and raw items alike.
+    """
+
+    def __init__(self, **fields):
+        super().__init__(**fields)
+        self.columns: Dict[str, List[Any]] = {}
+        self.rows = 0
+
+    def add_value(self, data_value: Dict[str, Any]) -> None:
+        """Append one entry of DataValues."""
+        for column, value in _flatten(data_value, {}).items():
+            values = self.columns.get(column)
+            if values is None:
+                values = self.columns[column] = [_MISSING] * self.rows
+            values.append(value)
+        self.rows += 1
+        for values in self.columns.values():
+            if len(values) < self.rows:
+                values.append(_MISSING)
+
+    @classmethod
+    def from_item(cls, item: Dict[str, Any]) -> "DecodedItem":
+        """Decode a raw item."""
+        if isinstance(item, DecodedItem):
+            return item
+        decoded = cls(
+            **{
+                key: value
+                for key, value in item.items()
+                if key != "DataValues"
+            }
+        )
+        for data_value in item.get("DataValues") or []:
+            decoded.add_value(data_value)
+        return decoded
+
+
+def history_frame(
+    items: List[Dict[str, Any]], item_fields: Sequence[str] = ()
+) -> Optional[pd.DataFrame]:
+    """One DataFrame with the values of all items.
+
+    Args:
+        items (list): Raw or decoded HistoryReadResults items
+        item_fields (Sequence[str]): Fields of the items repeated on their rows as HistoryReadResults.<field> columns, e.g. AggregateName
+    Returns:
+        pd.DataFrame: The flattened DataValues with HistoryReadResults.NodeId.* columns, None if there are no items
+    """
+    if not items:
+        return None
+    decoded = [DecodedItem.from_item(item) for item in items]
+    value_columns: Dict[str, None] = {}
+    node_columns: Dict[str, None] = {}
+    for item in decoded:
+        value_columns.update(dict.fromkeys(item.columns))
+        node_columns.update(dict.fromkeys(item.get("NodeId") or {}))
+
+    data: Dict[str, List[Any]] = {}
+    for column in value_columns:
+        values = data[column] = []
+        for item in decoded:
+            values.extend(item.columns.get(column) or [_MISSING] * item.rows)
+    for key in node_columns:
+        values = data[f"{NODE_ID_PREFIX}{key}"] = []
+        for item in decoded:
+            values.extend([(item.get("NodeId") or {}).get(key)] * item.rows)
+    for field in item_fields:
+        values = data[f"{ITEM_PREFIX}{field}"] = []
+        for item in decoded:
+            values.extend([item.get(field)] * item.rows)
+    return pd.DataFrame(data)
+
+
+async def decode_history_stream(stream) -> Dict[str, Any]:
+    """Decode a history response while it is being received.
+
+    The top level fields are returned as they are, the entries of
+    HistoryReadResults as DecodedItem.
+
+    Args:
+        stream: An object with an async read(size) method, e.g. the content of an aiohttp response
+    Returns:
+        dict: The response with decoded items
+    Raises:
+        ImportError: If ijson is not installed
+    """
+    if ijson is None:
+        raise ImportError(
+            "Streaming decode needs ijson, install it with "
+            "pip install pyPrediktorMapClient[stream]"
+        )
+    content: Dict[str, Any] = {}
+    item: Optional[DecodedItem] = None
+    builder = None
+    target = None
+    depth = 0
+
+    async for prefix, event, value in ijson.parse_async(
+        stream, use_float=True
+    ):
+        if builder is not None:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                target(builder.value)
+                builder = None
+            continue
+        if event == "map_key":
+            continue
+        if prefix == _RESULTS:
+            if event == "start_array":
+                content[_RESULTS] = []
+            continue
+        if prefix == _ITEM:
+            if event == "start_map":
+                item = DecodedItem()
+            elif event == "end_map":
+                content[_RESULTS].append(item)
+                item = None
+            continue
+        if prefix == f"{_ITEM}.DataValues":
+            continue
+        if prefix == _VALUE:
+            capture = item.add_value
+        elif item is not None and prefix.startswith(f"{_ITEM}."):
+            capture = partial(item.__setitem__, prefix[len(_ITEM) + 1 :])
+        elif prefix and "." not in prefix:
+            capture = partial(content.__setitem__, prefix)
+        else:
+            continue
+        if event in ("start_map", "start_array"):
+            builder = ObjectBuilder()
+            builder.event(event, value)
+            target = capture
+            depth = 1
+        else:
+            capture(value)
+    return content
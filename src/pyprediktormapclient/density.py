@@ -0,0 +1,228 @@
+"""Observed sample density of nodes, and a plan that sizes history batches with
+it.
+
+NodeDensityStats learns the points per second of every node from
+completed raw reads. DensityPlan uses them to group nodes of similar
+density, so a batch of slow nodes covers the whole time range in one
+request while a fast node gets its time range split, and every request
+stays around max_data_points.
+"""
+
+import json
+import logging
+import os
+import statistics
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pyprediktormapclient.batching import BatchSpec
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def node_key(node_id: Dict[str, Any]) -> str:
+    """The identity of a NodeId, e.g. "2;1;SOMEID" for namespace 2."""
+    return (
+        f"{node_id.get('Namespace')};{node_id.get('IdType')};"
+        f"{node_id.get('Id')}"
+    )
+
+
+class NodeDensityStats:
+    """Points per second of nodes, learned from completed reads.
+
+    Every observation is added to decayed totals of points and seconds,
+    so the rate follows changes of a node while long windows weigh more
+    than short ones. With a path the statistics are loaded from and
+    saved to a JSON file.
+
+    Args:
+        path (str): Optional JSON file to persist the statistics in
+        decay (float): Weight of the earlier observations (0-1) when a new one is added
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Optional[str] = None, decay: float = 0.9):
+        if not 0 <= decay < 1:
+            raise ValueError("decay must be at least 0 and below 1")
+        self.path = path
+        self.decay = decay
+        self._totals: Dict[str, Tuple[float, float]] = {}
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._totals)
+
+    def __contains__(self, node_id: Dict[str, Any]) -> bool:
+        return node_key(node_id) in self._totals
+
+    def observe(
+        self, node_id: Dict[str, Any], points: int, seconds: float
+    ) -> None:
+        """Add the number of values a node had in a time window.
+
+        Args:
+            node_id (dict): The NodeId
+            points (int): The number of values returned
+            seconds (float): The length of the time window
+        """
+        if seconds <= 0:
+            return
+        key = node_key(node_id)
+        old_points, old_seconds = self._totals.get(key, (0.0, 0.0))
+        self._totals[key] = (
+            old_points * self.decay + points,
+            old_seconds * self.decay + seconds,
+        )
+
+    def rate(self, node_id: Dict[str, Any]) -> Optional[float]:
+        """The points per second of a node, None if it was not observed."""
+        totals = self._totals.get(node_key(node_id))
+        if totals is None:
+            return None
+        return totals[0] / totals[1]
+
+    def median_rate(self) -> Optional[float]:
+        """The median points per second of the observed nodes."""
+        if not self._totals:
+            return None
+        return statistics.median(
+            points / seconds for points, seconds in self._totals.values()
+        )
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                data = json.load(file)
+            self._totals = {
+                key: (float(points), float(seconds))
+                for key, (points, seconds) in data["nodes"].items()
+            }
+        except (ValueError, KeyError, TypeError):
+            logger.warning(
+                "Ignoring unreadable density statistics in %s", self.path
+            )
+
+    def save(self) -> None:
+        """Write the statistics to path, atomically."""
+        if self.path is None:
+            raise ValueError("The statistics have no path to save to")
+        data = {
+            "version": self.VERSION,
+            "nodes": {
+                key: [points, seconds]
+                for key, (points, seconds) in self._totals.items()
+            },
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as temp:
+                json.dump(data, temp)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class DensityPlan:
+    """Splits a historical read into batches sized by the density of the nodes.
+
+    The nodes are sorted by their rate and packed into groups of
+    similar rate whose expected points over the whole time range stay
+    within max_data_points. A node that alone has more points gets its
+    time range split into equal windows instead. Nodes without
+    statistics are assumed to have default_rate, by default the median
+    rate of the known nodes.
+
+    Args:
+        start_time (datetime): Start of the read
+        end_time (datetime): End of the read
+        read_value_ids (list): The ReadValueIds to read
+        max_data_points (int): The target number of data points per request
+        stats (NodeDensityStats): The learned rates
+        default_rate (float): Points per second of nodes without statistics
+        max_nodes (int): The largest node group per request
+    """
+
+    def __init__(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        read_value_ids: List[Dict[str, Any]],
+        max_data_points: int,
+        stats: NodeDensityStats,
+        default_rate: Optional[float] = None,
+        max_nodes: int = 1000,
+    ):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.max_data_points = max_data_points
+        if default_rate is None:
+            default_rate = stats.median_rate() or 1.0
+        seconds = (end_time - start_time).total_seconds()
+
+        rated = sorted(
+            (
+                (_rate(stats, read_value_id, default_rate), read_value_id)
+                for read_value_id in read_value_ids
+            ),
+            key=lambda pair: pair[0],
+            reverse=True,
+        )
+        # (read_value_ids, number of time windows, expected points)
+        self.groups: List[Tuple[List[Dict[str, Any]], int, float]] = []
+        group: List[Dict[str, Any]] = []
+        group_rate = 0.0
+        for rate, read_value_id in rated:
+            if group and (
+                (group_rate + rate) * seconds > max_data_points
+                or len(group) >= max_nodes
+            ):
+                self._add_group(group, group_rate * seconds)
+                group, group_rate = [], 0.0
+            group.append(read_value_id)
+            group_rate += rate
+        if group:
+            self._add_group(group, group_rate * seconds)
+
+    def _add_group(self, group: List[Dict[str, Any]], points: float) -> None:
+        windows = max(1, -(-int(points) // self.max_data_points))
+        self.groups.append((group, windows, points))
+
+    def __len__(self) -> int:
+        return sum(windows for _, windows, _ in self.groups)
+
+    def __iter__(self) -> Iterator[BatchSpec]:
+        index = 0
+        for group, windows, _ in self.groups:
+            step = (self.end_time - self.start_time) / windows
+            for num in range(windows):
+                yield BatchSpec(
+                    index=index,
+                    read_value_ids=group,
+                    start_time=self.start_time + step * num,
+                    end_time=(
+                        self.end_time
+                        if num == windows - 1
+                        else self.start_time + step * (num + 1)
+                    ),
+                )
+                index += 1
+
+
+def _rate(
+    stats: Optional[NodeDensityStats],
+    read_value_id: Dict[str, Any],
+    default_rate: float,
+) -> float:
+    """The points per second of a node, default_rate if it is unknown."""
+    rate = None
+    if stats is not None:
+        rate = stats.rate(read_value_id.get("NodeId") or {})
+    return default_rate if rate is None else rate
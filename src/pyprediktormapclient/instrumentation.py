@@ -0,0 +1,321 @@
+import json
+import logging
+import math
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class RequestEvent(BaseModel):
+    """An observation emitted to the hooks of a client.
+
+    Variables:
+        kind: str - "request" for every HTTP attempt, "batch" for every history batch and "call" for every public call that fans out into batches
+        endpoint: str - The endpoint, e.g. values/historical
+        method: str - The HTTP method
+        attempt: int - The attempt number, starting at 1 (request events)
+        status: Optional[int] - The HTTP status code, None if no response was received
+        bytes_sent: int - Size of the request body
+        bytes_received: int - Size of the response body
+        rows: int - Number of rows decoded
+        requests: int - Number of requests the event covers
+        durations: Dict[str, float] - Seconds spent per phase, e.g. network, decode, dataframe, batching, retry_wait and total
+        error: Optional[str] - The error if the request, batch or call failed
+    """
+
+    kind: str
+    endpoint: str
+    method: str = "POST"
+    attempt: int = 1
+    status: Optional[int] = None
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    rows: int = 0
+    requests: int = 1
+    durations: Dict[str, float] = Field(default_factory=dict)
+    error: Optional[str] = None
+
+
+class Hooks:
+    """Observers of the requests made by the clients.
+
+    An observer is any callable taking a RequestEvent, e.g. a
+    MetricsRegistry. Exceptions raised by observers are logged and
+    otherwise ignored so they can never break a request.
+
+    Args:
+        *observers (Callable): The initial observers
+
+    Examples:
+        >>> metrics = MetricsRegistry()
+        >>> hooks = Hooks(metrics, lambda event: print(event.durations))
+        >>> opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, hooks=hooks)
+    """
+
+    def __init__(self, *observers: Callable[[RequestEvent], None]):
+        self._observers: List[Callable[[RequestEvent], None]] = list(observers)
+
+    def __bool__(self) -> bool:
+        return bool(self._observers)
+
+    def subscribe(self, observer: Callable[[RequestEvent], None]) -> None:
+        self._observers.append(observer)
+
+    def unsubscribe(self, observer: Callable[[RequestEvent], None]) -> None:
+        self._observers.remove(observer)
+
+    def emit(self, event: RequestEvent) -> None:
+        """Send the event to all observers."""
+        for observer in list(self._observers):
+            try:
+                observer(event)
+            except Exception:
+                logger.exception("Observer %r failed", observer)
+
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Dict[str, str] = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._values: Dict[LabelKey, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0.0)
+
+    def collect(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {"labels": dict(key), "value": value}
+                for key, value in self._values.items()
+            ]
+
+    def to_prometheus(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Bucketed observations per label set.
+
+    Args:
+        name (str): The metric name
+        description (str): The help text
+        buckets (Sequence[float]): Upper bounds of the buckets, +Inf is added if missing
+    """
+
+    DEFAULT_BUCKETS = (
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+        60.0,
+    )
+
+    def __init__(
+        self,
+        name: str,
+        description: str = "",
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets += (math.inf,)
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * len(self.buckets)
+            for num, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[num] += 1
+                    break
+            self._sums[key] += value
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(_label_key(labels), []))
+
+    def sum(self, **labels) -> float:
+        return self._sums.get(_label_key(labels), 0.0)
+
+    def collect(self) -> List[Dict]:
+        with self._lock:
+            return [
+                {
+                    "labels": dict(key),
+                    "buckets": {
+                        str(bound): count
+                        for bound, count in zip(self.buckets, counts)
+                    },
+                    "count": sum(counts),
+                    "sum": self._sums[key],
+                }
+                for key, counts in self._counts.items()
+            ]
+
+    def to_prometheus(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    labels = _format_labels(key, {"le": le})
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(key)
+                lines.append(f"{self.name}_sum{labels} {self._sums[key]}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """In-memory registry of counters and histograms.
+
+    The registry is an observer itself, add it to Hooks to record
+    request counts, errors, retries, bytes, rows and per-phase
+    durations. Read the metrics with snapshot(), dump() or
+    to_prometheus().
+
+    Args:
+        prefix (str): Prefix for the metric names
+    """
+
+    def __init__(self, prefix: str = "pyprediktormapclient"):
+        self.prefix = prefix
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        """Get or create a counter."""
+        return self._get_or_create(name, Counter, description)
+
+    def histogram(
+        self,
+        name: str,
+        description: str = "",
+        buckets: Sequence[float] = Histogram.DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Get or create a histogram."""
+        return self._get_or_create(name, Histogram, description, buckets)
+
+    def _get_or_create(self, name, metric_type, *args):
+        full_name = f"{self.prefix}_{name}" if self.prefix else name
+        with self._lock:
+            metric = self._metrics.get(full_name)
+            if metric is None:
+                metric = self._metrics[full_name] = metric_type(
+                    full_name, *args
+                )
+        if not isinstance(metric, metric_type):
+            raise ValueError(f"{full_name} is not a {metric_type.__name__}")
+        return metric
+
+    def __call__(self, event: RequestEvent) -> None:
+        labels = {"endpoint": event.endpoint}
+        if event.kind == "request":
+            self.counter("requests_total", "HTTP requests").inc(
+                status=event.status, **labels
+            )
+            self.counter("bytes_sent_total", "Request body bytes").inc(
+                event.bytes_sent, **labels
+            )
+            self.counter("bytes_received_total", "Response body bytes").inc(
+                event.bytes_received, **labels
+            )
+            if event.attempt > 1:
+                self.counter("retries_total", "Retried requests").inc(**labels)
+            if event.error is not None:
+                self.counter("request_errors_total", "Failed requests").inc(
+                    **labels
+                )
+        elif event.kind == "call":
+            self.counter("rows_total", "Rows decoded").inc(
+                event.rows, **labels
+            )
+            if event.error is not None:
+                self.counter("call_errors_total", "Failed calls").inc(**labels)
+        phases = self.histogram("phase_seconds", "Seconds spent per phase")
+        for phase, seconds in event.durations.items():
+            phases.observe(seconds, kind=event.kind, phase=phase, **labels)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """All metrics as a dictionary."""
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {
+            name: {
+                "type": type(metric).__name__.lower(),
+                "description": metric.description,
+                "values": metric.collect(),
+            }
+            for name, metric in metrics.items()
+        }
+
+    def dump(self) -> str:
+        """All metrics as a JSON string."""
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.to_prometheus())
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._metrics.clear()
@@ -7,7 +7,9 @@ import requests
 from pydantic import AnyUrl
 from pydantic_core import Url
 
-from pyprediktormapclient.shared import request_from_api
+from pyprediktormapclient.instrumentation import Hooks
+from pyprediktormapclient.shared import auth_headers, request_from_api
+from pyprediktormapclient.transport import RequestsTransport, Transport
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -18,6 +20,10 @@ class ModelIndex:
 
     Args:
         url (str): The URL of the ModelIndex server with the trailing slash
+        auth_client (AUTH_CLIENT): Optional authentication client
+        session (requests.Session): Optional session to reuse connections
+        hooks (Hooks): Optional observers that get a RequestEvent for every request
+        transport (Transport): Optional HTTP access shared with other clients, e.g. an HTTPTransport with pooled connections or a FakeTransport. Used when no session is given, defaults to a RequestsTransport
 
     Todo:
         * Validate combination of url and endpoint
@@ -31,6 +37,8 @@ class ModelIndex:
         url: AnyUrl,
         auth_client: object = None,
         session: requests.Session = None,
+        hooks: Hooks = None,
+        transport: Transport = None,
     ):
         self.url = url
         self.headers = {
@@ -38,7 +46,13 @@ class ModelIndex:
             "Accept": "application/json",
         }
         self.auth_client = auth_client
+        self.transport = (
+            transport if transport is not None else RequestsTransport()
+        )
+        if session is None:
+            session = self.transport.session
         self.session = session
+        self.hooks = hooks
 
         if self.auth_client is not None:
             if self.auth_client.token is not None:
@@ -81,8 +95,9 @@ class ModelIndex:
             self.url,
             "GET",
             "query/namespace-array",
-            headers=self.headers,
+            headers=auth_headers(self.headers, self.auth_client),
             session=self.session,
+            hooks=self.hooks,
         )
         return content
 
@@ -91,8 +106,9 @@ class ModelIndex:
             self.url,
             "GET",
             "query/object-types",
-            headers=self.headers,
+            headers=auth_headers(self.headers, self.auth_client),
             session=self.session,
+            hooks=self.hooks,
         )
         return content
 
@@ -135,8 +151,9 @@ class ModelIndex:
             "POST",
             "query/objects-of-type",
             body,
-            headers=self.headers,
+            headers=auth_headers(self.headers, self.auth_client),
             session=self.session,
+            hooks=self.hooks,
         )
         return content
 
@@ -172,8 +189,9 @@ class ModelIndex:
             "POST",
             "query/object-descendants",
             body,
-            headers=self.headers,
+            headers=auth_headers(self.headers, self.auth_client),
             session=self.session,
+            hooks=self.hooks,
         )
         return content
 
@@ -209,7 +227,8 @@ class ModelIndex:
             "POST",
             "query/object-ancestors",
             body,
-            headers=self.headers,
+            headers=auth_headers(self.headers, self.auth_client),
             session=self.session,
+            hooks=self.hooks,
         )
         return content
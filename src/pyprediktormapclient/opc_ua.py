@@ -1,21 +1,69 @@
 import asyncio
 import copy
+import functools
 import json
 import logging
-from asyncio import Semaphore
+import random
+import time
 from datetime import date, datetime, timedelta
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import aiohttp
 import nest_asyncio
+import numpy as np
 import pandas as pd
 import requests
-from aiohttp import ClientSession
 from pydantic import AnyUrl, BaseModel
 from pydantic_core import Url
 from requests import HTTPError
 
-from pyprediktormapclient.shared import request_from_api
+from pyprediktormapclient import tracing
+from pyprediktormapclient.batching import (
+    BatchEstimate,
+    BatchSpec,
+    Bisector,
+    BisectPolicy,
+    FailedBatch,
+    HistoryReadExplanation,
+    HistoryReadPlan,
+    HistoryReadReport,
+    run_batches,
+)
+from pyprediktormapclient.cache import (
+    AggregateCache,
+    completed_buckets,
+    first_bucket,
+)
+from pyprediktormapclient.checkpoint import Checkpoint
+from pyprediktormapclient.decoding import (
+    ITEM_PREFIX,
+    NODE_ID_PREFIX,
+    DecodedItem,
+    decode_history_stream,
+    history_frame,
+    parse_timestamps,
+)
+from pyprediktormapclient.density import (
+    DensityPlan,
+    NodeDensityStats,
+    _rate,
+    node_key,
+)
+from pyprediktormapclient.instrumentation import Hooks, RequestEvent
+from pyprediktormapclient.shared import auth_headers, request_from_api
+from pyprediktormapclient.sinks import MemorySink, ResultSink, SortedMemorySink
+from pyprediktormapclient.transport import AiohttpTransport, Transport
 
 nest_asyncio.apply()
 
@@ -23,6 +71,57 @@ nest_asyncio.apply()
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+# Bad status codes of a HistoryReadResults item that are worth asking for
+# again, see https://reference.opcfoundation.org/Core/Part6/v104/docs/A.2
+TRANSIENT_STATUS_CODES = {
+    0x80030000: "BadOutOfMemory",
+    0x80040000: "BadResourceUnavailable",
+    0x80050000: "BadCommunicationError",
+    0x800A0000: "BadTimeout",
+    0x800C0000: "BadShutdown",
+    0x800D0000: "BadServerNotConnected",
+    0x800E0000: "BadServerHalted",
+    0x80100000: "BadTooManyOperations",
+    0x80310000: "BadNoCommunication",
+    0x80320000: "BadWaitingForInitialData",
+    0x807D0000: "BadTcpServerTooBusy",
+    0x80850000: "BadRequestTimeout",
+    0x80AE0000: "BadConnectionClosed",
+}
+TRANSIENT_STATUS_SYMBOLS = frozenset(TRANSIENT_STATUS_CODES.values())
+
+# HTTP statuses that mean the bearer token was not accepted
+AUTH_ERROR_STATUSES = (401, 403)
+
+
+# HTTP statuses that mean the request was too large for the server
+TOO_LARGE_STATUSES = (413,)
+
+# GoodMoreData, the server returned part of the values of a node
+MORE_DATA_STATUS_CODE = 0x00A60000
+
+# Rough JSON size of a value with its timestamp and status, and of the
+# NodeId and status of a node in a history response
+BYTES_PER_VALUE = 110
+BYTES_PER_NODE = 150
+
+
+class _AuthenticationFailed(Exception):
+    """The server rejected the token of a request."""
+
+
+class _BatchTooLarge(Exception):
+    """A history request timed out, was rejected as too large or came back
+    truncated.
+
+    Variables:
+        nodes_first: bool - Splitting the node group helps more than splitting the time window
+    """
+
+    def __init__(self, message: str, nodes_first: bool = False):
+        super().__init__(message)
+        self.nodes_first = nodes_first
+
 
 class Variables(BaseModel):
     """Helper class to parse all values api's.
@@ -157,6 +256,202 @@ class Config:
     arbitrary_types_allowed = True
 
 
+def _truncate(text: str, max_chars: Optional[int]) -> str:
+    """Shorten text for logging, max_chars None keeps all of it."""
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text) - max_chars} more characters)"
+
+
+def _copy_item_fields(
+    content: Dict[str, Any],
+    read_value_ids: List[Dict[str, Any]],
+    fields: Sequence[str],
+) -> None:
+    """Copy fields of the ReadValueIds to their results, which are in the same
+    order."""
+    if not fields or not isinstance(content, dict):
+        return
+    results = content.get("HistoryReadResults")
+    if not results:
+        return
+    if len(results) != len(read_value_ids):
+        raise RuntimeError(
+            f"Got {len(results)} results for {len(read_value_ids)} "
+            "ReadValueIds"
+        )
+    for item, read_value_id in zip(results, read_value_ids):
+        for field in fields:
+            item[field] = read_value_id.get(field)
+
+
+def _reject_options(kwargs: Dict[str, Any], reason: str) -> None:
+    """Raise for options of get_historical_values that need the read to be a
+    single call."""
+    for option in ("plan", "sink", "on_error"):
+        if kwargs.get(option) not in (None, "raise"):
+            raise ValueError(f"{option} cannot be used with {reason}")
+
+
+def _with_interval(result: Any, pro_interval: int) -> Any:
+    """Add the ProcessingInterval column to a read result."""
+    df = result[0] if isinstance(result, tuple) else result
+    if isinstance(df, pd.DataFrame) and len(df):
+        df["ProcessingInterval"] = pro_interval
+    return result
+
+
+def _contiguous(
+    starts: List[datetime], interval: timedelta
+) -> List[Tuple[datetime, datetime]]:
+    """The first and last start of every run of consecutive buckets."""
+    runs = []
+    for start in starts:
+        if runs and runs[-1][1] + interval == start:
+            runs[-1] = (runs[-1][0], start)
+        else:
+            runs.append((start, start))
+    return runs
+
+
+def _read_end_time(plan: Iterable[BatchSpec]) -> Optional[datetime]:
+    """The end of the whole read of a plan, None for an empty plan."""
+    end_time = getattr(plan, "end_time", None)
+    if end_time is None:
+        end_time = max((spec.end_time for spec in plan), default=None)
+    return end_time
+
+
+def _utc_timestamp(value: datetime) -> pd.Timestamp:
+    """A request time as a UTC timestamp, naive times are sent as UTC."""
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize("UTC")
+    return timestamp.tz_convert("UTC")
+
+
+def _timestamp_positions(times: pd.Series, value: datetime) -> np.ndarray:
+    """The positions of the timestamps equal to a request time.
+
+    Text timestamps are matched against the spellings of the time the
+    server uses, e.g. 2023-01-01T01:00:00Z or 2023-01-01T01:00:00.000Z,
+    which is much faster than parsing the column.
+    """
+    timestamp = _utc_timestamp(value)
+    if not pd.api.types.is_object_dtype(times):
+        return np.flatnonzero(parse_timestamps(times) == timestamp)
+    base = timestamp.strftime("%Y-%m-%dT%H:%M:%S")
+    fraction = f"{timestamp.microsecond:06d}".rstrip("0")
+    spellings = [
+        base + ("." + (fraction + "0" * 7)[:digits] if digits else "") + suffix
+        for digits in range(len(fraction), 8)
+        for suffix in ("Z", "+00:00")
+    ]
+    return np.flatnonzero(times.isin(spellings).to_numpy())
+
+
+def _expires_at(
+    timeout: Optional[float], deadline: Optional[datetime]
+) -> Optional[float]:
+    """The time.monotonic() value at which a call runs out of budget.
+
+    Args:
+        timeout (float): Seconds the call may take, None for no limit
+        deadline (datetime): Wall clock time the call must finish by, naive datetimes are local time. None for no limit
+    Returns:
+        float: The monotonic expiry time, the earliest of the two, or None if neither is given
+    """
+    budgets = []
+    if timeout is not None:
+        budgets.append(timeout)
+    if deadline is not None:
+        budgets.append(
+            (deadline - datetime.now(deadline.tzinfo)).total_seconds()
+        )
+    if not budgets:
+        return None
+    return time.monotonic() + min(budgets)
+
+
+def _is_transient_status(status: Optional[Dict[str, Any]]) -> bool:
+    """Check if the StatusCode of a HistoryReadResults item is a bad status
+    that may go away when the node is read again.
+
+    The symbol is used when the server sends one, otherwise the code
+    without its info bits.
+    """
+    if not status:
+        return False
+    symbol = status.get("Symbol")
+    if symbol:
+        return symbol in TRANSIENT_STATUS_SYMBOLS
+    code = status.get("Code")
+    if not isinstance(code, int):
+        return False
+    return (code & 0xFFFF0000) in TRANSIENT_STATUS_CODES
+
+
+def _is_good_status(status: Optional[Dict[str, Any]]) -> bool:
+    """Check if the StatusCode of a HistoryReadResults item is Good.
+
+    Items without a StatusCode are Good. The severity bits of the code
+    are used when the server sends one, otherwise the symbol.
+    """
+    if not status:
+        return True
+    code = status.get("Code")
+    if isinstance(code, int):
+        return code & 0xC0000000 == 0
+    symbol = status.get("Symbol")
+    return not symbol or symbol.startswith("Good")
+
+
+def _is_session_expired(error_text: str) -> bool:
+    """Check if an error response has the body the server sends for an expired
+    session, the case check_auth_client handles."""
+    try:
+        content = json.loads(error_text)
+    except ValueError:
+        return False
+    error = content.get("error") if isinstance(content, dict) else None
+    return isinstance(error, dict) and error.get("code") == 404
+
+
+def _is_truncated(item: Dict[str, Any], point_limit: Optional[int]) -> bool:
+    """Check if a HistoryReadResults item holds only part of the values of its
+    node.
+
+    The server signals this with a continuation point or the
+    GoodMoreData status, or the number of values reaches its
+    point_limit.
+    """
+    if item.get("ContinuationPoint"):
+        return True
+    status = item.get("StatusCode") or {}
+    if status.get("Symbol") == "GoodMoreData":
+        return True
+    code = status.get("Code")
+    if isinstance(code, int) and code & 0xFFFF0000 == MORE_DATA_STATUS_CODE:
+        return True
+    if point_limit is None:
+        return False
+    if isinstance(item, DecodedItem):
+        return item.rows >= point_limit
+    return len(item.get("DataValues") or []) >= point_limit
+
+
+def _trace_attributes(arguments: Dict) -> Dict:
+    """Span attributes for the public OPC_UA calls."""
+    variable_list = arguments.get("variable_list")
+    return {
+        "nodes": None if variable_list is None else len(variable_list),
+        "start_time": arguments.get("start_time"),
+        "end_time": arguments.get("end_time"),
+        "pro_interval": arguments.get("pro_interval"),
+        "agg_name": arguments.get("agg_name"),
+    }
+
+
 class OPC_UA:
     """Helper functions to access the OPC UA REST Values API server.
 
@@ -164,6 +459,10 @@ class OPC_UA:
         rest_url (str): The complete url of the OPC UA Values REST API. E.g. "http://127.0.0.1:13371/"
         opcua_url (str): The complete url of the OPC UA Server that is passed on to the REST server. E.g. "opc.tcp://127.0.0.1:4872"
         namespaces (list): An optional but recommended ordered list of namespaces so that IDs match
+        hooks (Hooks): Optional observers that get a RequestEvent for every request, history batch and historical call
+        log_body_sample_rate (float): Share of history requests (0-1) whose body is logged at DEBUG level
+        log_body_max_chars (int): Truncate logged request bodies to this many characters, None to log them in full
+        slow_request_threshold (float): Log a warning with the request body for history requests slower than this many seconds, None to disable
 
     Returns:
         Object
@@ -184,6 +483,11 @@ class OPC_UA:
         namespaces: List = None,
         auth_client: object = None,
         session: requests.Session = None,
+        hooks: Hooks = None,
+        log_body_sample_rate: float = 1.0,
+        log_body_max_chars: Optional[int] = 2000,
+        slow_request_threshold: Optional[float] = None,
+        transport: Transport = None,
     ):
         """Class initializer.
 
@@ -191,6 +495,11 @@ class OPC_UA:
             rest_url (str): The complete url of the OPC UA Values REST API. E.g. "http://127.0.0.1:13371/"
             opcua_url (str): The complete url of the OPC UA Server that is passed on to the REST server. E.g. "opc.tcp://127.0.0.1:4872"
             namespaces (list): An optional but recommended ordered list of namespaces so that IDs match
+            hooks (Hooks): Optional observers that get a RequestEvent for every request, history batch and historical call
+            log_body_sample_rate (float): Share of history requests (0-1) whose body is logged at DEBUG level
+            log_body_max_chars (int): Truncate logged request bodies to this many characters, None to log them in full
+            slow_request_threshold (float): Log a warning with the request body for history requests slower than this many seconds, None to disable
+            transport (Transport): Optional HTTP access shared with other clients, e.g. an HTTPTransport with pooled connections or a FakeTransport. Defaults to an AiohttpTransport, a given session is used for the sync calls instead of the session of the transport
         Returns:
             Object: The initialized class object
         """
@@ -202,8 +511,18 @@ class OPC_UA:
             "Accept": "text/plain",
         }
         self.auth_client = auth_client
+        self.transport = (
+            transport if transport is not None else AiohttpTransport()
+        )
+        if session is None:
+            session = self.transport.session
         self.session = session
+        self.hooks = hooks
+        self.log_body_sample_rate = log_body_sample_rate
+        self.log_body_max_chars = log_body_max_chars
+        self.slow_request_threshold = slow_request_threshold
         self.helper = AsyncIONotebookHelper()
+        self._auth_refresh = None
 
         if not str(self.opcua_url).startswith("opc.tcp://"):
             raise ValueError("Invalid OPC UA URL")
@@ -275,6 +594,7 @@ class OPC_UA:
 
         return new_vars
 
+    @tracing.traced("OPC_UA.get_values", _trace_attributes)
     def get_values(self, variable_list: List[Variables]) -> List:
         """Request realtime values from the OPC UA server.
 
@@ -293,8 +613,10 @@ class OPC_UA:
                 method="POST",
                 endpoint="values/get",
                 data=json.dumps([body], default=self.json_serial),
-                headers=self.headers,
+                headers=auth_headers(self.headers, self.auth_client),
                 extended_timeout=True,
+                session=self.session,
+                hooks=self.hooks,
             )
         except HTTPError as e:
             if self.auth_client is not None:
@@ -304,8 +626,10 @@ class OPC_UA:
                     method="POST",
                     endpoint="values/get",
                     data=json.dumps([body], default=self.json_serial),
-                    headers=self.headers,
+                    headers=auth_headers(self.headers, self.auth_client),
                     extended_timeout=True,
+                    session=self.session,
+                    hooks=self.hooks,
                 )
             else:
                 raise RuntimeError(f"Error in get_values: {str(e)}") from e
@@ -384,65 +708,319 @@ class OPC_UA:
         return df_result
 
     async def _make_request(
-        self, endpoint: str, body: dict, max_retries: int, retry_delay: int
+        self,
+        endpoint: str,
+        body: dict,
+        max_retries: int,
+        retry_delay: int,
+        expires_at: Optional[float] = None,
+        stream_decode: bool = False,
+        split_oversized: bool = False,
     ):
-        for attempt in range(max_retries):
-            try:
-                logging.info(f"Attempt {attempt + 1} of {max_retries}")
-                async with ClientSession() as session:
-                    url = f"{self.rest_url}{endpoint}"
-                    logging.info(f"Making POST request to {url}")
-                    logging.debug(f"Request body: {body}")
-                    logging.debug(f"Request headers: {self.headers}")
-
-                    async with session.post(
-                        url, json=body, headers=self.headers
-                    ) as response:
-                        logging.info(
-                            f"Response received: Status {response.status}"
-                        )
+        """POST a request with retries and exponential backoff.
+
+        Requests rejected with 401 or 403, or with the {"error": {"code":
+        404}} body the server sends for an expired session, get a new
+        token from the auth client and are sent again right away, once
+        per call. That retry does not count as an attempt and has no
+        backoff.
 
-                        if response.status >= 400:
-                            error_text = await response.text()
-                            logging.error(
-                                f"HTTP error {response.status}: {error_text}"
+        Args:
+            endpoint (str): The endpoint, e.g. values/historical
+            body (dict): The request body
+            max_retries (int): The number of attempts
+            retry_delay (int): Seconds to wait before the first retry, doubled for every further retry
+            expires_at (float): Optional time.monotonic() value the request must finish by. Every attempt only gets the remaining budget as its timeout
+            stream_decode (bool): Decode a history response while it is received instead of reading the whole body first, see decoding.decode_history_stream
+            split_oversized (bool): Fail with _BatchTooLarge right away instead of retrying when the request times out or is rejected with 413, so the caller can split it
+        Returns:
+            dict: The decoded response
+        Raises:
+            TimeoutError: If the budget runs out before a successful attempt
+            RuntimeError: If all attempts fail
+        """
+        retry_wait = 0.0
+        attempts = 0
+        attempt = 0
+        auth_refreshed = False
+        try:
+            while attempt < max_retries:
+                started = time.perf_counter()
+                session_timeout = self._remaining_timeout(expires_at, endpoint)
+                attempts = attempt + 1
+                event = None
+                if self.hooks:
+                    event = RequestEvent(
+                        kind="request", endpoint=endpoint, attempt=attempt + 1
+                    )
+                    if retry_wait:
+                        event.durations["retry_wait"] = retry_wait
+                try:
+                    with tracing.span(
+                        "OPC_UA.request" if attempt == 0 else "OPC_UA.retry",
+                        endpoint=endpoint,
+                        attempt=attempt + 1,
+                    ):
+                        async with self.transport.async_session(
+                            **session_timeout
+                        ) as session:
+                            url = f"{self.rest_url}{endpoint}"
+                            data = json.dumps(body, default=self.json_serial)
+                            self._log_request(url, data, attempt, max_retries)
+                            sent_token = getattr(
+                                self.auth_client, "token", None
                             )
-                            await response.raise_for_status()
-
-                        return await response.json()
-
-            except aiohttp.ClientResponseError as e:
-                logging.error(f"ClientResponseError: {e}")
-                if attempt == max_retries - 1:
-                    raise RuntimeError("Max retries reached") from e
-            except aiohttp.ClientError as e:
-                logging.error(f"ClientError in POST request: {e}")
-            except Exception as e:
-                logging.error(f"Unexpected error in _make_request: {e}")
-
-            if attempt < max_retries - 1:
-                wait_time = retry_delay * (2**attempt)
-                logging.warning(
-                    f"Request failed. Retrying in {wait_time} seconds..."
-                )
-                await asyncio.sleep(wait_time)
 
-        logging.error("Max retries reached.")
-        raise RuntimeError("Max retries reached")
+                            async with session.post(
+                                url,
+                                data=data,
+                                headers=auth_headers(
+                                    self.headers, self.auth_client
+                                ),
+                            ) as response:
+                                logger.debug(
+                                    "Response received: Status %s",
+                                    response.status,
+                                )
+                                tracing.set_attributes(
+                                    http_status_code=response.status
+                                )
+                                if event is not None:
+                                    event.status = response.status
+                                    event.bytes_sent = len(data.encode())
+
+                                if (
+                                    response.status in AUTH_ERROR_STATUSES
+                                    and self.auth_client is not None
+                                    and not auth_refreshed
+                                ):
+                                    raise _AuthenticationFailed(
+                                        f"HTTP {response.status}"
+                                    )
+
+                                if response.status >= 400:
+                                    error_text = await response.text()
+                                    if (
+                                        self.auth_client is not None
+                                        and not auth_refreshed
+                                        and _is_session_expired(error_text)
+                                    ):
+                                        raise _AuthenticationFailed(
+                                            f"HTTP {response.status}, "
+                                            "session expired"
+                                        )
+                                    logger.error(
+                                        "HTTP error %s: %s",
+                                        response.status,
+                                        error_text,
+                                    )
+                                    if (
+                                        split_oversized
+                                        and response.status
+                                        in TOO_LARGE_STATUSES
+                                    ):
+                                        raise _BatchTooLarge(
+                                            f"HTTP {response.status}",
+                                            nodes_first=True,
+                                        )
+                                    await response.raise_for_status()
+
+                                if stream_decode:
+                                    # Network and decode time overlap, so
+                                    # only the total is reported
+                                    content = await decode_history_stream(
+                                        response.content
+                                    )
+                                    if event is not None:
+                                        event.bytes_received = getattr(
+                                            response.content, "total_bytes", 0
+                                        )
+                                        event.durations["total"] = (
+                                            time.perf_counter() - started
+                                        )
+                                        self.hooks.emit(event)
+                                    self._log_slow_request(
+                                        url, data, started, response.status
+                                    )
+                                    return content
+
+                                if event is None:
+                                    content = await response.json()
+                                    self._log_slow_request(
+                                        url, data, started, response.status
+                                    )
+                                    return content
+
+                                # Read the body first to tell network and decode
+                                # time apart
+                                raw = await response.read()
+                                received = time.perf_counter()
+                                content = await response.json()
+                                event.bytes_received = len(raw)
+                                event.durations["network"] = received - started
+                                event.durations["decode"] = (
+                                    time.perf_counter() - received
+                                )
+                                event.durations["total"] = (
+                                    time.perf_counter() - started
+                                )
+                                self.hooks.emit(event)
+                                self._log_slow_request(
+                                    url, data, started, response.status
+                                )
+                                return content
+
+                except _AuthenticationFailed as e:
+                    self._emit_failed_request(event, started, e)
+                    logger.warning(
+                        "Request to %s was not authorized (%s), "
+                        "refreshing the token",
+                        endpoint,
+                        e,
+                    )
+                    await self._refresh_auth(sent_token)
+                    auth_refreshed = True
+                    continue
+                except _BatchTooLarge as e:
+                    self._emit_failed_request(event, started, e)
+                    raise
+                except asyncio.TimeoutError as e:
+                    self._emit_failed_request(event, started, e)
+                    if split_oversized:
+                        raise _BatchTooLarge(
+                            f"Request to {endpoint} timed out"
+                        ) from e
+                    logger.error("Request to %s timed out", endpoint)
+                except aiohttp.ClientResponseError as e:
+                    self._emit_failed_request(event, started, e)
+                    logger.error("ClientResponseError: %s", e)
+                    if attempt == max_retries - 1:
+                        raise RuntimeError("Max retries reached") from e
+                except aiohttp.ClientError as e:
+                    self._emit_failed_request(event, started, e)
+                    logger.error("ClientError in POST request: %s", e)
+                except Exception as e:
+                    self._emit_failed_request(event, started, e)
+                    logger.error("Unexpected error in _make_request: %s", e)
+
+                if attempt < max_retries - 1:
+                    wait_time = retry_delay * (2**attempt)
+                    if (
+                        expires_at is not None
+                        and time.monotonic() + wait_time >= expires_at
+                    ):
+                        # Waiting would use up the budget, fail right away
+                        raise TimeoutError(
+                            f"Request to {endpoint} ran out of time budget "
+                            f"after {attempt + 1} attempts"
+                        )
+                    logger.warning(
+                        "Request failed. Retrying in %s seconds...", wait_time
+                    )
+                    await asyncio.sleep(wait_time)
+                    retry_wait = wait_time
+                attempt += 1
+
+            logger.error("Max retries reached.")
+            raise RuntimeError("Max retries reached")
+        except Exception as e:
+            # Lets callers report how often a failed request was tried
+            e.attempts = attempts
+            raise
+
+    async def _refresh_auth(self, sent_token: object) -> None:
+        """Get a new token after a request was not authorized.
+
+        Requests that fail at the same time await one shared refresh,
+        and a request that was sent with a token that has been replaced
+        meanwhile is just sent again.
+
+        Args:
+            sent_token (Token): The token the failed request was sent with
+        """
+        if self.auth_client.token is not sent_token:
+            return
+        if self._auth_refresh is None or self._auth_refresh.done():
+            loop = asyncio.get_running_loop()
+            self._auth_refresh = loop.run_in_executor(
+                None, self.auth_client.request_new_ory_token, sent_token
+            )
+        # Shielded so a cancelled request does not cancel the others' refresh
+        await asyncio.shield(self._auth_refresh)
+
+    @staticmethod
+    def _remaining_timeout(
+        expires_at: Optional[float], endpoint: str
+    ) -> Dict[str, aiohttp.ClientTimeout]:
+        """ClientSession arguments limiting a request to the remaining budget,
+        empty without a budget."""
+        if expires_at is None:
+            return {}
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Request to {endpoint} ran out of time budget")
+        return {"timeout": aiohttp.ClientTimeout(total=remaining)}
+
+    def _log_request(
+        self, url: str, data: str, attempt: int, max_retries: int
+    ) -> None:
+        """Log a history request, the body only for the sampled share of
+        requests and truncated to log_body_max_chars."""
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug(
+            "Making POST request to %s, attempt %s of %s",
+            url,
+            attempt + 1,
+            max_retries,
+        )
+        logger.debug("Request headers: %s", self._redacted_headers())
+        if (
+            self.log_body_sample_rate >= 1
+            or random.random() < self.log_body_sample_rate
+        ):
+            logger.debug(
+                "Request body: %s", _truncate(data, self.log_body_max_chars)
+            )
+
+    def _log_slow_request(
+        self, url: str, data: str, started: float, status: int
+    ) -> None:
+        if self.slow_request_threshold is None:
+            return
+        elapsed = time.perf_counter() - started
+        if elapsed > self.slow_request_threshold and logger.isEnabledFor(
+            logging.WARNING
+        ):
+            logger.warning(
+                "Slow request to %s took %.3f s (status %s). Request body: %s",
+                url,
+                elapsed,
+                status,
+                _truncate(data, self.log_body_max_chars),
+            )
+
+    def _redacted_headers(self) -> Dict[str, str]:
+        return {
+            key: "***" if key.lower() == "authorization" else value
+            for key, value in self.headers.items()
+        }
 
-    def _process_content(self, content: dict) -> pd.DataFrame:
+    def _emit_failed_request(
+        self, event: Optional[RequestEvent], started: float, error: Exception
+    ) -> None:
+        if event is None:
+            return
+        event.error = str(error)
+        event.durations["total"] = time.perf_counter() - started
+        self.hooks.emit(event)
+
+    def _process_content(
+        self, content: dict, item_fields: Sequence[str] = ()
+    ) -> pd.DataFrame:
         self._check_content(content)
-        df_list = []
-        for item in content["HistoryReadResults"]:
-            df = pd.json_normalize(item["DataValues"])
-            for key, value in item["NodeId"].items():
-                df[f"HistoryReadResults.NodeId.{key}"] = value
-            df_list.append(df)
-
-        if df_list:
-            df_result = pd.concat(df_list)
-            df_result.reset_index(inplace=True, drop=True)
-            return df_result
+        # One frame built from columns instead of a frame per node
+        return history_frame(content["HistoryReadResults"], item_fields)
 
     async def get_historical_values(
         self,
@@ -456,65 +1034,732 @@ class OPC_UA:
         max_retries: int = 3,
         retry_delay: int = 5,
         max_concurrent_requests: int = 30,
-    ) -> pd.DataFrame:
+        timeout: float = None,
+        deadline: datetime = None,
+        on_error: str = "raise",
+        plan: Iterable[BatchSpec] = None,
+        checkpoint_dir: str = None,
+        sink: ResultSink = None,
+        process_df: Callable[[pd.DataFrame], pd.DataFrame] = None,
+        stream_decode: bool = False,
+        bisect: BisectPolicy = None,
+        density: NodeDensityStats = None,
+        align: bool = True,
+        sort: bool = False,
+        item_fields: Sequence[str] = (),
+    ) -> Union[Any, Tuple[Any, HistoryReadReport]]:
         """Generic method to request historical values from the OPC UA server
-        with batching."""
-        total_time_range_ms = (end_time - start_time).total_seconds() * 1000
-        estimated_intervals = total_time_range_ms / max_data_points
+        with batching.
 
-        max_variables_per_batch = max(
-            1, int(max_data_points / estimated_intervals)
-        )
-        max_time_batches = max(1, int(estimated_intervals / max_data_points))
-        time_batch_size_ms = total_time_range_ms / max_time_batches
+        The batches are generated lazily and run by a pool of
+        max_concurrent_requests workers, so memory use for the requests
+        in flight depends on the concurrency and not on the number of
+        batches.
 
-        extended_variables = prepare_variables(variable_list)
-        variable_batches = [
-            extended_variables[i : i + max_variables_per_batch]
-            for i in range(0, len(extended_variables), max_variables_per_batch)
-        ]
+        timeout and deadline set a budget for the whole call. Every
+        request only gets the budget that is left, and retries that
+        cannot finish in time are not attempted. When a batch fails, the
+        budget runs out or the caller cancels the call, all outstanding
+        batches are cancelled and their connections closed.
+
+        With on_error="collect" a failing batch does not stop the call.
+        The rows of the successful batches are returned together with a
+        HistoryReadReport of the failed ones, and report.plan() can be
+        passed as plan to fetch only those again.
 
-        semaphore = Semaphore(max_concurrent_requests)
+        Values a server returns for both of two adjacent windows, e.g.
+        at the end time it includes, are only kept once, so the result
+        does not depend on how the read was batched.
 
-        async def process_batch(variables, time_batch):
-            async with semaphore:
-                batch_start_ms = time_batch * time_batch_size_ms
-                batch_end_ms = min(
-                    (time_batch + 1) * time_batch_size_ms, total_time_range_ms
+        Args:
+            on_error (str): "raise" to fail on the first failed batch, "collect" to return (DataFrame, HistoryReadReport)
+            plan (Iterable[BatchSpec]): Optional batches to run instead of splitting the time range and variable list, e.g. from HistoryReadReport.plan()
+            checkpoint_dir (str): Optional spool directory for resumable reads. Finished batches are stored there, and batches found there are loaded instead of requested
+            sink (ResultSink): Where the batches are written as they arrive, e.g. a ParquetDatasetSink for results larger than memory. The call returns sink.result(), by default a MemorySink gives one DataFrame
+            process_df (Callable): Optional function applied to the frame of every non-empty batch before it is written to the sink
+            stream_decode (bool): Decode the responses while they are received, so the raw body of a large response is never held in memory. Needs ijson (pip install pyPrediktorMapClient[stream])
+            bisect (BisectPolicy): Split batches that time out, are rejected with 413 or come back truncated instead of retrying them unchanged. Later batches of the plan are split as far right away
+            density (NodeDensityStats): Learned points per second of the nodes. The batches are planned with a DensityPlan, and raw reads update the statistics and save them when they have a path
+            align (bool): Align the time windows to multiples of the ProcessingInterval of aggregated reads, and to calendar units such as whole hours for raw reads, so repeated reads make the same requests
+            sort (bool): Return the DataFrame sorted by node Id, item_fields such as the aggregate, and time, merged from the sorted batches with a SortedMemorySink instead of a full sort. Cannot be combined with sink
+            item_fields (Sequence[str]): Fields of the ReadValueIds copied to the rows of their results as HistoryReadResults.<field> columns, e.g. AggregateName when the nodes are read with different aggregates
+        Raises:
+            TimeoutError: If the call does not finish within the budget
+            RuntimeError: If a batch fails after all retries
+        """
+        if on_error not in ("raise", "collect"):
+            raise ValueError('on_error must be "raise" or "collect"')
+        if sort and sink is not None:
+            raise ValueError("sort cannot be combined with a sink")
+        started = time.perf_counter()
+        expires_at = _expires_at(timeout, deadline)
+        plan = self._make_plan(
+            start_time,
+            end_time,
+            variable_list,
+            prepare_variables,
+            max_data_points,
+            plan,
+            density,
+            self._window_alignment(align, additional_params),
+            start_time,
+        )
+        read_end_time = _read_end_time(plan)
+        # Aggregates and limited reads do not show the density of a node
+        learn_density = density is not None and not (
+            {"ProcessingInterval", "Limit"} & set(additional_params or {})
+        )
+        report = HistoryReadReport(endpoint=endpoint, batches=len(plan))
+        checkpoint = None
+        if checkpoint_dir is not None:
+            checkpoint = Checkpoint(
+                checkpoint_dir,
+                endpoint,
+                additional_params,
+                rest_url=self.rest_url,
+                opcua_url=self.opcua_url,
+            )
+            logger.info(
+                "Checkpoint %s has %s finished batches",
+                checkpoint_dir,
+                len(checkpoint),
+            )
+        bisector = None if bisect is None else Bisector(bisect)
+        batching_duration = time.perf_counter() - started
+        tracing.set_attributes(batches=len(plan))
+
+        def make_body(spec: BatchSpec) -> Dict[str, Any]:
+            return {
+                **self.body,
+                "StartTime": spec.start_time.isoformat() + "Z",
+                "EndTime": spec.end_time.isoformat() + "Z",
+                "ReadValueIds": spec.read_value_ids,
+                **(additional_params or {}),
+            }
+
+        async def process_batch(spec: BatchSpec):
+            if checkpoint is not None and spec in checkpoint:
+                return checkpoint.load(spec)
+            batch_started = time.perf_counter()
+
+            with tracing.span(
+                "OPC_UA.batch",
+                endpoint=endpoint,
+                nodes=len(spec.read_value_ids),
+                start_time=spec.start_time,
+                end_time=spec.end_time,
+            ):
+                part_ends: List[datetime] = []
+                try:
+                    if bisector is None:
+                        body = make_body(spec)
+                        content = await self._make_request(
+                            endpoint,
+                            body,
+                            max_retries,
+                            retry_delay,
+                            expires_at,
+                            stream_decode,
+                        )
+                        await self._retry_transient_nodes(
+                            endpoint,
+                            body,
+                            content,
+                            max_retries,
+                            retry_delay,
+                            expires_at,
+                            stream_decode,
+                        )
+                        _copy_item_fields(
+                            content, body["ReadValueIds"], item_fields
+                        )
+                    else:
+                        content = await self._read_bisected(
+                            endpoint,
+                            spec,
+                            make_body,
+                            bisector,
+                            max_retries,
+                            retry_delay,
+                            expires_at,
+                            stream_decode,
+                            item_fields,
+                            part_ends,
+                        )
+                except Exception as e:
+                    if on_error == "raise":
+                        raise
+                    logger.error(
+                        "Batch %s failed and is added to the report: %s",
+                        spec.index,
+                        e,
+                    )
+                    tracing.set_attributes(error=str(e))
+                    return FailedBatch(
+                        spec=spec,
+                        error=str(e),
+                        exception=e,
+                        attempts=getattr(e, "attempts", 1),
+                    )
+                received = time.perf_counter()
+                if isinstance(content, dict):
+                    report.bad_nodes.extend(
+                        item.get("NodeId")
+                        for item in content.get("HistoryReadResults") or []
+                        if not _is_good_status(item.get("StatusCode"))
+                    )
+                if learn_density:
+                    self._observe_density(density, spec, content)
+                with tracing.span("OPC_UA.decode", endpoint=endpoint):
+                    df = self._drop_duplicates(
+                        self._process_content(content, item_fields),
+                        spec,
+                        read_end_time,
+                        part_ends,
+                    )
+                if checkpoint is not None:
+                    checkpoint.save(spec, df)
+            if self.hooks:
+                finished = time.perf_counter()
+                self.hooks.emit(
+                    RequestEvent(
+                        kind="batch",
+                        endpoint=endpoint,
+                        rows=0 if df is None else len(df),
+                        durations={
+                            "request": received - batch_started,
+                            "dataframe": finished - received,
+                            "total": finished - batch_started,
+                        },
+                    )
                 )
-                batch_start = start_time + timedelta(
-                    milliseconds=batch_start_ms
+            return df
+
+        if sort:
+            # The columns have their final names once process_df is applied
+            sink = (
+                SortedMemorySink()
+                if process_df is not None
+                else SortedMemorySink(
+                    (f"{NODE_ID_PREFIX}Id", "SourceTimestamp"),
+                    [f"{ITEM_PREFIX}{field}" for field in item_fields],
                 )
-                batch_end = start_time + timedelta(milliseconds=batch_end_ms)
+            )
+        elif sink is None:
+            sink = MemorySink()
+        rows = 0
+
+        def collect(spec: BatchSpec, df: Optional[pd.DataFrame]) -> None:
+            nonlocal rows
+            if isinstance(df, FailedBatch):
+                report.failed.append(df)
+            elif df is not None and len(df):
+                if process_df is not None:
+                    df = process_df(df)
+                rows += len(df)
+                sink.write(spec.index, df)
+
+        try:
+            batches = run_batches(
+                plan, process_batch, max_concurrent_requests, collect
+            )
+            if expires_at is None:
+                await batches
+            else:
+                try:
+                    await asyncio.wait_for(
+                        batches, max(0.0, expires_at - time.monotonic())
+                    )
+                except asyncio.TimeoutError as e:
+                    raise TimeoutError(
+                        "Historical read did not finish within its time "
+                        "budget"
+                    ) from e
+        except Exception as e:
+            self._emit_call(
+                endpoint, len(plan), 0, started, batching_duration, e
+            )
+            raise
+
+        # Keep the plan order so the result does not depend on timing
+        report.failed.sort(key=lambda failure: failure.spec.index)
+        if learn_density and density.path is not None:
+            density.save()
+        combined_df = sink.result()
+        self._emit_call(
+            endpoint,
+            len(plan),
+            rows,
+            started,
+            batching_duration,
+            (
+                None
+                if report.ok
+                else RuntimeError(f"{len(report.failed)} batches failed")
+            ),
+        )
+        if on_error == "collect":
+            return combined_df, report
+        return combined_df
 
-                body = {
-                    **self.body,
-                    "StartTime": batch_start.isoformat() + "Z",
-                    "EndTime": batch_end.isoformat() + "Z",
-                    "ReadValueIds": variables,
-                    **(additional_params or {}),
-                }
+    @staticmethod
+    def _make_plan(
+        start_time: datetime,
+        end_time: datetime,
+        variable_list: List[str],
+        prepare_variables: Callable[[List[str]], List[dict]],
+        max_data_points: int,
+        plan: Optional[Iterable[BatchSpec]] = None,
+        density: Optional[NodeDensityStats] = None,
+        align: Union[bool, timedelta] = False,
+        origin: Optional[datetime] = None,
+    ) -> Iterable[BatchSpec]:
+        """The batches of a historical read, the given plan if any.
+
+        align is a step the windows are aligned to from origin, True for
+        calendar aligned windows or False to split the time range
+        evenly.
+        """
+        if plan is None and density is not None:
+            return DensityPlan(
+                start_time,
+                end_time,
+                prepare_variables(variable_list),
+                max_data_points,
+                density,
+            )
+        if plan is None and align is True:
+            return HistoryReadPlan.calendar_aligned(
+                start_time,
+                end_time,
+                prepare_variables(variable_list),
+                max_data_points,
+            )
+        if plan is None:
+            return HistoryReadPlan(
+                start_time,
+                end_time,
+                prepare_variables(variable_list),
+                max_data_points,
+                align=align or None,
+                origin=origin,
+            )
+        if not isinstance(plan, (HistoryReadPlan, DensityPlan)):
+            return list(plan)
+        return plan
 
-                content = await self._make_request(
-                    endpoint, body, max_retries, retry_delay
+    @staticmethod
+    def _window_alignment(
+        align: bool, additional_params: Optional[Dict[str, Any]]
+    ) -> Union[bool, timedelta]:
+        """What _make_plan aligns the windows of a read to."""
+        interval = (additional_params or {}).get("ProcessingInterval")
+        if not align or interval is None:
+            return align
+        return timedelta(milliseconds=interval)
+
+    @staticmethod
+    def _drop_duplicates(
+        df: Optional[pd.DataFrame],
+        spec: BatchSpec,
+        read_end_time: Optional[datetime],
+        part_ends: Sequence[datetime] = (),
+    ) -> Optional[pd.DataFrame]:
+        """Drop the values at the end of a window that the next window starts
+        with, and the repeated values of a node where the parts of a split
+        batch meet.
+
+        Only the rows whose timestamp equals one of these boundaries are
+        looked at, the column is not parsed.
+        """
+        if df is None or "SourceTimestamp" not in df.columns or not len(df):
+            return df
+        drop = np.zeros(len(df), dtype=bool)
+        times = df["SourceTimestamp"]
+        if read_end_time is None or spec.end_time < read_end_time:
+            drop[_timestamp_positions(times, spec.end_time)] = True
+        keys = [
+            column for column in df.columns if column.startswith(ITEM_PREFIX)
+        ]
+        for boundary in set(part_ends) - {spec.end_time}:
+            positions = _timestamp_positions(times, boundary)
+            drop[positions] = df.iloc[positions].duplicated(subset=keys)
+        if not drop.any():
+            return df
+        return df[~drop].reset_index(drop=True)
+
+    def explain_historical_read(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        variable_list: List[str],
+        pro_interval: int = None,
+        agg_name: str = None,
+        max_data_points: int = 10000,
+        plan: Iterable[BatchSpec] = None,
+        density: NodeDensityStats = None,
+        raw_rate: float = None,
+        bytes_per_value: int = BYTES_PER_VALUE,
+        align: bool = True,
+    ) -> HistoryReadExplanation:
+        """The batches a historical read would make and their expected size,
+        without any request to the server.
+
+        Use it to tune max_data_points and max_concurrent_requests
+        before a large read. With pro_interval the read is planned as
+        get_historical_aggregated_values and the number of values is
+        exact, otherwise as get_historical_raw_values and it is estimated
+        from the density statistics or raw_rate.
+
+        Args:
+            start_time (datetime): Start of the read
+            end_time (datetime): End of the read
+            variable_list (list): The variables to read
+            pro_interval (int): The processing interval in milliseconds of an aggregated read
+            agg_name (str): The aggregate of an aggregated read
+            max_data_points (int): The target number of data points per request
+            plan (Iterable[BatchSpec]): Optional batches to explain instead of planning the read
+            density (NodeDensityStats): Learned points per second of the nodes, also used for planning as in get_historical_values
+            raw_rate (float): Points per second of nodes without density statistics in a raw read, by default the median rate of the known nodes or 1
+            bytes_per_value (int): The expected JSON size of a value
+            align (bool): Plan aligned time windows as in get_historical_values
+        Returns:
+            HistoryReadExplanation: The batches with their expected values and bytes
+        """
+        if pro_interval is None:
+            endpoint = "values/historical"
+            prepare_variables = self._raw_read_value_ids
+        else:
+            endpoint = "values/historicalaggregated"
+            prepare_variables = functools.partial(
+                self._aggregated_read_value_ids, agg_name=agg_name
+            )
+        plan = self._make_plan(
+            start_time,
+            end_time,
+            variable_list,
+            prepare_variables,
+            max_data_points,
+            plan,
+            density,
+            self._window_alignment(
+                align,
+                (
+                    None
+                    if pro_interval is None
+                    else {"ProcessingInterval": pro_interval}
+                ),
+            ),
+            start_time,
+        )
+        if raw_rate is None:
+            if density is not None:
+                raw_rate = density.median_rate()
+            raw_rate = raw_rate or 1.0
+
+        batches = []
+        nodes = set()
+        for spec in plan:
+            window = spec.end_time - spec.start_time
+            if pro_interval is None:
+                points = sum(
+                    _rate(density, read_value_id, raw_rate)
+                    * window.total_seconds()
+                    for read_value_id in spec.read_value_ids
+                )
+            else:
+                points = len(spec.read_value_ids) * -(
+                    -int(window.total_seconds() * 1000) // pro_interval
                 )
-                return self._process_content(content)
+            points = int(round(points))
+            nodes.update(
+                node_key(read_value_id.get("NodeId") or {})
+                for read_value_id in spec.read_value_ids
+            )
+            batches.append(
+                BatchEstimate(
+                    index=spec.index,
+                    start_time=spec.start_time,
+                    end_time=spec.end_time,
+                    nodes=len(spec.read_value_ids),
+                    estimated_points=points,
+                    estimated_bytes=points * bytes_per_value
+                    + len(spec.read_value_ids) * BYTES_PER_NODE,
+                )
+            )
+        return HistoryReadExplanation(
+            endpoint=endpoint,
+            requests=len(batches),
+            nodes=len(nodes),
+            estimated_points=sum(b.estimated_points for b in batches),
+            estimated_bytes=sum(b.estimated_bytes for b in batches),
+            batches=batches,
+        )
 
-        tasks = [
-            process_batch(variables, time_batch)
-            for variables in variable_batches
-            for time_batch in range(max_time_batches)
+    @staticmethod
+    def _raw_read_value_ids(variable_list: List[Any]) -> List[dict]:
+        return [{"NodeId": var} for var in variable_list]
+
+    @staticmethod
+    def _aggregated_read_value_ids(
+        variable_list: List[Any], agg_name: str
+    ) -> List[dict]:
+        return [
+            {"NodeId": var, "AggregateName": agg_name} for var in variable_list
         ]
 
-        results = await asyncio.gather(*tasks)
-        results = [df for df in results if df is not None]
+    @staticmethod
+    def _observe_density(
+        density: NodeDensityStats, spec: BatchSpec, content: Dict[str, Any]
+    ) -> None:
+        """Add the number of values per node of a batch to the density
+        statistics, leaving out truncated results."""
+        if not isinstance(content, dict):
+            return
+        points: Dict[str, int] = {}
+        node_ids: Dict[str, Dict[str, Any]] = {}
+        truncated = set()
+        for item in content.get("HistoryReadResults") or []:
+            node_id = item.get("NodeId") or {}
+            key = node_key(node_id)
+            node_ids[key] = node_id
+            if _is_truncated(item, None):
+                truncated.add(key)
+            elif isinstance(item, DecodedItem):
+                points[key] = points.get(key, 0) + item.rows
+            else:
+                points[key] = points.get(key, 0) + len(
+                    item.get("DataValues") or []
+                )
+        seconds = (spec.end_time - spec.start_time).total_seconds()
+        for key, count in points.items():
+            if key not in truncated:
+                density.observe(node_ids[key], count, seconds)
 
-        if not results:
-            return pd.DataFrame()
+    async def _read_bisected(
+        self,
+        endpoint: str,
+        spec: BatchSpec,
+        make_body: Callable[[BatchSpec], Dict[str, Any]],
+        bisector: Bisector,
+        max_retries: int,
+        retry_delay: int,
+        expires_at: Optional[float] = None,
+        stream_decode: bool = False,
+        item_fields: Sequence[str] = (),
+        part_ends: Optional[List[datetime]] = None,
+    ) -> Dict[str, Any]:
+        """Read a batch, splitting it in halves while the server cannot handle
+        it.
+
+        The batch is first split as far as earlier batches of the plan
+        had to be. The parts are read one after the other, so a split
+        batch does not take more than its share of the concurrency.
 
-        combined_df = pd.concat(results, ignore_index=True)
-        return combined_df
+        Args:
+            endpoint (str): The endpoint, e.g. values/historical
+            spec (BatchSpec): The batch
+            make_body (Callable): Makes the request body of a batch
+            bisector (Bisector): Splits the batches of the plan
+            max_retries (int): The number of attempts per request
+            retry_delay (int): Seconds to wait before the first retry
+            expires_at (float): Optional time.monotonic() value the reads must finish by
+            stream_decode (bool): Decode the responses while they are received
+            item_fields (Sequence[str]): Fields of the ReadValueIds to copy to their results
+            part_ends (list): Optional list the end times of the parts that were read are added to
+        Returns:
+            dict: A response with the HistoryReadResults of all parts
+        Raises:
+            RuntimeError: If a part at the minimum size still fails
+        """
+        pending = bisector.presplit(spec)
+        results = []
+        while pending:
+            part = pending.pop(0)
+            body = make_body(part)
+            try:
+                content = await self._make_request(
+                    endpoint,
+                    body,
+                    max_retries,
+                    retry_delay,
+                    expires_at,
+                    stream_decode,
+                    split_oversized=True,
+                )
+                self._check_content(content)
+                await self._retry_transient_nodes(
+                    endpoint,
+                    body,
+                    content,
+                    max_retries,
+                    retry_delay,
+                    expires_at,
+                    stream_decode,
+                )
+                _copy_item_fields(content, body["ReadValueIds"], item_fields)
+                truncated = any(
+                    _is_truncated(item, bisector.policy.point_limit)
+                    for item in content["HistoryReadResults"]
+                )
+                if not truncated:
+                    results.extend(content["HistoryReadResults"])
+                    if part_ends is not None:
+                        part_ends.append(part.end_time)
+                    continue
+                error = _BatchTooLarge("Result truncated by the server")
+            except _BatchTooLarge as e:
+                content = None
+                error = e
+            halves = bisector.split(part, nodes_first=error.nodes_first)
+            if halves is None:
+                if content is None:
+                    raise RuntimeError(
+                        f"Batch is at the minimum size and still fails: "
+                        f"{error}"
+                    ) from error
+                logger.warning(
+                    "Batch %s is at the minimum size and still truncated",
+                    spec.index,
+                )
+                results.extend(content["HistoryReadResults"])
+                if part_ends is not None:
+                    part_ends.append(part.end_time)
+                continue
+            logger.info(
+                "Splitting batch %s (%s nodes, %s to %s): %s",
+                spec.index,
+                len(part.read_value_ids),
+                part.start_time,
+                part.end_time,
+                error,
+            )
+            tracing.set_attributes(splits=bisector.splits)
+            pending[:0] = halves
+        return {"Success": True, "HistoryReadResults": results}
+
+    async def _retry_transient_nodes(
+        self,
+        endpoint: str,
+        body: dict,
+        content: Dict[str, Any],
+        max_retries: int,
+        retry_delay: int,
+        expires_at: Optional[float] = None,
+        stream_decode: bool = False,
+    ) -> None:
+        """Read the nodes of a history response again whose results have a
+        transient bad status, and put the new results in place.
+
+        The nodes of a batch that need another try are merged into one
+        follow-up request per round, so nodes with good results are not
+        read twice. There are up to max_retries - 1 rounds with the same
+        backoff as _make_request. Nodes that still fail keep their last
+        result, and a failing follow-up request ends the retries without
+        failing the batch.
+
+        Args:
+            endpoint (str): The endpoint, e.g. values/historical
+            body (dict): The body of the original request
+            content (dict): The response to the original request, updated in place
+            max_retries (int): The number of attempts per node
+            retry_delay (int): Seconds to wait before the first retry
+            expires_at (float): Optional time.monotonic() value the retries must finish by
+            stream_decode (bool): Decode the follow-up responses while they are received
+        """
+        if not isinstance(content, dict):
+            return
+        results = content.get("HistoryReadResults")
+        read_value_ids = body["ReadValueIds"]
+        # Results are matched to the ReadValueIds by position
+        if not results or len(results) != len(read_value_ids):
+            return
+
+        for retry in range(1, max_retries):
+            pending = [
+                num
+                for num, item in enumerate(results)
+                if _is_transient_status(item.get("StatusCode"))
+            ]
+            if not pending:
+                return
+            wait_time = retry_delay * (2 ** (retry - 1))
+            if (
+                expires_at is not None
+                and time.monotonic() + wait_time >= expires_at
+            ):
+                break
+            logger.warning(
+                "%s nodes returned a transient bad status. Retrying them "
+                "in %s seconds...",
+                len(pending),
+                wait_time,
+            )
+            await asyncio.sleep(wait_time)
+            follow_up = {
+                **body,
+                "ReadValueIds": [read_value_ids[num] for num in pending],
+            }
+            with tracing.span(
+                "OPC_UA.node_retry", endpoint=endpoint, nodes=len(pending)
+            ):
+                try:
+                    retried = await self._make_request(
+                        endpoint,
+                        follow_up,
+                        max_retries,
+                        retry_delay,
+                        expires_at,
+                        stream_decode,
+                    )
+                    self._check_content(retried)
+                except Exception as e:
+                    logger.warning("Retrying nodes failed: %s", e)
+                    break
+            retried_results = retried["HistoryReadResults"]
+            if len(retried_results) != len(pending):
+                break
+            for num, item in zip(pending, retried_results):
+                results[num] = item
+
+        failed = [
+            item.get("NodeId")
+            for item in results
+            if _is_transient_status(item.get("StatusCode"))
+        ]
+        if failed:
+            logger.warning(
+                "%s nodes still have a transient bad status: %s",
+                len(failed),
+                failed,
+            )
 
+    def _emit_call(
+        self,
+        endpoint: str,
+        requests: int,
+        rows: int,
+        started: float,
+        batching_duration: float,
+        error: Exception = None,
+    ) -> None:
+        if not self.hooks:
+            return
+        self.hooks.emit(
+            RequestEvent(
+                kind="call",
+                endpoint=endpoint,
+                requests=requests,
+                rows=rows,
+                durations={
+                    "batching": batching_duration,
+                    "total": time.perf_counter() - started,
+                },
+                error=None if error is None else str(error),
+            )
+        )
+
+    @tracing.traced("OPC_UA.get_historical_raw_values", _trace_attributes)
     async def get_historical_raw_values_asyn(
         self,
         start_time: datetime,
@@ -533,15 +1778,6 @@ class OPC_UA:
                 "NumRecords": limit_num_records,
             }
 
-        combined_df = await self.get_historical_values(
-            start_time,
-            end_time,
-            variable_list,
-            "values/historical",
-            lambda vars: [{"NodeId": var} for var in vars],
-            additional_params,
-            **kwargs,
-        )
         columns = {
             "Value.Type": "ValueType",
             "Value.Body": "Value",
@@ -550,7 +1786,16 @@ class OPC_UA:
             "HistoryReadResults.NodeId.Id": "Id",
             "HistoryReadResults.NodeId.Namespace": "Namespace",
         }
-        return self._process_df(combined_df, columns)
+        return await self.get_historical_values(
+            start_time,
+            end_time,
+            variable_list,
+            "values/historical",
+            self._raw_read_value_ids,
+            additional_params,
+            process_df=functools.partial(self._process_df, columns=columns),
+            **kwargs,
+        )
 
     def get_historical_raw_values(self, *args, **kwargs):
         result = self.helper.run_coroutine(
@@ -558,6 +1803,9 @@ class OPC_UA:
         )
         return result
 
+    @tracing.traced(
+        "OPC_UA.get_historical_aggregated_values", _trace_attributes
+    )
     async def get_historical_aggregated_values_asyn(
         self,
         start_time: datetime,
@@ -565,26 +1813,93 @@ class OPC_UA:
         pro_interval: int,
         agg_name: str,
         variable_list: List[str],
+        cache: AggregateCache = None,
         **kwargs,
     ) -> pd.DataFrame:
-        """Request historical aggregated values from the OPC UA server."""
+        """Request historical aggregated values from the OPC UA server.
+
+        With a cache only the buckets it does not have are requested,
+        and the completed ones are added to it. The buckets are then
+        aligned to multiples of pro_interval from the Unix epoch, so
+        reads with any start time share them, and only the buckets that
+        start within the read are returned. The result is sorted by Id
+        and Timestamp, and plan, sink and on_error cannot be used.
+        """
 
         additional_params = {
             "ProcessingInterval": pro_interval,
             "AggregateName": agg_name,
         }
 
-        combined_df = await self.get_historical_values(
-            start_time,
-            end_time,
-            variable_list,
-            "values/historicalaggregated",
-            lambda vars: [
-                {"NodeId": var, "AggregateName": agg_name} for var in vars
-            ],
-            additional_params,
-            **kwargs,
+        columns = {
+            "Value.Type": "ValueType",
+            "Value.Body": "Value",
+            "StatusCode.Symbol": "StatusSymbol",
+            "StatusCode.Code": "StatusCode",
+            "SourceTimestamp": "Timestamp",
+            "HistoryReadResults.NodeId.IdType": "IdType",
+            "HistoryReadResults.NodeId.Id": "Id",
+            "HistoryReadResults.NodeId.Namespace": "Namespace",
+        }
+        read = functools.partial(
+            self.get_historical_values,
+            endpoint="values/historicalaggregated",
+            prepare_variables=functools.partial(
+                self._aggregated_read_value_ids, agg_name=agg_name
+            ),
+            additional_params=additional_params,
+            process_df=functools.partial(self._process_df, columns=columns),
         )
+        if cache is not None:
+            return await self._read_cached_aggregates(
+                read,
+                start_time,
+                end_time,
+                pro_interval,
+                agg_name,
+                variable_list,
+                cache,
+                **kwargs,
+            )
+        return await read(start_time, end_time, variable_list, **kwargs)
+
+    @tracing.traced(
+        "OPC_UA.get_historical_multi_aggregated_values", _trace_attributes
+    )
+    async def get_historical_multi_aggregated_values_asyn(
+        self,
+        start_time: datetime,
+        end_time: datetime,
+        pro_intervals: Union[int, List[int]],
+        agg_names: List[str],
+        variable_list: List[str],
+        **kwargs,
+    ) -> pd.DataFrame:
+        """Request several aggregates at one or more processing intervals in
+        one call.
+
+        Every node is read once per aggregate in the same requests, as
+        the ReadValueIds carry their own AggregateName. Intervals need
+        their own requests, they are read concurrently. The result is
+        one frame with Aggregate and ProcessingInterval columns.
+
+        Args:
+            start_time (datetime): Start of the read
+            end_time (datetime): End of the read
+            pro_intervals (int | list): The processing intervals in milliseconds
+            agg_names (list): The aggregates, e.g. ["Average", "Minimum", "Maximum"]
+            variable_list (list): The variables to read
+            **kwargs: Options of get_historical_values. plan, sink and on_error="collect" need a single interval
+        Returns:
+            pd.DataFrame: The values of all aggregates and intervals
+        """
+        if isinstance(pro_intervals, int):
+            pro_intervals = [pro_intervals]
+        if not pro_intervals or not agg_names:
+            raise ValueError("Give at least one interval and one aggregate")
+        if len(pro_intervals) > 1:
+            _reject_options(kwargs, "several intervals")
+
         columns = {
             "Value.Type": "ValueType",
             "Value.Body": "Value",
@@ -594,8 +1909,184 @@ class OPC_UA:
             "HistoryReadResults.NodeId.IdType": "IdType",
             "HistoryReadResults.NodeId.Id": "Id",
             "HistoryReadResults.NodeId.Namespace": "Namespace",
+            "HistoryReadResults.AggregateName": "Aggregate",
         }
-        return self._process_df(combined_df, columns)
+
+        def prepare_variables(variables: List[Any]) -> List[dict]:
+            # The aggregates of a node stay next to each other, so they
+            # end up in the same batch
+            return [
+                {"NodeId": var, "AggregateName": agg_name}
+                for var in variables
+                for agg_name in agg_names
+            ]
+
+        results = await asyncio.gather(
+            *(
+                self.get_historical_values(
+                    start_time,
+                    end_time,
+                    variable_list,
+                    "values/historicalaggregated",
+                    prepare_variables,
+                    {"ProcessingInterval": pro_interval},
+                    process_df=functools.partial(
+                        self._process_df, columns=columns
+                    ),
+                    item_fields=("AggregateName",),
+                    **kwargs,
+                )
+                for pro_interval in pro_intervals
+            )
+        )
+        if len(results) == 1:
+            return _with_interval(results[0], pro_intervals[0])
+        frames = [
+            _with_interval(df, pro_interval)
+            for df, pro_interval in zip(results, pro_intervals)
+            if len(df)
+        ]
+        if not frames:
+            return pd.DataFrame()
+        if kwargs.get("sort"):
+            # Merge the sorted frames of the intervals
+            sink = SortedMemorySink()
+            for index, df in enumerate(frames):
+                sink.write(index, df)
+            return sink.result()
+        return pd.concat(frames, ignore_index=True)
+
+    def get_historical_multi_aggregated_values(self, *args, **kwargs):
+        result = self.helper.run_coroutine(
+            self.get_historical_multi_aggregated_values_asyn(*args, **kwargs)
+        )
+        return result
+
+    async def _read_cached_aggregates(
+        self,
+        read: Callable[..., Awaitable[pd.DataFrame]],
+        start_time: datetime,
+        end_time: datetime,
+        pro_interval: int,
+        agg_name: str,
+        variable_list: List[Any],
+        cache: AggregateCache,
+        **kwargs,
+    ) -> pd.DataFrame:
+        """An aggregated read that only requests the buckets missing in the
+        cache.
+
+        The missing buckets of every node are joined into time ranges,
+        nodes missing the same range are read together, and the ranges
+        are read concurrently. Nodes whose results do not have a Good
+        status are not cached, so e.g. a node that timed out is
+        requested again instead of being cached without values.
+        """
+        _reject_options(kwargs, "a cache")
+        kwargs.pop("sort", None)
+        kwargs.pop("on_error", None)
+        interval = timedelta(milliseconds=pro_interval)
+        # The part of a bucket before the first start on the epoch grid
+        # is left out, so reads with other start times share the buckets
+        grid_start = first_bucket(start_time, interval)
+        completed = completed_buckets(grid_start, end_time, interval)
+        # The open and partial buckets after the completed ones
+        tail_start = completed[-1] + interval if completed else grid_start
+
+        nodes = self._get_variable_list_as_list(variable_list)
+        cached: List[Dict[str, Any]] = []
+        ranges: Dict[Tuple[datetime, datetime], List[Dict[str, Any]]] = {}
+        for node in nodes:
+            found, missing = cache.lookup(
+                node, agg_name, pro_interval, completed
+            )
+            for start in completed:
+                cached.extend(found.get(start, ()))
+            for first, last in _contiguous(missing, interval):
+                end = last + interval
+                if end == tail_start:
+                    end = end_time
+                ranges.setdefault((first, end), []).append(node)
+            if tail_start < end_time and (
+                not missing or missing[-1] + interval != tail_start
+            ):
+                ranges.setdefault((tail_start, end_time), []).append(node)
+
+        results = await asyncio.gather(
+            *(
+                read(first, end, range_nodes, on_error="collect", **kwargs)
+                for (first, end), range_nodes in ranges.items()
+            )
+        )
+        frames = []
+        for ((first, end), range_nodes), (df, report) in zip(
+            ranges.items(), results
+        ):
+            if not report.ok:
+                raise report.failed[0].exception
+            bad = {node_key(node) for node in report.bad_nodes if node}
+            self._cache_buckets(
+                cache,
+                df,
+                [node for node in range_nodes if node_key(node) not in bad],
+                agg_name,
+                pro_interval,
+                [start for start in completed if first <= start < end],
+                grid_start,
+            )
+            frames.append(df)
+
+        sink = SortedMemorySink()
+        if cached:
+            sink.write(0, pd.DataFrame(cached))
+        for index, df in enumerate(frames, start=1):
+            if len(df):
+                sink.write(index, df)
+        return sink.result()
+
+    @staticmethod
+    def _cache_buckets(
+        cache: AggregateCache,
+        df: pd.DataFrame,
+        nodes: List[Dict[str, Any]],
+        agg_name: str,
+        pro_interval: int,
+        starts: List[datetime],
+        origin: datetime,
+    ) -> None:
+        """Add the rows of the completed buckets of a read to the cache,
+        buckets without rows included."""
+        if not starts:
+            return
+        rows: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+        if len(df):
+            keys = (
+                df["Namespace"].astype(str)
+                + ";"
+                + df["IdType"].astype(str)
+                + ";"
+                + df["Id"].astype(str)
+            )
+            interval_ns = pro_interval * 1_000_000
+            buckets = (
+                pd.DatetimeIndex(parse_timestamps(df["Timestamp"])).asi8
+                - _utc_timestamp(origin).value
+            ) // interval_ns
+            for key, bucket, row in zip(keys, buckets, df.to_dict("records")):
+                rows.setdefault((key, int(bucket)), []).append(row)
+        for node in nodes:
+            key = node_key(node)
+            for start in starts:
+                bucket = (start - origin) // timedelta(
+                    milliseconds=pro_interval
+                )
+                cache.put(
+                    node,
+                    agg_name,
+                    pro_interval,
+                    start,
+                    tuple(rows.get((key, bucket), ())),
+                )
 
     def get_historical_aggregated_values(self, *args, **kwargs):
         result = self.helper.run_coroutine(
@@ -603,6 +2094,7 @@ class OPC_UA:
         )
         return result
 
+    @tracing.traced("OPC_UA.write_values", _trace_attributes)
     def write_values(self, variable_list: List[WriteVariables]) -> List:
         """Request to write realtime values to the OPC UA server.
 
@@ -621,8 +2113,10 @@ class OPC_UA:
                 method="POST",
                 endpoint="values/set",
                 data=json.dumps([body], default=self.json_serial),
-                headers=self.headers,
+                headers=auth_headers(self.headers, self.auth_client),
                 extended_timeout=True,
+                session=self.session,
+                hooks=self.hooks,
             )
         except HTTPError as e:
             if self.auth_client is not None:
@@ -632,8 +2126,10 @@ class OPC_UA:
                     method="POST",
                     endpoint="values/set",
                     data=json.dumps([body], default=self.json_serial),
-                    headers=self.headers,
+                    headers=auth_headers(self.headers, self.auth_client),
                     extended_timeout=True,
+                    session=self.session,
+                    hooks=self.hooks,
                 )
             else:
                 raise RuntimeError(f"Error in write_values: {str(e)}")
@@ -658,6 +2154,7 @@ class OPC_UA:
 
         return vars
 
+    @tracing.traced("OPC_UA.write_historical_values", _trace_attributes)
     def write_historical_values(
         self, variable_list: List[WriteHistoricalVariables]
     ) -> List:
@@ -695,8 +2192,10 @@ class OPC_UA:
                 method="POST",
                 endpoint="values/historicalwrite",
                 data=json.dumps(body, default=self.json_serial),
-                headers=self.headers,
+                headers=auth_headers(self.headers, self.auth_client),
                 extended_timeout=True,
+                session=self.session,
+                hooks=self.hooks,
             )
         except HTTPError as e:
             if self.auth_client is not None:
@@ -707,8 +2206,10 @@ class OPC_UA:
                     method="POST",
                     endpoint="values/historicalwrite",
                     data=json.dumps(body, default=self.json_serial),
-                    headers=self.headers,
+                    headers=auth_headers(self.headers, self.auth_client),
                     extended_timeout=True,
+                    session=self.session,
+                    hooks=self.hooks,
                 )
             else:
                 raise RuntimeError(
@@ -742,7 +2243,8 @@ class OPC_UA:
         return vars
 
     def check_if_ory_session_token_is_valid_refresh(self):
-        """Check if the session token is still valid."""
+        """Check if the session token is still valid, and get a new one if it
+        is not."""
         if self.auth_client.check_if_token_has_expired():
             self.auth_client.refresh_token()
 
@@ -0,0 +1,430 @@
+"""Recording and replay of HTTP traffic.
+
+RecordingTransport wraps another transport and writes every request and
+response of the clients to a gzip compressed JSON lines archive.
+ReplayTransport serves the archive again without a server, so decode and
+batching performance can be measured offline against real payloads.
+Authorization and cookie headers are never written, and the credentials
+and session tokens in the bodies of Ory self-service requests are
+replaced by a placeholder.
+"""
+
+import base64
+import gzip
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+import requests
+from pydantic import BaseModel, Field
+
+from pyprediktormapclient.transport import (
+    FakeRequest,
+    FakeResponse,
+    FakeTransport,
+    Transport,
+    _AsyncResponse,
+    _AsyncSession,
+)
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Response headers that are not replayed, the body is stored decoded
+_SKIPPED_HEADERS = {
+    "set-cookie",
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+}
+
+REDACTED = "[REDACTED]"
+# Body fields replaced by REDACTED in the exchanges of Ory self-service
+# endpoints, i.e. the login and refresh flows
+_SECRET_FIELDS = {"password", "identifier", "session_token"}
+_SECRET_URL = "self-service/"
+
+
+class Exchange(BaseModel):
+    """A recorded request with its response.
+
+    Variables:
+        method: str - GET or POST
+        url: str - The requested URL without the query
+        params: Optional[Dict[str, Any]] - The query parameters
+        request_body: Optional[str] - The request body
+        status: int - The HTTP status of the response
+        headers: Dict[str, str] - The response headers
+        body: str - The response body, text or base64
+        base64: bool - True if body is base64 encoded bytes
+        elapsed: float - Seconds from sending the request to having read the response
+    """
+
+    method: str
+    url: str
+    params: Optional[Dict[str, Any]] = None
+    request_body: Optional[str] = None
+    status: int
+    headers: Dict[str, str] = Field(default_factory=dict)
+    body: str = ""
+    base64: bool = False
+    elapsed: float = 0.0
+
+    @classmethod
+    def create(
+        cls,
+        method: str,
+        url: str,
+        params: Optional[Dict[str, Any]],
+        data: Any,
+        status: int,
+        headers: Any,
+        content: bytes,
+        elapsed: float,
+    ) -> "Exchange":
+        """Record a request and its response."""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", errors="replace")
+        try:
+            body, encoded = content.decode("utf-8"), False
+        except UnicodeDecodeError:
+            body, encoded = base64.b64encode(content).decode("ascii"), True
+        return cls(
+            method=method,
+            url=str(url).split("?", 1)[0],
+            params=dict(params) if params else None,
+            request_body=data,
+            status=status,
+            headers={
+                key: value
+                for key, value in headers.items()
+                if key.lower() not in _SKIPPED_HEADERS
+            },
+            body=body,
+            base64=encoded,
+            elapsed=elapsed,
+        )
+
+    def content(self) -> bytes:
+        """The response body as bytes."""
+        if self.base64:
+            return base64.b64decode(self.body)
+        return self.body.encode("utf-8")
+
+    def key(self) -> Tuple[str, str, str, Optional[str]]:
+        """The request identity used to match replayed requests."""
+        return _key(self.method, self.url, self.params, self.request_body)
+
+
+def _key(method, url, params, data) -> Tuple[str, str, str, Optional[str]]:
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", errors="replace")
+    return (
+        method,
+        url,
+        json.dumps(params or {}, sort_keys=True, default=str),
+        data,
+    )
+
+
+def _redact_fields(value: Any, fields: set) -> Any:
+    if isinstance(value, dict):
+        return {
+            key: (
+                REDACTED
+                if key in fields and item is not None
+                else _redact_fields(item, fields)
+            )
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_redact_fields(item, fields) for item in value]
+    return value
+
+
+def _redact_body(body: Optional[str], fields: set) -> Optional[str]:
+    """A JSON body with the values of fields replaced, other bodies as they
+    are."""
+    if not body:
+        return body
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(_redact_fields(data, fields))
+
+
+def redact_credentials(exchange: Exchange) -> Exchange:
+    """Replace the password, identifier and session token in the bodies of Ory
+    self-service exchanges."""
+    if _SECRET_URL not in exchange.url:
+        return exchange
+    update: Dict[str, Any] = {
+        "request_body": _redact_body(exchange.request_body, _SECRET_FIELDS)
+    }
+    if not exchange.base64:
+        update["body"] = _redact_body(exchange.body, _SECRET_FIELDS)
+    return exchange.model_copy(update=update)
+
+
+def read_archive(path: str) -> List[Exchange]:
+    """The exchanges of an archive in recorded order.
+
+    An archive whose recording was interrupted is read up to the last
+    complete exchange.
+
+    Args:
+        path (str): The archive
+    Returns:
+        list: The recorded exchanges
+    """
+    exchanges = []
+    with gzip.open(path, "rt", encoding="utf-8") as archive:
+        try:
+            for line in archive:
+                exchanges.append(Exchange.model_validate_json(line))
+        except (EOFError, zlib.error, ValueError):
+            logger.warning(
+                "Archive %s ends early, replaying %s exchanges",
+                path,
+                len(exchanges),
+            )
+    return exchanges
+
+
+class _RecordingSession:
+    """Records the sync calls of a requests-compatible session."""
+
+    def __init__(self, session, recorder: "RecordingTransport"):
+        self._session = session
+        self._recorder = recorder
+
+    def _client(self):
+        return self._session if self._session is not None else requests
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        started = time.perf_counter()
+        result = self._client().get(
+            url, params=params, headers=headers, **kwargs
+        )
+        self._record(result, "GET", url, params, None, started)
+        return result
+
+    def post(self, url, data=None, params=None, headers=None, **kwargs):
+        started = time.perf_counter()
+        result = self._client().post(
+            url, data=data, params=params, headers=headers, **kwargs
+        )
+        self._record(result, "POST", url, params, data, started)
+        return result
+
+    def _record(self, result, method, url, params, data, started) -> None:
+        content = result.content
+        self._recorder.record(
+            Exchange.create(
+                method,
+                url,
+                params,
+                data,
+                result.status_code,
+                result.headers,
+                content,
+                time.perf_counter() - started,
+            )
+        )
+
+
+class _RecordingAsyncSession(_AsyncSession):
+    """Records the async calls of an aiohttp-compatible session."""
+
+    def __init__(self, context, recorder: "RecordingTransport"):
+        super().__init__()
+        self._context = context
+        self._session = None
+        self._recorder = recorder
+
+    async def __aenter__(self) -> "_RecordingAsyncSession":
+        self._session = await self._context.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self._context.__aexit__(exc_type, exc, tb)
+
+    async def _send(
+        self, method, url, data, params, headers
+    ) -> _AsyncResponse:
+        started = time.perf_counter()
+        if method == "GET":
+            request = self._session.get(url, params=params, headers=headers)
+        else:
+            request = self._session.post(
+                url, data=data, params=params, headers=headers
+            )
+        # The body is read in full to record it, streaming decode then
+        # works on the recorded copy
+        async with request as response:
+            content = await response.read()
+            status = response.status
+            response_headers = dict(response.headers)
+        self._recorder.record(
+            Exchange.create(
+                method,
+                url,
+                params,
+                data,
+                status,
+                response_headers,
+                content,
+                time.perf_counter() - started,
+            )
+        )
+        return _AsyncResponse(method, url, status, response_headers, content)
+
+
+class RecordingTransport(Transport):
+    """Sends the requests with another transport and writes every exchange to a
+    gzip compressed archive.
+
+    The archive is flushed after every exchange, so an interrupted
+    recording can still be replayed up to the last complete exchange.
+    Close the transport to finish the archive.
+
+    Every exchange passes redact_credentials() and then redact, which
+    can remove other secrets from the bodies before they are written.
+
+    Args:
+        transport (Transport): The transport that sends the requests
+        path (str): The archive to write, e.g. traffic.jsonl.gz
+        redact (Callable): Optional function that gets every Exchange and returns the one to write
+
+    Examples:
+        >>> with RecordingTransport(AiohttpTransport(), "traffic.jsonl.gz") as transport:
+        ...     opc = OPC_UA(rest_url=url, opcua_url=opcua_url, transport=transport)
+        ...     df = opc.get_historical_raw_values(...)
+    """
+
+    def __init__(
+        self,
+        transport: Transport,
+        path: str,
+        redact: Optional[Callable[[Exchange], Exchange]] = None,
+    ):
+        self.transport = transport
+        self.path = path
+        self.redact = redact
+        self.exchanges = 0
+        self._archive = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> _RecordingSession:
+        return _RecordingSession(self.transport.session, self)
+
+    def async_session(self, timeout: Optional[aiohttp.ClientTimeout] = None):
+        if timeout is None:
+            return _RecordingAsyncSession(self.transport.async_session(), self)
+        return _RecordingAsyncSession(
+            self.transport.async_session(timeout=timeout), self
+        )
+
+    def record(self, exchange: Exchange) -> None:
+        """Append an exchange to the archive."""
+        exchange = redact_credentials(exchange)
+        if self.redact is not None:
+            exchange = self.redact(exchange)
+        line = exchange.model_dump_json() + "\n"
+        with self._lock:
+            if self._archive is None:
+                raise RuntimeError(f"Recording to {self.path} is closed")
+            self._archive.write(line)
+            self._archive.flush()
+            self.exchanges += 1
+
+    def close(self) -> None:
+        """Finish the archive and close the wrapped transport."""
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+        self.transport.close()
+
+
+class ReplayTransport(FakeTransport):
+    """Serves the exchanges of an archive written by RecordingTransport.
+
+    A request gets the response recorded for the same method, URL, query
+    and body. Identical requests get their responses in recorded order,
+    and a request without an exact match, e.g. a login with a new flow
+    id, gets the next unused response for the same method and URL.
+    Requests without any recording get a 404.
+
+    Args:
+        path (str): The archive to replay
+        speed (float): Responses are delayed by their recorded time divided by speed, None to answer right away
+    """
+
+    def __init__(self, path: str, speed: Optional[float] = 1.0):
+        super().__init__(handler=self._replay)
+        self.path = path
+        self.speed = speed
+        self.exchanges = read_archive(path)
+        self._used = [False] * len(self.exchanges)
+        self._exact: Dict[tuple, Deque[int]] = {}
+        self._by_url: Dict[Tuple[str, str], Deque[int]] = {}
+        for num, exchange in enumerate(self.exchanges):
+            self._exact.setdefault(exchange.key(), deque()).append(num)
+            self._by_url.setdefault(
+                (exchange.method, exchange.url), deque()
+            ).append(num)
+
+    @property
+    def unused(self) -> int:
+        """The number of recorded exchanges not replayed yet."""
+        return self._used.count(False)
+
+    def _next(self, queue: Optional[Deque[int]]) -> Optional[int]:
+        while queue:
+            num = queue.popleft()
+            if not self._used[num]:
+                self._used[num] = True
+                return num
+        return None
+
+    def _replay(self, request: FakeRequest) -> FakeResponse:
+        with self._lock:
+            num = self._next(
+                self._exact.get(
+                    _key(
+                        request.method,
+                        request.url,
+                        request.params,
+                        request.data,
+                    )
+                )
+            )
+            if num is None:
+                num = self._next(
+                    self._by_url.get((request.method, request.url))
+                )
+        if num is None:
+            logger.warning(
+                "No recorded response for %s %s", request.method, request.url
+            )
+            return FakeResponse(
+                status=404,
+                body={"error": f"No recorded response for {request.url}"},
+            )
+        exchange = self.exchanges[num]
+        return FakeResponse(
+            status=exchange.status,
+            body=exchange.content(),
+            headers=exchange.headers,
+            latency=(
+                0.0 if self.speed is None else exchange.elapsed / self.speed
+            ),
+        )
@@ -0,0 +1,264 @@
+"""Client-side rollup of aggregated history to coarser intervals.
+
+Reading the same nodes at 15 minutes, one hour and one day makes the
+server aggregate the raw data three times. rollup() derives the coarser
+intervals from one finer aggregated read instead, with NumPy reductions
+over all nodes and buckets at once:
+
+- Average is the time-weighted mean of the finer averages, or the
+  finer Total divided by the time it covers
+- Total is the sum of the finer totals, or the finer averages times
+  their interval in seconds
+- Minimum, Maximum, Count and Sum reduce the same finer aggregate
+
+Finer values with a bad status are left out. A coarse bucket is Good
+when all of its finer buckets are present and Good, Uncertain when some
+are missing, bad or uncertain, and Bad without any usable value.
+"""
+
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from pyprediktormapclient.decoding import parse_timestamps
+
+# The finer aggregates each aggregate can be derived from, preferred first
+SOURCES: Dict[str, Tuple[str, ...]] = {
+    "Average": ("Average", "Total"),
+    "Total": ("Total", "Average"),
+    "Minimum": ("Minimum",),
+    "Maximum": ("Maximum",),
+    "Count": ("Count",),
+    "Sum": ("Sum",),
+}
+
+GOOD = (0, "Good")
+UNCERTAIN = (0x40A40000, "UncertainDataSubNormal")
+BAD = (0x809B0000, "BadNoData")
+
+_NODE_COLUMNS = ("Id", "Namespace", "IdType")
+_MS = 1_000_000
+
+
+def _severity(status: pd.Series) -> np.ndarray:
+    """0 for good, 1 for uncertain and 2 for bad status codes."""
+    codes = pd.to_numeric(status, errors="coerce").fillna(0)
+    return (codes.to_numpy(dtype=np.int64) >> 30) & 3
+
+
+def _reduce(
+    ufunc: np.ufunc,
+    values: np.ndarray,
+    order: np.ndarray,
+    starts: np.ndarray,
+) -> np.ndarray:
+    """ufunc.reduceat over the rows of every group."""
+    return ufunc.reduceat(values[order], starts)
+
+
+def _format(times: np.ndarray, interval: int) -> List[str]:
+    index = pd.DatetimeIndex(times.astype("datetime64[ns]"))
+    if interval % 1000:
+        return list(index.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+    return list(index.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+
+def _rollup_source(
+    df: pd.DataFrame,
+    source: str,
+    targets: List[str],
+    interval: int,
+    source_interval: int,
+    origin_ns: int,
+    by: List[str],
+) -> Optional[pd.DataFrame]:
+    """Roll the rows of one finer aggregate up to the targets, None if they
+    have no valid timestamps."""
+    parsed = pd.DatetimeIndex(parse_timestamps(df["Timestamp"]))
+    # Rows without a valid timestamp belong to no bucket
+    df = df[~parsed.isna()]
+    if not len(df):
+        return None
+    offsets = parsed[~parsed.isna()].asi8 - origin_ns
+    if ((offsets % (interval * _MS)) + source_interval * _MS).max() > (
+        interval * _MS
+    ):
+        raise ValueError(
+            "The finer buckets cross the boundaries of the rollup interval, "
+            "pass the origin of the finer read"
+        )
+    buckets = offsets // (interval * _MS)
+    nodes = df.groupby(by, sort=True, dropna=False).ngroup().to_numpy()
+    node_table = df[by].iloc[np.unique(nodes, return_index=True)[1]]
+    # The (node, bucket) groups sorted by node and time
+    groups, inverse = np.unique(
+        np.stack([nodes, buckets], axis=1), axis=0, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    order = np.argsort(inverse, kind="stable")
+    starts = np.searchsorted(inverse[order], np.arange(len(groups)))
+
+    values = pd.to_numeric(df["Value"], errors="coerce").to_numpy(dtype=float)
+    severity = (
+        _severity(df["StatusCode"])
+        if "StatusCode" in df.columns
+        else np.zeros(len(df), dtype=np.int64)
+    )
+    usable = (severity < 2) & ~np.isnan(values)
+    counts = np.bincount(inverse, weights=usable, minlength=len(groups))
+    uncertain = np.bincount(
+        inverse, weights=usable & (severity == 1), minlength=len(groups)
+    )
+    sums = np.bincount(
+        inverse, weights=np.where(usable, values, 0.0), minlength=len(groups)
+    )
+    seconds = source_interval / 1000
+
+    status = np.where(
+        counts == 0,
+        BAD[0],
+        np.where(
+            (uncertain > 0) | (counts < interval // source_interval),
+            UNCERTAIN[0],
+            GOOD[0],
+        ),
+    )
+    symbols = np.array([GOOD[1], UNCERTAIN[1], BAD[1]], dtype=object)[
+        np.select([status == GOOD[0], status == UNCERTAIN[0]], [0, 1], 2)
+    ]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        results = {}
+        for target in targets:
+            if target == "Minimum":
+                result = _reduce(
+                    np.minimum,
+                    np.where(usable, values, np.inf),
+                    order,
+                    starts,
+                )
+            elif target == "Maximum":
+                result = _reduce(
+                    np.maximum,
+                    np.where(usable, values, -np.inf),
+                    order,
+                    starts,
+                )
+            elif target == "Average" and source == "Total":
+                result = sums / (counts * seconds)
+            elif target == "Average":
+                # Every finer bucket covers source_interval, so the
+                # time-weighted mean is the mean of the usable ones
+                result = sums / counts
+            elif target == "Total" and source == "Average":
+                result = sums * seconds
+            else:
+                result = sums
+            results[target] = np.where(counts > 0, result, np.nan)
+
+    node_frame = node_table.iloc[groups[:, 0]].reset_index(drop=True)
+    timestamps = _format(origin_ns + groups[:, 1] * interval * _MS, interval)
+    frames = []
+    for target, result in results.items():
+        frame = node_frame.copy()
+        frame["Aggregate"] = target
+        frame["ProcessingInterval"] = interval
+        frame["Timestamp"] = timestamps
+        frame["Value"] = result
+        frame["StatusCode"] = status
+        frame["StatusSymbol"] = symbols
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def rollup(
+    df: pd.DataFrame,
+    intervals: Union[int, List[int]],
+    aggregates: Optional[Sequence[str]] = None,
+    source: Optional[str] = None,
+    source_interval: Optional[int] = None,
+    origin: Optional[datetime] = None,
+) -> pd.DataFrame:
+    """Derive coarser aggregates from a finer aggregated read.
+
+    Args:
+        df (pd.DataFrame): The result of get_historical_aggregated_values or get_historical_multi_aggregated_values
+        intervals (int | list): The coarser intervals in milliseconds, multiples of the finer interval
+        aggregates (Sequence[str]): The aggregates to derive, by default all the finer ones allow
+        source (str): The aggregate of the rows of df, needed when it has no Aggregate column
+        source_interval (int): The finer interval in milliseconds, by default the ProcessingInterval column of df
+        origin (datetime): The time the coarse buckets are counted from, naive times are UTC. The Unix epoch by default, which gives calendar aligned buckets
+    Returns:
+        pd.DataFrame: One row per node, aggregate, interval and bucket with Aggregate, ProcessingInterval, Timestamp, Value, StatusCode and StatusSymbol columns
+    Raises:
+        ValueError: If an aggregate cannot be derived or the intervals do not fit
+    """
+    if isinstance(intervals, int):
+        intervals = [intervals]
+    if source_interval is None:
+        if "ProcessingInterval" not in df.columns:
+            raise ValueError("source_interval is needed")
+        found = df["ProcessingInterval"].unique()
+        if len(found) != 1:
+            raise ValueError(
+                "df has several intervals, select one or pass source_interval"
+            )
+        source_interval = int(found[0])
+    for interval in intervals:
+        if interval <= 0 or interval % source_interval:
+            raise ValueError(
+                f"The interval {interval} is not a multiple of the finer "
+                f"interval {source_interval}"
+            )
+    if "Aggregate" in df.columns:
+        parts = dict(tuple(df.groupby("Aggregate", sort=False)))
+    elif source is not None:
+        parts = {source: df}
+    else:
+        raise ValueError("source is needed when df has no Aggregate column")
+
+    if aggregates is None:
+        aggregates = [
+            target
+            for target, sources in SOURCES.items()
+            if any(candidate in parts for candidate in sources)
+        ]
+    plan: Dict[str, List[str]] = {}
+    for target in aggregates:
+        candidates = [s for s in SOURCES.get(target, ()) if s in parts]
+        if not candidates:
+            raise ValueError(
+                f"{target} cannot be derived from {sorted(parts)}"
+            )
+        plan.setdefault(candidates[0], []).append(target)
+
+    if origin is None:
+        origin = datetime(1970, 1, 1)
+    if origin.tzinfo is not None:
+        origin = origin.astimezone(timezone.utc).replace(tzinfo=None)
+    origin_ns = pd.Timestamp(origin).value
+    by = [column for column in _NODE_COLUMNS if column in df.columns]
+    if not by:
+        raise ValueError("df has no Id column")
+
+    frames = [
+        frame
+        for frame in (
+            _rollup_source(
+                parts[part_source],
+                part_source,
+                targets,
+                interval,
+                source_interval,
+                origin_ns,
+                by,
+            )
+            for interval in intervals
+            for part_source, targets in plan.items()
+        )
+        if frame is not None
+    ]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
@@ -1,13 +1,43 @@
+import time
 from typing import Literal
 
 import requests
 from pydantic import AnyUrl, ValidationError
 
+from pyprediktormapclient import tracing
+from pyprediktormapclient.instrumentation import Hooks, RequestEvent
+
 
 class Config:
     arbitrary_types_allowed = True
 
 
+def auth_headers(headers: dict, auth_client: object = None) -> dict:
+    """A copy of the headers with the current bearer token.
+
+    The token of the auth client is read once, so a refresh running in
+    another thread never leaves a request with a half updated header.
+
+    Args:
+        headers (dict): The headers of the client
+        auth_client (AUTH_CLIENT): Optional authentication client
+    Returns:
+        dict: The headers to send
+    """
+    headers = dict(headers)
+    token = getattr(auth_client, "token", None)
+    if token is not None:
+        headers["Authorization"] = f"Bearer {token.session_token}"
+    return headers
+
+
+@tracing.traced(
+    "request_from_api",
+    lambda arguments: {
+        "method": arguments.get("method"),
+        "endpoint": arguments.get("endpoint"),
+    },
+)
 def request_from_api(
     rest_url: AnyUrl,
     method: Literal["GET", "POST"],
@@ -17,6 +47,7 @@ def request_from_api(
     headers: dict = None,
     extended_timeout: bool = False,
     session: requests.Session = None,
+    hooks: Hooks = None,
 ) -> str:
     """Function to perform the request to the ModelIndex server.
 
@@ -26,6 +57,7 @@ def request_from_api(
         endpoint (str): The last part of the url (without the leading slash)
         data (str): defaults to None but can contain the data to send to the endpoint
         headers (str): default to None but can contain the headers og the request
+        hooks (Hooks): Optional observers that get a RequestEvent for the request
     Returns:
         JSON: The result if successfull
     """
@@ -34,6 +66,7 @@ def request_from_api(
 
     # Use session if provided, else use requests
     request_method = session if session else requests
+    started = time.perf_counter()
 
     if method == "GET":
         result = request_method.get(
@@ -55,10 +88,50 @@ def request_from_api(
     if method not in ["GET", "POST"]:
         raise ValidationError("Unsupported method")
 
-    result.raise_for_status()
+    received = time.perf_counter()
+    error = None
+    try:
+        result.raise_for_status()
+        if "application/json" in result.headers.get("Content-Type", ""):
+            return result.json()
+        else:
+            return {"error": "Non-JSON response", "content": result.text}
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        if hooks:
+            _emit_request_event(
+                hooks, result, endpoint, method, data, started, received, error
+            )
 
-    if "application/json" in result.headers.get("Content-Type", ""):
-        return result.json()
 
-    else:
-        return {"error": "Non-JSON response", "content": result.text}
+def _emit_request_event(
+    hooks: Hooks,
+    result: requests.Response,
+    endpoint: str,
+    method: str,
+    data: str,
+    started: float,
+    received: float,
+    error: str,
+) -> None:
+    finished = time.perf_counter()
+    hooks.emit(
+        RequestEvent(
+            kind="request",
+            endpoint=endpoint,
+            method=method,
+            status=result.status_code,
+            bytes_sent=len(
+                data.encode() if isinstance(data, str) else data or b""
+            ),
+            bytes_received=len(result.content),
+            durations={
+                "network": received - started,
+                "decode": finished - received,
+                "total": finished - started,
+            },
+            error=error,
+        )
+    )
@@ -0,0 +1,355 @@
+"""Destinations for the batches of a historical read.
+
+get_historical_values writes every batch to a sink as soon as it is
+decoded and returns sink.result() when all batches are done. The
+default MemorySink concatenates the batches into one DataFrame, and
+SortedMemorySink gives it sorted by node and time. The Parquet and Arrow
+IPC sinks keep the batches on disk so the result can be larger than
+memory, they need pyarrow (``pip install pyPrediktorMapClient[arrow]``).
+"""
+
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from pyprediktormapclient.decoding import parse_timestamps
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - depends on the environment
+    pa = None
+    ds = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _require_pyarrow(sink: str) -> None:
+    if pa is None:
+        raise ImportError(
+            f"{sink} needs pyarrow, install it with "
+            "pip install pyPrediktorMapClient[arrow]"
+        )
+
+
+def _unify_schemas(schemas: List["pa.Schema"]) -> "pa.Schema":
+    """The union of the columns of the schemas, with types promoted where the
+    schemas differ, e.g. int64 and double to double."""
+    try:
+        return pa.unify_schemas(schemas, promote_options="permissive")
+    except TypeError:  # pragma: no cover - pyarrow < 14
+        return pa.unify_schemas(schemas)
+
+
+def _conform(table: "pa.Table", schema: "pa.Schema") -> "pa.Table":
+    """The table with the columns of the schema, nulls for the missing ones.
+
+    Raises:
+        pa.ArrowException: If a column cannot be cast to the schema
+    """
+    columns = [
+        (
+            table.column(field.name).cast(field.type)
+            if field.name in table.column_names
+            else pa.nulls(table.num_rows, field.type)
+        )
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class ResultSink(ABC):
+    """Receives the frames of a historical read batch by batch."""
+
+    @abstractmethod
+    def write(self, index: int, df: pd.DataFrame) -> None:
+        """Store the frame of a batch.
+
+        Args:
+            index (int): Position of the batch in the plan
+            df (pd.DataFrame): The decoded batch
+        """
+        raise NotImplementedError("write method is not implemented")
+
+    @abstractmethod
+    def result(self) -> Any:
+        """The handle returned by the read once all batches are written."""
+        raise NotImplementedError("result method is not implemented")
+
+
+class MemorySink(ResultSink):
+    """Keeps the batches in memory, result() is one DataFrame in plan order."""
+
+    def __init__(self):
+        self._frames: List[Tuple[int, pd.DataFrame]] = []
+
+    def write(self, index: int, df: pd.DataFrame) -> None:
+        self._frames.append((index, df))
+
+    def result(self) -> pd.DataFrame:
+        if not self._frames:
+            return pd.DataFrame()
+        # Keep the plan order so the result does not depend on timing
+        self._frames.sort(key=lambda frame: frame[0])
+        return pd.concat([df for _, df in self._frames], ignore_index=True)
+
+
+class SortedMemorySink(ResultSink):
+    """Keeps the batches in memory, result() is one DataFrame sorted by node
+    and time.
+
+    A batch holds the values of every node as one run in time order, as
+    the server returns them. The runs are sorted by node and first
+    timestamp, which only compares one key per run, and the rows are
+    taken in that order with a single copy. This is a k-way merge of the
+    runs of a node, which do not overlap when the time windows of the
+    plan do not. Runs that overlap or are not in time order themselves
+    fall back to a full stable sort.
+
+    The item columns that all batches have are added to the node
+    columns, so e.g. the aggregates of a node are separate runs and
+    sorted by name instead of interleaved.
+
+    Args:
+        by (Sequence[str]): The node columns followed by the time column
+        item_columns (Sequence[str]): Columns that identify a result of a node when the batches have them
+    """
+
+    def __init__(
+        self,
+        by: Sequence[str] = ("Id", "Timestamp"),
+        item_columns: Sequence[str] = ("Aggregate", "ProcessingInterval"),
+    ):
+        if len(by) < 2:
+            raise ValueError("by needs a node column and a time column")
+        self.node_columns = list(by[:-1])
+        self.time_column = by[-1]
+        self.item_columns = list(item_columns)
+        self._frames: List[Tuple[int, pd.DataFrame]] = []
+
+    def write(self, index: int, df: pd.DataFrame) -> None:
+        self._frames.append((index, df))
+
+    def _runs(
+        self, df: pd.DataFrame, offset: int, key_columns: List[str]
+    ) -> Tuple[List[tuple], bool]:
+        """(node, first time, last time, start, stop) of the node runs, and
+        whether every run is in time order."""
+        changed = np.zeros(len(df), dtype=bool)
+        changed[0] = True
+        for column in key_columns:
+            values = df[column].to_numpy()
+            changed[1:] |= values[1:] != values[:-1]
+        starts = np.flatnonzero(changed)
+        stops = np.append(starts[1:], len(df))
+        times = df[self.time_column]
+        in_order = _ascending(times, changed[1:])
+        first = _nanoseconds(times.iloc[starts])
+        last = _nanoseconds(times.iloc[stops - 1])
+        nodes = zip(*(df[c].to_numpy()[starts] for c in key_columns))
+        runs = [
+            (node, *run)
+            for node, run in zip(
+                nodes,
+                zip(first, last, starts + offset, stops + offset),
+            )
+        ]
+        return runs, in_order
+
+    def result(self) -> pd.DataFrame:
+        if not self._frames:
+            return pd.DataFrame()
+        self._frames.sort(key=lambda frame: frame[0])
+        frames = [df for _, df in self._frames if len(df)]
+        key_columns = self.node_columns + [
+            column
+            for column in self.item_columns
+            if frames and all(column in df.columns for df in frames)
+        ]
+        runs = []
+        in_order = True
+        offset = 0
+        for df in frames:
+            frame_runs, frame_in_order = self._runs(df, offset, key_columns)
+            runs.extend(frame_runs)
+            in_order = in_order and frame_in_order
+            offset += len(df)
+        combined = pd.concat([df for _, df in self._frames], ignore_index=True)
+        if not in_order:
+            logger.debug("A batch is not in time order, sorting all rows")
+            return self._sorted(combined, key_columns)
+        runs.sort(key=lambda run: (run[0], run[1]))
+
+        overlapping = any(
+            previous[0] == run[0] and previous[2] > run[1]
+            for previous, run in zip(runs, runs[1:])
+        )
+        if overlapping:
+            logger.debug("Batches overlap in time, sorting all rows")
+            return self._sorted(combined, key_columns)
+        # Positions of the rows when the runs are laid out in order
+        starts = np.array([run[3] for run in runs], dtype=np.int64)
+        lengths = np.array([run[4] - run[3] for run in runs], dtype=np.int64)
+        order = np.arange(offset) + np.repeat(
+            starts - (np.cumsum(lengths) - lengths), lengths
+        )
+        if np.array_equal(order, np.arange(len(combined))):
+            return combined
+        return combined.take(order).reset_index(drop=True)
+
+    def _sorted(
+        self, df: pd.DataFrame, key_columns: List[str]
+    ) -> pd.DataFrame:
+        order = np.lexsort(
+            [_nanoseconds(df[self.time_column])]
+            + [df[c].to_numpy() for c in reversed(key_columns)]
+        )
+        return df.take(order).reset_index(drop=True)
+
+
+def _nanoseconds(times: pd.Series) -> np.ndarray:
+    """Timestamps as comparable integers, unparsable ones first."""
+    parsed = parse_timestamps(times)
+    return pd.DatetimeIndex(parsed).asi8
+
+
+def _ascending(times: pd.Series, boundaries: np.ndarray) -> bool:
+    """Check that every time is not before the one above it, except at the
+    boundaries.
+
+    Timestamps of the same length that all end in Z are in one ISO 8601
+    format and compare as strings, which is much cheaper than parsing
+    them. Other timestamps are parsed.
+    """
+    values = times.to_numpy()
+    if pd.api.types.infer_dtype(values, skipna=False) == "string":
+        text = values.astype("U")
+        width = text.dtype.itemsize // 4
+        codes = text.view(np.uint32).reshape(len(text), width)
+        if (codes[:, -1] == ord("Z")).all():
+            return bool(np.all((text[1:] >= text[:-1]) | boundaries))
+    parsed = _nanoseconds(times)
+    return bool(np.all((parsed[1:] >= parsed[:-1]) | boundaries))
+
+
+class ParquetDatasetSink(ResultSink):
+    """Writes every batch to its own Parquet file in a directory.
+
+    result() is a lazy pyarrow.dataset.Dataset over the files, read it in
+    pieces with to_batches() or filter it before calling to_table(). The
+    files are named after the plan position, so the dataset is in plan
+    order. Its schema has the columns of all files, with nulls where a
+    file does not have a column. Only the files written by the sink are
+    part of the dataset, not other Parquet files in the directory.
+
+    Args:
+        directory (str): The dataset directory, created if missing
+        compression (str): The Parquet compression codec
+    """
+
+    def __init__(self, directory: str, compression: str = "snappy"):
+        _require_pyarrow("ParquetDatasetSink")
+        self.directory = directory
+        self.compression = compression
+        self._paths: Dict[int, str] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, index: int, df: pd.DataFrame) -> None:
+        path = os.path.join(self.directory, f"part-{index:08d}.parquet")
+        temp_path = f"{path}.tmp"
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, temp_path, compression=self.compression)
+        os.replace(temp_path, path)
+        self._paths[index] = path
+
+    def result(self) -> "ds.Dataset":
+        files = [self._paths[index] for index in sorted(self._paths)]
+        if not files:
+            return ds.dataset([], schema=pa.schema([]), format="parquet")
+        schema = _unify_schemas([pq.read_schema(path) for path in files])
+        return ds.dataset(files, schema=schema, format="parquet")
+
+
+class ArrowIPCSink(ResultSink):
+    """Appends every batch to one Arrow IPC (Feather v2) file.
+
+    The schema is taken from the first batch and later batches are cast
+    to it, with nulls for the columns they do not have. A batch with new
+    columns, or types the schema cannot hold, makes the file be
+    rewritten once with the unified schema. result() memory-maps the
+    file, so the returned pyarrow.Table is not copied into memory. The
+    batches are in the order they were finished, sort the table by Id
+    and Timestamp if the order matters.
+
+    Args:
+        path (str): The file to write
+    """
+
+    def __init__(self, path: str):
+        _require_pyarrow("ArrowIPCSink")
+        self.path = path
+        # A rewrite goes to the other of path and path.tmp
+        self._file = path
+        self._writer = None
+        self._sink = None
+        self._schema = None
+
+    def _open(self, path: str, schema: "pa.Schema") -> None:
+        self._file = path
+        self._schema = schema
+        self._sink = pa.OSFile(path, "wb")
+        self._writer = pa.ipc.new_file(self._sink, schema)
+
+    def _finish(self) -> None:
+        self._writer.close()
+        self._sink.close()
+        self._writer = None
+
+    def _rewrite(self, schema: "pa.Schema") -> None:
+        """Copy the written batches to a new file with the schema."""
+        logger.debug("Rewriting %s with new columns or types", self.path)
+        self._finish()
+        source = self._file
+        self._open(
+            f"{self.path}.tmp" if source == self.path else self.path, schema
+        )
+        with pa.memory_map(source, "r") as mapped:
+            reader = pa.ipc.open_file(mapped)
+            for num in range(reader.num_record_batches):
+                batch = pa.Table.from_batches([reader.get_batch(num)])
+                self._writer.write_table(_conform(batch, schema))
+        os.remove(source)
+
+    def write(self, index: int, df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._schema is None:
+            self._open(self.path, table.schema)
+        elif not set(table.column_names) <= set(self._schema.names):
+            self._rewrite(_unify_schemas([self._schema, table.schema]))
+        try:
+            table = _conform(table, self._schema)
+        except pa.ArrowException:
+            self._rewrite(_unify_schemas([self._schema, table.schema]))
+            table = _conform(table, self._schema)
+        self._writer.write_table(table)
+
+    def close(self) -> None:
+        """Finish the file, called by result()."""
+        if self._writer is not None:
+            self._finish()
+            if self._file != self.path:
+                os.replace(self._file, self.path)
+                self._file = self.path
+
+    def result(self) -> "pa.Table":
+        self.close()
+        if self._schema is None:
+            return pa.table({})
+        return pa.ipc.open_file(pa.memory_map(self.path, "r")).read_all()
@@ -0,0 +1,124 @@
+"""Optional OpenTelemetry tracing.
+
+Spans are created through the opentelemetry-api package when it is
+installed (``pip install pyPrediktorMapClient[tracing]``). Without it
+span() hands out one shared no-op context manager, so tracing costs
+nothing. Configure exporters with the OpenTelemetry SDK as usual, the
+spans are created with the "pyprediktormapclient" tracer.
+"""
+
+import functools
+import inspect
+from contextlib import nullcontext
+from datetime import date, datetime
+from typing import Callable, ContextManager, Dict
+
+try:
+    from opentelemetry import trace
+except ImportError:  # pragma: no cover - depends on the environment
+    trace = None
+
+TRACER_NAME = "pyprediktormapclient"
+TRACING_AVAILABLE = trace is not None
+
+_NO_SPAN = nullcontext()
+
+
+def _attributes(attributes: dict) -> dict:
+    return {
+        key: _attribute(value)
+        for key, value in attributes.items()
+        if value is not None
+    }
+
+
+def _attribute(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    return str(value)
+
+
+def _span(name: str, **attributes) -> ContextManager:
+    """Start a span as the current span, as a child of the active span if there
+    is one.
+
+    Args:
+        name (str): The span name, e.g. OPC_UA.get_values
+        **attributes: Span attributes, None values are left out and datetimes are sent as ISO 8601 strings
+    Returns:
+        ContextManager: The span context manager
+    """
+    return trace.get_tracer(TRACER_NAME).start_as_current_span(
+        name, attributes=_attributes(attributes)
+    )
+
+
+def _set_attributes(**attributes) -> None:
+    """Add attributes to the current span."""
+    trace.get_current_span().set_attributes(_attributes(attributes))
+
+
+def _no_span(name: str, **attributes) -> ContextManager:
+    return _NO_SPAN
+
+
+def _no_attributes(**attributes) -> None:
+    pass
+
+
+if TRACING_AVAILABLE:
+    span, set_attributes = _span, _set_attributes
+else:  # pragma: no cover - depends on the environment
+    span, set_attributes = _no_span, _no_attributes
+
+
+def traced(name: str, attributes: Callable[[Dict], Dict] = None):
+    """Decorator that runs a function or coroutine function in a span.
+
+    Without OpenTelemetry the function is returned as is.
+
+    Args:
+        name (str): The span name
+        attributes (Callable): Optional function that gets the bound arguments of the call as a dict and returns the span attributes
+    """
+
+    def decorator(func):
+        if (
+            not TRACING_AVAILABLE
+        ):  # pragma: no cover - depends on the environment
+            return func
+        signature = inspect.signature(func)
+
+        def call_attributes(args, kwargs) -> Dict:
+            if attributes is None:
+                return {}
+            try:
+                bound = signature.bind(*args, **kwargs)
+            except TypeError:
+                return {}
+            arguments = dict(bound.arguments)
+            arguments.update(arguments.pop("kwargs", {}))
+            try:
+                return attributes(arguments)
+            except Exception:
+                return {}
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **call_attributes(args, kwargs)):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **call_attributes(args, kwargs)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
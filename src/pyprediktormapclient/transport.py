@@ -0,0 +1,533 @@
+"""HTTP access of the clients.
+
+A Transport gives the clients two things: session, an object with the
+get and post methods of requests.Session used by the sync calls, and
+async_session(), an async context manager with the post method of
+aiohttp.ClientSession used by the async calls. OPC_UA, ModelIndex and
+AUTH_CLIENT accept a transport, so the HTTP client can be swapped
+without touching their request and decode logic.
+
+AiohttpTransport is the default: a pooled requests.Session for the sync
+calls and aiohttp for the async ones. RequestsTransport runs the async
+calls with requests in worker threads, HTTPTransport sizes the
+connection pool of the sync calls, and FakeTransport answers in memory
+for tests and load tests.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+import requests
+from aiohttp import ClientSession
+from multidict import CIMultiDict, CIMultiDictProxy
+from pydantic import BaseModel, Field
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from yarl import URL
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class Transport(ABC):
+    """Sync and async HTTP access shared by the clients.
+
+    Variables:
+        session: The object the sync calls use, with the get and post methods of requests.Session. None uses the module level functions of requests
+    """
+
+    session: Any = None
+
+    @abstractmethod
+    def async_session(self, timeout: Optional[aiohttp.ClientTimeout] = None):
+        """An async context manager with the post method of
+        aiohttp.ClientSession.
+
+        Args:
+            timeout (aiohttp.ClientTimeout): Optional timeout of the requests
+        """
+        raise NotImplementedError("async_session method is not implemented")
+
+    def close(self) -> None:
+        """Release the connections of the transport."""
+
+    def __enter__(self) -> "Transport":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class _AsyncResponse:
+    """A received response with the interface of aiohttp.ClientResponse."""
+
+    def __init__(
+        self,
+        method: str,
+        url: str,
+        status: int,
+        headers: Dict[str, str],
+        body: bytes,
+    ):
+        self.method = method
+        self.url = URL(url)
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.content = _BytesStream(body)
+        self._body = body
+
+    async def __aenter__(self) -> "_AsyncResponse":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = "utf-8") -> str:
+        return self._body.decode(encoding)
+
+    async def json(self, **kwargs) -> Any:
+        return json.loads(self._body) if self._body else None
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(
+                request_info=aiohttp.RequestInfo(
+                    url=self.url,
+                    method=self.method,
+                    headers=CIMultiDictProxy(CIMultiDict()),
+                    real_url=self.url,
+                ),
+                history=(),
+                status=self.status,
+                message=f"HTTP {self.status}",
+                headers=self.headers,
+            )
+
+
+class _BytesStream:
+    """A received body with the read method of aiohttp.StreamReader."""
+
+    def __init__(self, body: bytes):
+        self._body = body
+        self.total_bytes = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            n = len(self._body) - self.total_bytes
+        chunk = self._body[self.total_bytes : self.total_bytes + n]
+        self.total_bytes += len(chunk)
+        return chunk
+
+
+class _PendingResponse:
+    """The result of a request on an async session, used like the return value
+    of aiohttp.ClientSession.post."""
+
+    def __init__(self, send: Callable[[], Awaitable[_AsyncResponse]]):
+        self._send = send
+
+    def __await__(self):
+        return self._send().__await__()
+
+    async def __aenter__(self) -> _AsyncResponse:
+        return await self._send()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+class _AsyncSession(ABC):
+    """An async session with the get and post methods of
+    aiohttp.ClientSession."""
+
+    def __init__(self, timeout: Optional[aiohttp.ClientTimeout] = None):
+        self.timeout = timeout
+
+    async def __aenter__(self) -> "_AsyncSession":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        return _PendingResponse(
+            functools.partial(
+                self._send, "GET", str(url), None, params, headers
+            )
+        )
+
+    def post(self, url, data=None, params=None, headers=None, **kwargs):
+        return _PendingResponse(
+            functools.partial(
+                self._send, "POST", str(url), data, params, headers
+            )
+        )
+
+    @abstractmethod
+    async def _send(
+        self, method, url, data, params, headers
+    ) -> _AsyncResponse:
+        raise NotImplementedError("_send method is not implemented")
+
+
+class _ThreadedSession(_AsyncSession):
+    def __init__(self, session, timeout: Optional[aiohttp.ClientTimeout]):
+        super().__init__(timeout)
+        self.session = session
+
+    async def _send(
+        self, method, url, data, params, headers
+    ) -> _AsyncResponse:
+        client = self.session if self.session is not None else requests
+        send = client.get if method == "GET" else client.post
+        kwargs = {"params": params, "headers": headers}
+        if method == "POST":
+            kwargs["data"] = data
+        if self.timeout is not None and self.timeout.total is not None:
+            kwargs["timeout"] = self.timeout.total
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(send, url, **kwargs)
+        )
+        return _AsyncResponse(
+            method, url, result.status_code, result.headers, result.content
+        )
+
+
+class RequestsTransport(Transport):
+    """Sends all calls with requests, the async ones in worker threads.
+
+    Args:
+        session (requests.Session): Optional session, by default a new requests.Session whose connections are reused by all calls
+    """
+
+    def __init__(self, session: requests.Session = None):
+        self.session = session if session is not None else requests.Session()
+
+    def async_session(self, timeout: Optional[aiohttp.ClientTimeout] = None):
+        return _ThreadedSession(self.session, timeout)
+
+    def close(self) -> None:
+        """Close the connections of the session."""
+        if self.session is not None:
+            self.session.close()
+
+
+class AiohttpTransport(RequestsTransport):
+    """Sends the async calls with aiohttp and the sync calls with requests, the
+    default of the clients.
+
+    Args:
+        session (requests.Session): Optional session for the sync calls, by default a new requests.Session
+    """
+
+    def async_session(self, timeout: Optional[aiohttp.ClientTimeout] = None):
+        if timeout is None:
+            return ClientSession()
+        return ClientSession(timeout=timeout)
+
+
+class HTTPTransport(AiohttpTransport):
+    """Pooled HTTP connections to share between clients.
+
+    Every client pools the connections of its own sync calls by
+    default. Pass the same transport to AUTH_CLIENT, ModelIndex and
+    OPC_UA to let them share one pool, sized with the arguments below.
+
+    Args:
+        pool_connections (int): The number of hosts to keep a connection pool for
+        pool_maxsize (int): The number of connections kept open per host
+        pool_block (bool): Wait for a free connection when all pool_maxsize connections to a host are busy, which makes pool_maxsize a hard limit per host. Otherwise extra connections are opened and dropped after use
+        keep_alive (bool): Keep connections open between requests, False sends "Connection: close"
+        max_retries (int): Retries of failed connection attempts, done by urllib3
+
+    Examples:
+        >>> transport = HTTPTransport(pool_maxsize=20)
+        >>> auth_client = AUTH_CLIENT(ory_url, username, password, transport=transport)
+        >>> model = ModelIndex(model_url, auth_client=auth_client, transport=transport)
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        pool_block: bool = False,
+        keep_alive: bool = True,
+        max_retries: int = 0,
+    ):
+        super().__init__(requests.Session())
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries,
+            pool_block=pool_block,
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+
+class FakeRequest(BaseModel):
+    """A request received by a FakeTransport.
+
+    Variables:
+        method: str - GET or POST
+        url: str - The requested URL without the query
+        data: Any - The request body
+        params: Optional[Dict[str, Any]] - The query parameters
+        headers: Dict[str, str] - The request headers
+    """
+
+    method: str
+    url: str
+    data: Any = None
+    params: Optional[Dict[str, Any]] = None
+    headers: Dict[str, str] = Field(default_factory=dict)
+
+    def json_body(self) -> Any:
+        """The decoded JSON body."""
+        return json.loads(self.data) if self.data else None
+
+
+class FakeResponse(BaseModel):
+    """A response served by a FakeTransport.
+
+    Variables:
+        status: int - The HTTP status
+        body: Any - The body, dicts and lists are sent as JSON
+        headers: Dict[str, str] - The response headers
+        latency: Optional[float] - Seconds to wait before answering, overrides the latency of the transport
+    """
+
+    status: int = 200
+    body: Any = None
+    headers: Dict[str, str] = Field(
+        default_factory=lambda: {"Content-Type": "application/json"}
+    )
+    latency: Optional[float] = None
+
+    def content(self) -> bytes:
+        """The body as bytes."""
+        if isinstance(self.body, bytes):
+            return self.body
+        if isinstance(self.body, str):
+            return self.body.encode()
+        return json.dumps(self.body).encode()
+
+
+class _FakeSession(_AsyncSession):
+    def __init__(
+        self,
+        transport: "FakeTransport",
+        timeout: Optional[aiohttp.ClientTimeout],
+    ):
+        super().__init__(timeout)
+        self.transport = transport
+
+    async def _send(
+        self, method, url, data, params, headers
+    ) -> _AsyncResponse:
+        response, delay = self.transport._respond(
+            method, url, data, params, headers
+        )
+        limit = None if self.timeout is None else self.timeout.total
+        if limit is not None and delay > limit:
+            await asyncio.sleep(limit)
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(delay)
+        return _AsyncResponse(
+            method, url, response.status, response.headers, response.content()
+        )
+
+
+class FakeTransport(Transport):
+    """Answers requests in memory, with simulated latency.
+
+    Responses are looked up in responses by the end of the URL, e.g.
+    "values/historical", or made by handler for every request, which
+    takes precedence. Unknown URLs get a 404. Every request is recorded
+    in calls.
+
+    Args:
+        responses (dict): Canned responses by URL suffix, FakeResponse or a body
+        handler (Callable): Optional function making the response of a FakeRequest, a FakeResponse or a body
+        latency (float): Seconds every response is delayed
+        jitter (float): Up to this many seconds are added to the latency at random
+        seed (int): Seed of the jitter, for repeatable runs
+
+    Examples:
+        >>> transport = FakeTransport(handler=synthetic_history, latency=0.05)
+        >>> opc = OPC_UA(rest_url=url, opcua_url=opcua_url, transport=transport)
+    """
+
+    def __init__(
+        self,
+        responses: Optional[Dict[str, Any]] = None,
+        handler: Optional[Callable[[FakeRequest], Any]] = None,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.responses = dict(responses or {})
+        self.handler = handler
+        self.latency = latency
+        self.jitter = jitter
+        self.calls: List[FakeRequest] = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> "FakeTransport":
+        return self
+
+    def async_session(self, timeout: Optional[aiohttp.ClientTimeout] = None):
+        return _FakeSession(self, timeout)
+
+    def get(self, url, params=None, headers=None, timeout=None, **kwargs):
+        return self._send_sync("GET", url, None, params, headers)
+
+    def post(
+        self, url, data=None, params=None, headers=None, timeout=None, **kwargs
+    ):
+        return self._send_sync("POST", url, data, params, headers)
+
+    def _send_sync(self, method, url, data, params, headers):
+        response, delay = self._respond(method, url, data, params, headers)
+        time.sleep(delay)
+        result = requests.Response()
+        result.status_code = response.status
+        result.headers = CaseInsensitiveDict(response.headers)
+        result._content = response.content()
+        result.url = str(url)
+        result.encoding = "utf-8"
+        return result
+
+    def _respond(self, method, url, data, params, headers):
+        request = FakeRequest(
+            method=method,
+            url=str(url).split("?", 1)[0],
+            data=data,
+            params=params,
+            headers=dict(headers or {}),
+        )
+        with self._lock:
+            self.calls.append(request)
+            jitter = self._random.uniform(0, self.jitter) if self.jitter else 0
+        if self.handler is not None:
+            response = self.handler(request)
+        else:
+            response = self._canned(request.url)
+        if not isinstance(response, FakeResponse):
+            response = FakeResponse(body=response)
+        delay = (
+            response.latency if response.latency is not None else self.latency
+        )
+        return response, delay + jitter
+
+    def _canned(self, url: str) -> Any:
+        # The longest matching suffix wins, e.g. "values/historicalaggregated"
+        # over "historicalaggregated"
+        for suffix in sorted(self.responses, key=len, reverse=True):
+            if url.endswith(suffix):
+                return self.responses[suffix]
+        return FakeResponse(
+            status=404, body={"error": f"No response for {url}"}
+        )
+
+
+GOOD_STATUS = {"Code": 0, "Symbol": "Good"}
+
+
+def _parse_time(value: str) -> datetime:
+    """Parse the timestamps the clients send, e.g. 2023-01-01T00:00:00Z or
+    2023-01-01T00:00:00+00:00Z, to naive UTC."""
+    parsed = datetime.fromisoformat(value.rstrip("Z"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _counter_value(num: int) -> Dict[str, Any]:
+    return {"Type": 11, "Body": float(num)}
+
+
+def history_body(
+    body: Dict[str, Any],
+    interval: timedelta,
+    value: Callable[[int], Dict[str, Any]] = _counter_value,
+    status: Optional[Dict[str, Any]] = GOOD_STATUS,
+    max_points: Optional[int] = None,
+) -> Dict[str, Any]:
+    """A history response with one value per interval for every node of a
+    request body.
+
+    Args:
+        body (dict): The body of a request to values/historical or values/historicalaggregated
+        interval (timedelta): The time between the generated values
+        value (Callable): Gives the Value of the num-th value of a node, by default num as a double
+        status (dict): The StatusCode of the values, None to leave it out
+        max_points (int): Optional number of values per node to truncate to, as servers with a point limit do
+    Returns:
+        dict: The response body
+    """
+    start_time = _parse_time(body["StartTime"])
+    end_time = _parse_time(body["EndTime"])
+    count = max(0, (end_time - start_time) // interval)
+    if max_points is not None:
+        count = min(count, max_points)
+    timestamps = [
+        (start_time + num * interval).isoformat() + "Z" for num in range(count)
+    ]
+    results = []
+    for read_value_id in body.get("ReadValueIds", []):
+        data_values = []
+        for num, timestamp in enumerate(timestamps):
+            data_value = {"Value": value(num), "SourceTimestamp": timestamp}
+            if status is not None:
+                data_value["StatusCode"] = dict(status)
+            data_values.append(data_value)
+        results.append(
+            {
+                "NodeId": read_value_id["NodeId"],
+                "StatusCode": dict(GOOD_STATUS),
+                "DataValues": data_values,
+            }
+        )
+    return {
+        "Success": True,
+        "ErrorMessage": "",
+        "ErrorCode": 0,
+        "ServerNamespaces": [],
+        "HistoryReadResults": results,
+    }
+
+
+def synthetic_history(
+    request: FakeRequest, interval: timedelta = timedelta(seconds=1)
+) -> Dict[str, Any]:
+    """A history response with one value per interval for every node of the
+    request, a handler for FakeTransport.
+
+    Args:
+        request (FakeRequest): A request to values/historical or values/historicalaggregated
+        interval (timedelta): The time between the generated values
+    Returns:
+        dict: The response body, see history_body
+    """
+    return history_body(request.json_body(), interval)
@@ -1,3 +1,7 @@
+import os
+import stat
+import threading
+import time
 import unittest
 from copy import deepcopy
 from datetime import datetime, timedelta, timezone
@@ -7,7 +11,8 @@ import pytest
 import requests
 from pydantic import AnyUrl, BaseModel, ValidationError
 
-from pyprediktormapclient.auth_client import AUTH_CLIENT, Token
+from pyprediktormapclient.auth_client import AUTH_CLIENT, Token, TokenCache
+from pyprediktormapclient.shared import auth_headers
 
 URL = "http://someserver.somedomain.com/v1/"
 username = "some@user.com"
@@ -385,13 +390,16 @@ class TestCaseAuthClient:
         with pytest.raises(ValidationError):
             AnyUrlModel(rest_url="invalid-url")
 
-    @patch("requests.get", side_effect=successful_self_service_mocked_requests)
+    @patch(
+        "requests.Session.get",
+        side_effect=successful_self_service_mocked_requests,
+    )
     def test_get_self_service_login_id_successful(self, mock_get, auth_client):
         auth_client.get_login_id()
         assert auth_client.id == auth_id
 
     @patch(
-        "requests.get",
+        "requests.Session.get",
         side_effect=unsuccessful_self_service_login_mocked_requests,
     )
     def test_get_self_service_login_id_unsuccessful(
@@ -400,12 +408,17 @@ class TestCaseAuthClient:
         with pytest.raises(RuntimeError):
             auth_client.get_login_id()
 
-    @patch("requests.get", side_effect=empty_self_service_mocked_requests)
+    @patch(
+        "requests.Session.get", side_effect=empty_self_service_mocked_requests
+    )
     def test_get_self_service_login_id_empty(self, mock_get, auth_client):
         with pytest.raises(RuntimeError):
             auth_client.get_login_id()
 
-    @patch("requests.get", side_effect=wrong_id_self_service_mocked_requests)
+    @patch(
+        "requests.Session.get",
+        side_effect=wrong_id_self_service_mocked_requests,
+    )
     def test_get_self_service_login_id_wrong_id(self, mock_get, auth_client):
         with pytest.raises(RuntimeError):
             auth_client.get_login_id()
@@ -419,7 +432,7 @@ class TestCaseAuthClient:
         assert str(context.value) == "Invalid request"
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=empty_self_service_login_token_mocked_requests,
     )
     def test_get_self_service_login_token_empty(self, mock_get, auth_client):
@@ -428,7 +441,7 @@ class TestCaseAuthClient:
             auth_client.get_login_token()
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=successful_self_service_login_token_mocked_requests,
     )
     def test_get_self_service_login_token_successful(
@@ -444,7 +457,7 @@ class TestCaseAuthClient:
         assert auth_client.token.expires_at == test_token.expires_at
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=unsuccessful_self_service_login_token_mocked_requests,
     )
     def test_get_self_service_login_token_unsuccessful(
@@ -542,5 +555,239 @@ class TestCaseAuthClient:
         assert auth_client.token.expires_at == invalid_datetime
 
 
+def in_seconds(seconds):
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+class TestCaseTokenRefresh:
+    def test_expired_within_margin(self, auth_client):
+        auth_client.token = Token(
+            session_token=auth_session_id, expires_at=in_seconds(30)
+        )
+
+        assert not auth_client.check_if_token_has_expired()
+        assert auth_client.check_if_token_has_expired(margin=60)
+
+    def test_concurrent_refreshes_collapse_into_one_login(self, auth_client):
+        logins = []
+
+        def slow_login():
+            time.sleep(0.1)
+            logins.append(1)
+            auth_client.token = Token(
+                session_token=f"token{len(logins)}",
+                expires_at=in_seconds(3600),
+            )
+
+        with patch.object(auth_client, "get_login_id"), patch.object(
+            auth_client, "get_login_token", side_effect=slow_login
+        ):
+            threads = [
+                threading.Thread(target=auth_client.request_new_ory_token)
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert len(logins) == 1
+        assert auth_client.token.session_token == "token1"
+
+    def test_refresh_after_another_refresh_finished(self, auth_client):
+        expired = Token(session_token="old", expires_at=in_seconds(-10))
+        auth_client.token = expired
+
+        def login():
+            auth_client.token = Token(
+                session_token="new", expires_at=in_seconds(3600)
+            )
+
+        with patch.object(auth_client, "get_login_id"), patch.object(
+            auth_client, "get_login_token", side_effect=login
+        ) as mock_get_login_token:
+            auth_client.request_new_ory_token(expired)
+            # A caller that saw the expired token before the refresh
+            auth_client.request_new_ory_token(expired)
+            auth_client.refresh_token()
+
+        assert mock_get_login_token.call_count == 1
+        assert auth_client.token.session_token == "new"
+
+    def test_failed_login_is_not_shared(self, auth_client):
+        with patch.object(auth_client, "get_login_id"), patch.object(
+            auth_client,
+            "get_login_token",
+            side_effect=[RuntimeError("failed"), None],
+        ) as mock_get_login_token:
+            with pytest.raises(RuntimeError):
+                auth_client.request_new_ory_token()
+            auth_client.request_new_ory_token()
+
+        assert mock_get_login_token.call_count == 2
+
+    def test_refresh_token_only_when_expiring(self, auth_client):
+        auth_client.token = Token(
+            session_token=auth_session_id, expires_at=in_seconds(3600)
+        )
+        with patch.object(auth_client, "request_new_ory_token") as mock_new:
+            auth_client.refresh_token()
+            mock_new.assert_not_called()
+
+            auth_client.token = Token(
+                session_token=auth_session_id, expires_at=in_seconds(30)
+            )
+            auth_client.refresh_token()
+            mock_new.assert_called_once()
+
+    def test_auto_refresh_before_expiry(self, auth_client):
+        auth_client.refresh_margin = 60
+        refreshed = threading.Event()
+
+        def login():
+            auth_client.token = Token(
+                session_token="new", expires_at=in_seconds(3600)
+            )
+            refreshed.set()
+
+        auth_client.token = Token(
+            session_token="old", expires_at=in_seconds(60.1)
+        )
+        with patch.object(auth_client, "get_login_id"), patch.object(
+            auth_client, "get_login_token", side_effect=login
+        ):
+            auth_client.start_auto_refresh()
+            try:
+                assert refreshed.wait(5)
+                # The next refresh is scheduled for the new token
+                assert auth_client._refresh_timer.interval > 3000
+            finally:
+                auth_client.stop_auto_refresh()
+
+        assert auth_client.token.session_token == "new"
+        assert auth_client._refresh_timer is None
+
+    def test_auto_refresh_retries_failed_login(self, auth_client):
+        auth_client.AUTO_REFRESH_RETRY_DELAY = 0.01
+        logged_in = threading.Event()
+        attempts = []
+
+        def login():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("Ory is down")
+            auth_client.token = Token(
+                session_token="new", expires_at=in_seconds(3600)
+            )
+            logged_in.set()
+
+        with patch.object(auth_client, "get_login_id"), patch.object(
+            auth_client, "get_login_token", side_effect=login
+        ):
+            auth_client.start_auto_refresh()
+            try:
+                assert logged_in.wait(5)
+            finally:
+                auth_client.stop_auto_refresh()
+
+    def test_auth_headers(self):
+        auth_client = Mock()
+        auth_client.token = Token(session_token="abc")
+        headers = {"Content-Type": "application/json"}
+
+        assert auth_headers(headers, auth_client) == {
+            "Content-Type": "application/json",
+            "Authorization": "Bearer abc",
+        }
+        assert auth_headers(headers) == headers
+        assert "Authorization" not in headers
+
+
+class TestCaseTokenCache:
+    def client(self, cache, user=username):
+        client = AUTH_CLIENT(
+            rest_url=URL, username=user, password=password, token_cache=cache
+        )
+        client.logins = 0
+
+        def login():
+            time.sleep(0.05)
+            client.logins += 1
+            client.token = Token(
+                session_token=f"{user}-{client.logins}-{id(client)}",
+                expires_at=in_seconds(3600),
+            )
+
+        client._login = login
+        return client
+
+    def test_store_and_load(self, tmp_path):
+        cache = TokenCache(str(tmp_path))
+        token = Token(session_token="abc", expires_at=in_seconds(3600))
+
+        cache.store("key", token)
+
+        loaded = cache.load("key")
+        assert loaded.session_token == "abc"
+        assert abs(loaded.expires_at - token.expires_at) < timedelta(seconds=1)
+        assert cache.load("other") is None
+        mode = os.stat(tmp_path / "key.json").st_mode
+        assert stat.S_IMODE(mode) == 0o600
+
+    def test_unreadable_entry_is_ignored(self, tmp_path):
+        cache = TokenCache(str(tmp_path))
+        (tmp_path / "key.json").write_text("not json")
+
+        assert cache.load("key") is None
+
+    def test_key_depends_on_url_and_username(self):
+        assert TokenCache.key(URL, "a") != TokenCache.key(URL, "b")
+        assert TokenCache.key(URL, "a") != TokenCache.key(URL + "x/", "a")
+
+    def test_token_is_reused_by_other_clients(self, tmp_path):
+        cache = TokenCache(str(tmp_path))
+        first = self.client(cache)
+        first.request_new_ory_token()
+
+        second = self.client(cache)
+        second.request_new_ory_token()
+
+        assert second.logins == 0
+        assert second.token.session_token == first.token.session_token
+        other_user = self.client(cache, user="other@user.com")
+        other_user.request_new_ory_token()
+        assert other_user.logins == 1
+
+    def test_rejected_or_expiring_token_is_not_reused(self, tmp_path):
+        cache = TokenCache(str(tmp_path))
+        first = self.client(cache)
+        first.request_new_ory_token()
+
+        # The current token was rejected, the cached one is the same
+        first.request_new_ory_token()
+        assert first.logins == 2
+
+        key = TokenCache.key(URL, username)
+        cache.store(key, Token(session_token="x", expires_at=in_seconds(30)))
+        second = self.client(cache)
+        second.request_new_ory_token()
+        assert second.logins == 1
+
+    def test_concurrent_clients_log_in_once(self, tmp_path):
+        cache = TokenCache(str(tmp_path))
+        clients = [self.client(cache) for _ in range(5)]
+        threads = [
+            threading.Thread(target=client.request_new_ory_token)
+            for client in clients
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sum(client.logins for client in clients) == 1
+        assert len({client.token.session_token for client in clients}) == 1
+
+
 if __name__ == "__main__":
     unittest.main()
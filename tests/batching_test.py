@@ -0,0 +1,286 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from pyprediktormapclient.batching import (
+    BatchSpec,
+    Bisector,
+    BisectPolicy,
+    HistoryReadPlan,
+    calendar_step,
+    run_batches,
+)
+
+START = datetime(2023, 1, 1)
+
+
+def read_value_ids(count):
+    return [
+        {"NodeId": {"Id": f"SOMEID{num}", "Namespace": 1, "IdType": 2}}
+        for num in range(count)
+    ]
+
+
+def specs(count):
+    return [
+        BatchSpec(
+            index=num,
+            read_value_ids=read_value_ids(1),
+            start_time=START,
+            end_time=START + timedelta(hours=1),
+        )
+        for num in range(count)
+    ]
+
+
+class TestCaseHistoryReadPlan:
+    def test_single_batch(self):
+        plan = HistoryReadPlan(
+            START, START + timedelta(days=1), read_value_ids(1), 10000
+        )
+        batches = list(plan)
+
+        assert len(plan) == 1
+        assert len(batches) == 1
+        assert batches[0].start_time == START
+        assert batches[0].end_time == START + timedelta(days=1)
+
+    def test_time_batches_cover_the_range(self):
+        plan = HistoryReadPlan(
+            START, START + timedelta(days=30), read_value_ids(2), 100
+        )
+        batches = list(plan)
+
+        assert len(batches) == len(plan)
+        assert [batch.index for batch in batches] == list(range(len(plan)))
+        first_node = [
+            batch
+            for batch in batches
+            if batch.read_value_ids == batches[0].read_value_ids
+        ]
+        assert first_node[0].start_time == START
+        assert first_node[-1].end_time == START + timedelta(days=30)
+        for previous, batch in zip(first_node, first_node[1:]):
+            assert previous.end_time == batch.start_time
+
+    def test_variable_batches(self):
+        plan = HistoryReadPlan(
+            START, START + timedelta(seconds=1), read_value_ids(25), 10000
+        )
+        batches = list(plan)
+
+        assert len(plan) == len(batches)
+        nodes = [rvi for batch in batches for rvi in batch.read_value_ids]
+        assert nodes == read_value_ids(25)
+
+    def test_plan_is_lazy(self):
+        plan = HistoryReadPlan(
+            START, START + timedelta(days=365), read_value_ids(1000), 1000
+        )
+        iterator = iter(plan)
+
+        assert next(iterator).index == 0
+        assert len(plan) > 100000
+
+    def test_aligned_windows(self):
+        end = START + timedelta(days=30, minutes=7)
+        plan = HistoryReadPlan(
+            START, end, read_value_ids(2), 100, align=timedelta(hours=1)
+        )
+        batches = list(plan)
+
+        assert len(batches) == len(plan)
+        first_node = batches[: len(batches) // 2]
+        assert first_node[0].start_time == START
+        assert first_node[-1].end_time == end
+        for previous, batch in zip(first_node, first_node[1:]):
+            assert previous.end_time == batch.start_time
+            assert batch.start_time.minute == batch.start_time.second == 0
+
+    def test_aligned_to_origin(self):
+        start = START + timedelta(milliseconds=250)
+        plan = HistoryReadPlan(
+            start,
+            start + timedelta(hours=1),
+            read_value_ids(1),
+            1000,
+            align=timedelta(minutes=7),
+            origin=start,
+        )
+
+        assert [b.start_time - start for b in plan] == [
+            timedelta(0),
+            timedelta(minutes=21),
+            timedelta(minutes=42),
+        ]
+
+    def test_calendar_aligned(self):
+        plan = HistoryReadPlan.calendar_aligned(
+            START, START + timedelta(hours=1), read_value_ids(1), 1000
+        )
+
+        assert calendar_step(timedelta(minutes=20)) == timedelta(minutes=15)
+        assert calendar_step(timedelta(milliseconds=10)) == timedelta(
+            seconds=1
+        )
+        assert [(b.start_time.minute, b.end_time.minute) for b in plan] == [
+            (0, 15),
+            (15, 45),
+            (45, 0),
+        ]
+
+
+@pytest.mark.asyncio
+class TestCaseRunBatches:
+    async def test_runs_all_batches(self):
+        async def process(spec):
+            await asyncio.sleep(0)
+            return spec.index * 2
+
+        results = {}
+        processed = await run_batches(
+            specs(20),
+            process,
+            4,
+            lambda spec, r: results.update({spec.index: r}),
+        )
+
+        assert processed == 20
+        assert results == {num: num * 2 for num in range(20)}
+
+    async def test_concurrency_is_bounded(self):
+        running, peak = 0, 0
+
+        async def process(spec):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.001)
+            running -= 1
+
+        await run_batches(specs(50), process, 5, lambda spec, r: None)
+
+        assert peak == 5
+
+    async def test_plan_is_consumed_lazily(self):
+        pulled = 0
+
+        def plan():
+            nonlocal pulled
+            for spec in specs(1000):
+                pulled += 1
+                yield spec
+
+        seen = []
+
+        async def process(spec):
+            await asyncio.sleep(0)
+            return spec.index
+
+        def consume(spec, result):
+            # The producer can only be a bounded distance ahead
+            seen.append(pulled - len(seen))
+
+        await run_batches(plan(), process, 3, consume)
+
+        assert pulled == 1000
+        assert max(seen) <= 3 * 3 + 1
+
+    async def test_error_cancels_outstanding_batches(self):
+        cancelled = 0
+
+        async def process(spec):
+            nonlocal cancelled
+            if spec.index == 0:
+                raise RuntimeError("Max retries reached")
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled += 1
+                raise
+
+        with pytest.raises(RuntimeError, match="Max retries reached"):
+            await asyncio.wait_for(
+                run_batches(specs(10), process, 4, lambda spec, r: None), 1
+            )
+
+        assert cancelled == 3
+
+    async def test_plan_error_is_raised(self):
+        def plan():
+            yield from specs(2)
+            raise ValueError("broken plan")
+
+        async def process(spec):
+            return spec.index
+
+        with pytest.raises(ValueError, match="broken plan"):
+            await asyncio.wait_for(
+                run_batches(plan(), process, 2, lambda spec, r: None), 1
+            )
+
+
+def batch(nodes, hours):
+    return BatchSpec(
+        index=0,
+        read_value_ids=read_value_ids(nodes),
+        start_time=START,
+        end_time=START + timedelta(hours=hours),
+    )
+
+
+class TestCaseBisector:
+    def test_split_halves_the_window(self):
+        bisector = Bisector(BisectPolicy())
+
+        first, second = bisector.split(batch(4, 2))
+
+        assert (
+            first.end_time == second.start_time == START + timedelta(hours=1)
+        )
+        assert first.read_value_ids == second.read_value_ids
+        assert bisector.max_window == timedelta(hours=1)
+        assert bisector.splits == 1
+
+    def test_split_nodes_first(self):
+        bisector = Bisector(BisectPolicy())
+
+        first, second = bisector.split(batch(3, 2), nodes_first=True)
+
+        assert len(first.read_value_ids) == 2
+        assert len(second.read_value_ids) == 1
+        assert first.end_time == START + timedelta(hours=2)
+        assert bisector.max_nodes == 2
+
+    def test_nodes_are_split_at_the_minimum_window(self):
+        bisector = Bisector(BisectPolicy(min_window=timedelta(hours=1)))
+
+        halves = bisector.split(batch(2, 1))
+
+        assert [len(half.read_value_ids) for half in halves] == [1, 1]
+
+    def test_minimum_size(self):
+        bisector = Bisector(
+            BisectPolicy(min_window=timedelta(hours=1), min_nodes=2)
+        )
+
+        assert bisector.split(batch(3, 1)) is None
+        assert bisector.splits == 0
+
+    def test_presplit_uses_earlier_splits(self):
+        bisector = Bisector(BisectPolicy())
+        assert bisector.presplit(batch(4, 3)) == [batch(4, 3)]
+        bisector.split(batch(4, 2))
+        bisector.split(batch(4, 2), nodes_first=True)
+
+        parts = bisector.presplit(batch(4, 3))
+
+        assert len(parts) == 6
+        assert {len(part.read_value_ids) for part in parts} == {2}
+        assert parts[0].start_time == START
+        assert parts[2].end_time == START + timedelta(hours=3)
+        assert all(
+            part.end_time - part.start_time == timedelta(hours=1)
+            for part in parts
+        )
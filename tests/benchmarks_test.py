@@ -0,0 +1,38 @@
+import json
+
+from benchmarks.runner import main
+
+
+class TestCaseBenchmarkRunner:
+    def test_one_iteration_against_the_mock_server(self, tmp_path):
+        output = tmp_path / "results.json"
+
+        report = main(
+            [
+                "--scenarios",
+                "historical_raw,historical_aggregated,get_values",
+                "--nodes",
+                "2",
+                "--hours",
+                "1",
+                "--batch-sizes",
+                "1000",
+                "--concurrency",
+                "1",
+                "--output",
+                str(output),
+            ]
+        )
+
+        assert json.loads(output.read_text()) == report
+        results = report["results"]
+        assert [result["scenario"] for result in results] == [
+            "historical_raw",
+            "historical_aggregated",
+            "get_values",
+        ]
+        for result in results:
+            assert result["error"] is None
+            assert result["rows"] > 0
+            assert result["requests"] > 0
+            assert result["latency_p50_ms"] is not None
@@ -0,0 +1,252 @@
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import pytest
+
+from pyprediktormapclient.cache import (
+    AggregateCache,
+    completed_buckets,
+    first_bucket,
+)
+from pyprediktormapclient.opc_ua import OPC_UA
+from pyprediktormapclient.sinks import ParquetDatasetSink
+from pyprediktormapclient.transport import FakeTransport, synthetic_history
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+END = datetime(2023, 1, 8)
+HOUR = timedelta(hours=1)
+
+
+def node(name):
+    return {"Id": name, "Namespace": 1, "IdType": 2}
+
+
+ROW = {"Id": "A", "Value": 1.0, "Timestamp": "2023-01-01T00:00:00Z"}
+
+
+class TestCaseAggregateCache:
+    def test_lookup(self):
+        cache = AggregateCache()
+        cache.put(node("A"), "Average", 3600000, datetime(2023, 1, 1), (ROW,))
+        cache.put(node("A"), "Average", 3600000, datetime(2023, 1, 1, 1), ())
+
+        found, missing = cache.lookup(
+            node("A"),
+            "Average",
+            3600000,
+            [datetime(2023, 1, 1, hour) for hour in range(3)],
+        )
+
+        assert found == {
+            datetime(2023, 1, 1): (ROW,),
+            datetime(2023, 1, 1, 1): (),
+        }
+        assert missing == [datetime(2023, 1, 1, 2)]
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    def test_key_includes_aggregate_and_interval(self):
+        cache = AggregateCache()
+        cache.put(node("A"), "Average", 3600000, datetime(2023, 1, 1), ())
+
+        for aggregate, interval in [("Minimum", 3600000), ("Average", 60000)]:
+            _, missing = cache.lookup(
+                node("A"), aggregate, interval, [datetime(2023, 1, 1)]
+            )
+            assert missing == [datetime(2023, 1, 1)]
+
+    def test_least_recently_used_buckets_are_evicted(self):
+        cache = AggregateCache()
+        starts = [datetime(2023, 1, 1, hour) for hour in range(3)]
+        for start in starts:
+            cache.put(node("A"), "Average", 3600000, start, (ROW,))
+        cache.max_bytes = cache.bytes - 1
+        cache.lookup(node("A"), "Average", 3600000, starts[:1])
+        cache.put(node("A"), "Average", 3600000, starts[0], (ROW,))
+
+        _, missing = cache.lookup(node("A"), "Average", 3600000, starts)
+
+        assert missing == [starts[1]]
+        assert cache.evictions == 1
+        assert len(cache) == 2
+
+    def test_invalid_budget(self):
+        with pytest.raises(ValueError):
+            AggregateCache(max_bytes=0)
+
+    def test_completed_buckets(self):
+        start = datetime(2023, 1, 1)
+
+        assert completed_buckets(start, start + 2.5 * HOUR, HOUR) == [
+            start,
+            start + HOUR,
+        ]
+        # The bucket from 02:00 is still open at 02:30
+        assert completed_buckets(
+            start, start + 4 * HOUR, HOUR, now=start + 2.5 * HOUR
+        ) == [start, start + HOUR]
+        aware = start.replace(tzinfo=timezone.utc)
+        assert completed_buckets(aware, aware + HOUR, HOUR) == [aware]
+
+    def test_first_bucket(self):
+        start = datetime(2023, 1, 1, 10, 17, 30)
+
+        assert first_bucket(start, HOUR) == datetime(2023, 1, 1, 11)
+        assert first_bucket(datetime(2023, 1, 1, 10), HOUR) == datetime(
+            2023, 1, 1, 10
+        )
+        aware = start.replace(tzinfo=timezone(timedelta(hours=2)))
+        assert first_bucket(aware, HOUR) == datetime(
+            2023, 1, 1, 9, tzinfo=timezone.utc
+        )
+
+
+@pytest.mark.asyncio
+class TestCaseCachedAggregatedRead:
+    def setup_method(self):
+        self.transport = FakeTransport(
+            handler=partial(synthetic_history, interval=HOUR)
+        )
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=self.transport
+        )
+
+    async def read(self, start_time, end_time, cache, **kwargs):
+        return await self.opc.get_historical_aggregated_values_asyn(
+            start_time=start_time,
+            end_time=end_time,
+            pro_interval=3600000,
+            agg_name="Average",
+            variable_list=[node("B"), node("A")],
+            cache=cache,
+            **kwargs,
+        )
+
+    def windows(self):
+        return [
+            (request.json_body()["StartTime"], request.json_body()["EndTime"])
+            for request in self.transport.calls
+        ]
+
+    async def test_overlapping_reads_only_fetch_missing_buckets(self):
+        cache = AggregateCache()
+        day = await self.read(END - timedelta(days=1), END, cache)
+        self.transport.calls.clear()
+
+        week = await self.read(END - timedelta(days=7), END, cache)
+
+        windows = self.windows()
+        assert min(windows)[0] == "2023-01-01T00:00:00Z"
+        assert max(windows)[1] == "2023-01-07T00:00:00Z"
+        assert len(day) == 2 * 24
+        assert len(week) == 2 * 24 * 7
+        assert week["Id"].tolist() == ["A"] * 168 + ["B"] * 168
+        assert week.iloc[144:168].reset_index(drop=True).equals(day[:24])
+        self.transport.calls.clear()
+
+        again = await self.read(END - timedelta(days=7), END, cache)
+
+        assert self.transport.calls == []
+        assert again.equals(week)
+
+    async def test_reads_with_unaligned_start_times_share_buckets(self):
+        now = END + timedelta(minutes=17, seconds=30)
+        cache = AggregateCache()
+        week = await self.read(now - timedelta(days=7), now, cache)
+        self.transport.calls.clear()
+        hits = cache.hits
+
+        later = now + timedelta(seconds=30)
+        day = await self.read(later - timedelta(days=1), later, cache)
+
+        # Only the partial bucket at the end is requested again
+        assert self.windows() == [
+            ("2023-01-08T00:00:00Z", "2023-01-08T00:18:00Z")
+        ]
+        assert cache.hits - hits == 2 * 23
+        # The fake server has no value for the partial bucket
+        assert len(day) == 2 * 23
+        assert day["Timestamp"].tolist()[:2] == [
+            "2023-01-07T01:00:00Z",
+            "2023-01-07T02:00:00Z",
+        ]
+        a_rows = day[day["Id"] == "A"].reset_index(drop=True)
+        week_a = week[week["Id"] == "A"].reset_index(drop=True)
+        assert a_rows.equals(week_a.iloc[-23:].reset_index(drop=True))
+
+    async def test_open_bucket_is_always_fetched(self):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        start = now.replace(minute=0, second=0, microsecond=0) - 3 * HOUR
+        cache = AggregateCache()
+        await self.read(start, start + 5 * HOUR, cache)
+        self.transport.calls.clear()
+
+        await self.read(start, start + 5 * HOUR, cache)
+
+        # The buckets from start + 3 hours have not ended yet
+        (window,) = self.windows()
+        assert window[1] == (start + 5 * HOUR).isoformat() + "Z"
+        assert window[0] >= (start + 3 * HOUR).isoformat() + "Z"
+
+    async def test_empty_buckets_are_cached(self):
+        self.transport = FakeTransport(
+            handler=partial(synthetic_history, interval=timedelta(days=2))
+        )
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=self.transport
+        )
+        cache = AggregateCache()
+        first = await self.read(END - 3 * HOUR, END, cache)
+        self.transport.calls.clear()
+
+        second = await self.read(END - 3 * HOUR, END, cache)
+
+        assert first.empty and second.empty
+        assert self.transport.calls == []
+        assert len(cache) == 6
+
+    async def test_nodes_with_a_bad_status_are_not_cached(self):
+        calls = []
+
+        def handler(request):
+            content = synthetic_history(request, interval=HOUR)
+            calls.append(request)
+            if len(calls) == 1:
+                for item in content["HistoryReadResults"]:
+                    if item["NodeId"]["Id"] == "B":
+                        item["StatusCode"] = {
+                            "Code": 0x800A0000,
+                            "Symbol": "BadTimeout",
+                        }
+                        item["DataValues"] = []
+            return content
+
+        self.transport = FakeTransport(handler=handler)
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=self.transport
+        )
+        cache = AggregateCache()
+        first = await self.read(END - 3 * HOUR, END, cache, max_retries=1)
+        cached = len(cache)
+        self.transport.calls.clear()
+
+        second = await self.read(END - 3 * HOUR, END, cache, max_retries=1)
+
+        assert first["Id"].tolist() == ["A"] * 3
+        assert cached == 3
+        (request,) = self.transport.calls
+        assert [
+            read_value_id["NodeId"]["Id"]
+            for read_value_id in request.json_body()["ReadValueIds"]
+        ] == ["B"]
+        assert second["Id"].tolist() == ["A"] * 3 + ["B"] * 3
+
+    async def test_cache_cannot_be_used_with_a_sink(self, tmp_path):
+        pytest.importorskip("pyarrow")
+        with pytest.raises(ValueError):
+            await self.read(
+                END - HOUR,
+                END,
+                AggregateCache(),
+                sink=ParquetDatasetSink(str(tmp_path)),
+            )
@@ -0,0 +1,157 @@
+import json
+import os
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+from conftest import node_post
+
+from pyprediktormapclient.batching import BatchSpec
+from pyprediktormapclient.checkpoint import Checkpoint
+from pyprediktormapclient.opc_ua import OPC_UA
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+
+def spec(index=0, node="A", hours=1):
+    return BatchSpec(
+        index=index,
+        read_value_ids=[{"NodeId": {"Id": node, "Namespace": 1, "IdType": 2}}],
+        start_time=datetime(2023, 1, 1),
+        end_time=datetime(2023, 1, 1) + timedelta(hours=hours),
+    )
+
+
+def read(opc, variables, directory, **kwargs):
+    return opc.get_historical_raw_values_asyn(
+        start_time=datetime(2023, 1, 1),
+        end_time=datetime(2023, 1, 2),
+        variable_list=[
+            {"Id": name, "Namespace": 1, "IdType": 2} for name in variables
+        ],
+        max_retries=1,
+        retry_delay=0,
+        checkpoint_dir=str(directory),
+        **kwargs,
+    )
+
+
+class TestCaseCheckpoint:
+    def test_save_and_load(self, tmp_path):
+        checkpoint = Checkpoint(str(tmp_path), "values/historical")
+        df = pd.DataFrame({"Value": [1.0, 2.0]})
+
+        checkpoint.save(spec(), df)
+
+        assert spec() in checkpoint
+        assert spec(node="B") not in checkpoint
+        pd.testing.assert_frame_equal(checkpoint.load(spec()), df)
+        assert not [
+            name for name in os.listdir(tmp_path) if name.endswith(".tmp")
+        ]
+
+    def test_empty_batch(self, tmp_path):
+        checkpoint = Checkpoint(str(tmp_path), "values/historical")
+
+        checkpoint.save(spec(), None)
+
+        assert checkpoint.load(spec()) is None
+
+    def test_manifest_is_reloaded(self, tmp_path):
+        Checkpoint(str(tmp_path), "values/historical").save(
+            spec(), pd.DataFrame({"Value": [1.0]})
+        )
+
+        checkpoint = Checkpoint(str(tmp_path), "values/historical")
+
+        assert len(checkpoint) == 1
+        assert spec(index=5) in checkpoint
+
+    def test_identity_includes_window_and_parameters(self, tmp_path):
+        checkpoint = Checkpoint(
+            str(tmp_path), "values/historicalaggregated", {"a": 1}
+        )
+        checkpoint.save(spec(), pd.DataFrame({"Value": [1.0]}))
+
+        other = Checkpoint(
+            str(tmp_path), "values/historicalaggregated", {"a": 2}
+        )
+
+        assert spec(hours=2) not in checkpoint
+        assert spec() not in other
+
+    def test_identity_includes_the_servers(self, tmp_path):
+        checkpoint = Checkpoint(
+            str(tmp_path), "values/historical", rest_url=URL, opcua_url=OPC_URL
+        )
+        checkpoint.save(spec(), pd.DataFrame({"Value": [1.0]}))
+
+        for rest_url, opcua_url in [
+            ("http://other.somedomain.com/v1/", OPC_URL),
+            (URL, "opc.tcp://other.nosuchdomain.com"),
+        ]:
+            other = Checkpoint(
+                str(tmp_path),
+                "values/historical",
+                rest_url=rest_url,
+                opcua_url=opcua_url,
+            )
+            assert spec() not in other
+
+    def test_batches_are_stored_as_parquet(self, tmp_path):
+        pytest.importorskip("pyarrow")
+        checkpoint = Checkpoint(str(tmp_path), "values/historical")
+        mixed = pd.DataFrame({"Value": [1.0, "text"]})
+
+        checkpoint.save(spec(), pd.DataFrame({"Value": [1.0]}))
+        checkpoint.save(spec(node="B"), mixed)
+
+        assert sorted(
+            os.path.splitext(name)[1] for name in checkpoint.completed.values()
+        ) == [".parquet", ".pkl"]
+        pd.testing.assert_frame_equal(checkpoint.load(spec(node="B")), mixed)
+
+    def test_torn_manifest_line_is_ignored(self, tmp_path):
+        checkpoint = Checkpoint(str(tmp_path), "values/historical")
+        checkpoint.save(spec(), pd.DataFrame({"Value": [1.0]}))
+        with open(checkpoint.manifest_path, "a") as manifest:
+            manifest.write('{"key": "abc", "fi')
+
+        assert len(Checkpoint(str(tmp_path), "values/historical")) == 1
+
+
+@pytest.mark.asyncio
+class TestCaseResumableRead:
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_rerun_only_requests_unfinished_batches(
+        self, mock_post, tmp_path
+    ):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+        with pytest.raises(RuntimeError):
+            await read(opc, ["A", "B", "FAILING"], tmp_path)
+        mock_post.reset_mock()
+        mock_post.side_effect = lambda url, data, headers: node_post(
+            url, data.replace("FAILING", "C"), headers
+        )
+
+        result = await read(opc, ["A", "B", "FAILING"], tmp_path)
+
+        requested = [
+            json.loads(c.kwargs["data"])["ReadValueIds"][0]["NodeId"]["Id"]
+            for c in mock_post.call_args_list
+        ]
+        assert "A" not in requested and "B" not in requested
+        assert result["Id"].tolist() == ["A", "B", "C"]
+
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_finished_read_makes_no_requests(self, mock_post, tmp_path):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+        first = await read(opc, ["A", "B"], tmp_path)
+        mock_post.reset_mock()
+
+        second = await read(opc, ["A", "B"], tmp_path)
+
+        mock_post.assert_not_called()
+        pd.testing.assert_frame_equal(first, second)
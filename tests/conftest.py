@@ -1,7 +1,9 @@
+import json
 import random
 import string
 from unittest.mock import AsyncMock, Mock, patch
 
+import aiohttp
 import pytest
 from aiohttp import ClientResponseError
 
@@ -16,6 +18,66 @@ password = "somepassword"
 OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
 
 
+class AsyncMockResponse:
+    """Response of a patched aiohttp.ClientSession.post."""
+
+    def __init__(self, json_data, status_code=200):
+        self.json_data = json_data
+        self.status = status_code
+        self.headers = {"Content-Type": "application/json"}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def read(self):
+        return json.dumps(self.json_data).encode()
+
+    async def json(self):
+        return self.json_data
+
+    async def text(self):
+        return "" if self.json_data is None else json.dumps(self.json_data)
+
+    async def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(
+                request_info=aiohttp.RequestInfo(
+                    url=URL, method="POST", headers={}, real_url=OPC_URL
+                ),
+                history=(),
+                status=self.status,
+                message="Mocked error",
+                headers=self.headers,
+            )
+
+
+def node_post(url, data, headers):
+    """A history response with one value for the first node of the request,
+    HTTP 500 for a node with the Id FAILING."""
+    node = json.loads(data)["ReadValueIds"][0]["NodeId"]
+    if node["Id"] == "FAILING":
+        return AsyncMockResponse(None, 500)
+    return AsyncMockResponse(
+        {
+            "Success": True,
+            "HistoryReadResults": [
+                {
+                    "NodeId": node,
+                    "DataValues": [
+                        {
+                            "Value": {"Type": 11, "Body": 1.0},
+                            "SourceTimestamp": "2023-01-01T00:00:00Z",
+                        }
+                    ],
+                }
+            ],
+        }
+    )
+
+
 def grs():
     """Generate a random string."""
     return "".join(
@@ -0,0 +1,193 @@
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+from pyprediktormapclient.decoding import DecodedItem, history_frame
+from pyprediktormapclient.opc_ua import OPC_UA
+
+ijson = pytest.importorskip("ijson")
+
+from pyprediktormapclient.decoding import decode_history_stream  # noqa: E402
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+CONTENT = {
+    "Success": True,
+    "ErrorMessage": "",
+    "HistoryReadResults": [
+        {
+            "NodeId": {"IdType": 2, "Id": "A", "Namespace": 1},
+            "StatusCode": {"Code": 0, "Symbol": "Good"},
+            "DataValues": [
+                {
+                    "Value": {"Type": 11, "Body": 1.5},
+                    "SourceTimestamp": "2023-01-01T00:00:00Z",
+                },
+                {
+                    "Value": {"Type": 11, "Body": 2.5},
+                    "StatusCode": {"Code": 1073741824, "Symbol": "Uncertain"},
+                    "SourceTimestamp": "2023-01-01T00:01:00Z",
+                },
+            ],
+        },
+        {
+            "NodeId": {"IdType": 2, "Id": "B", "Namespace": 1},
+            "StatusCode": {"Code": 0, "Symbol": "Good"},
+            "DataValues": [
+                {
+                    "Value": {"Type": 11, "Body": 3.0},
+                    "SourceTimestamp": "2023-01-01T00:00:00Z",
+                }
+            ],
+        },
+    ],
+}
+
+
+def normalized(content):
+    frames = []
+    for item in content["HistoryReadResults"]:
+        df = pd.json_normalize(item["DataValues"])
+        for key, value in item["NodeId"].items():
+            df[f"HistoryReadResults.NodeId.{key}"] = value
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+class ChunkedStream:
+    """Hands out the body in small pieces like a network stream."""
+
+    def __init__(self, body: bytes, chunk_size: int = 7):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.reads = 0
+
+    async def read(self, size=-1):
+        self.reads += 1
+        size = self.chunk_size if size < 0 else min(size, self.chunk_size)
+        chunk = self.body[self.position : self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    @property
+    def total_bytes(self):
+        return self.position
+
+
+class StreamingResponse:
+    def __init__(self, content):
+        self.status = 200
+        self.content = ChunkedStream(json.dumps(content).encode())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def json(self):
+        raise AssertionError("The body should not be read at once")
+
+
+class TestCaseHistoryFrame:
+    def test_matches_json_normalize(self):
+        df = history_frame(CONTENT["HistoryReadResults"])
+
+        pd.testing.assert_frame_equal(df, normalized(CONTENT))
+        assert list(df.columns)[:3] == [
+            "SourceTimestamp",
+            "Value.Type",
+            "Value.Body",
+        ]
+
+    def test_columns_missing_in_some_values(self):
+        df = history_frame(CONTENT["HistoryReadResults"])
+
+        assert df["StatusCode.Symbol"].tolist()[1] == "Uncertain"
+        assert df["StatusCode.Symbol"].isna().tolist() == [True, False, True]
+        assert df["HistoryReadResults.NodeId.Id"].tolist() == ["A", "A", "B"]
+
+    def test_items_without_values(self):
+        item = {"NodeId": {"Id": "A"}, "DataValues": []}
+
+        df = history_frame([item])
+
+        assert df.empty
+        assert list(df.columns) == ["HistoryReadResults.NodeId.Id"]
+
+    def test_no_items(self):
+        assert history_frame([]) is None
+
+    def test_item_fields(self):
+        items = [
+            {**item, "AggregateName": name}
+            for item, name in zip(
+                CONTENT["HistoryReadResults"], ["Average", "Maximum"]
+            )
+        ]
+
+        df = history_frame(items, item_fields=["AggregateName"])
+
+        assert df["HistoryReadResults.AggregateName"].tolist() == [
+            "Average",
+            "Average",
+            "Maximum",
+        ]
+
+    def test_decoded_item_keeps_item_fields(self):
+        item = DecodedItem.from_item(CONTENT["HistoryReadResults"][0])
+
+        assert item["StatusCode"]["Symbol"] == "Good"
+        assert "DataValues" not in item
+        assert item.rows == 2
+        assert item.columns["Value.Body"] == [1.5, 2.5]
+
+
+@pytest.mark.asyncio
+class TestCaseStreamDecode:
+    async def test_stream_matches_buffered_decode(self):
+        stream = ChunkedStream(json.dumps(CONTENT).encode())
+
+        content = await decode_history_stream(stream)
+
+        assert stream.reads > 10
+        assert content["Success"] is True
+        assert content["ErrorMessage"] == ""
+        assert [
+            item["NodeId"]["Id"] for item in content["HistoryReadResults"]
+        ] == ["A", "B"]
+        pd.testing.assert_frame_equal(
+            history_frame(content["HistoryReadResults"]),
+            history_frame(CONTENT["HistoryReadResults"]),
+        )
+
+    async def test_numbers_are_floats(self):
+        body = b'{"HistoryReadResults": [{"DataValues": [{"Value": 1.25}]}]}'
+
+        content = await decode_history_stream(ChunkedStream(body))
+
+        value = content["HistoryReadResults"][0].columns["Value"][0]
+        assert isinstance(value, float)
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_historical_read_with_stream_decode(self, mock_post):
+        mock_post.side_effect = lambda *args, **kwargs: StreamingResponse(
+            CONTENT
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        df = await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            variable_list=[{"Id": "A", "Namespace": 1, "IdType": 2}],
+            stream_decode=True,
+        )
+
+        assert df["Id"].tolist() == ["A", "A", "B"]
+        assert df["Value"].tolist() == [1.5, 2.5, 3.0]
+        assert df["ValueType"].tolist() == ["Double"] * 3
@@ -0,0 +1,203 @@
+import json
+from datetime import datetime, timedelta
+from functools import partial
+
+import pytest
+
+from pyprediktormapclient.density import (
+    DensityPlan,
+    NodeDensityStats,
+    node_key,
+)
+from pyprediktormapclient.opc_ua import OPC_UA
+from pyprediktormapclient.transport import FakeTransport, synthetic_history
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+START = datetime(2023, 1, 1)
+
+
+def node(name):
+    return {"Id": name, "Namespace": 1, "IdType": 2}
+
+
+def read_value_ids(names):
+    return [{"NodeId": node(name)} for name in names]
+
+
+class TestCaseNodeDensityStats:
+    def test_rate(self):
+        stats = NodeDensityStats()
+        stats.observe(node("A"), 3600, 3600)
+
+        assert stats.rate(node("A")) == 1.0
+        assert stats.rate(node("B")) is None
+        assert node("A") in stats
+        assert node_key(node("A")) == "1;2;A"
+
+    def test_recent_observations_weigh_more(self):
+        stats = NodeDensityStats(decay=0.5)
+        stats.observe(node("A"), 100, 100)
+        stats.observe(node("A"), 1000, 100)
+
+        assert stats.rate(node("A")) == pytest.approx(1050 / 150)
+
+    def test_empty_window_is_ignored(self):
+        stats = NodeDensityStats()
+        stats.observe(node("A"), 10, 0)
+
+        assert len(stats) == 0
+
+    def test_persistence(self, tmp_path):
+        path = str(tmp_path / "density.json")
+        stats = NodeDensityStats(path)
+        stats.observe(node("A"), 10, 1)
+        stats.save()
+
+        loaded = NodeDensityStats(path)
+
+        assert loaded.rate(node("A")) == 10
+        assert not list(tmp_path.glob("*.tmp"))
+
+    def test_unreadable_file(self, tmp_path):
+        path = tmp_path / "density.json"
+        path.write_text("{broken")
+
+        assert len(NodeDensityStats(str(path))) == 0
+
+    def test_save_without_path(self):
+        with pytest.raises(ValueError):
+            NodeDensityStats().save()
+
+
+class TestCaseDensityPlan:
+    def test_fast_and_slow_nodes_are_grouped_apart(self):
+        stats = NodeDensityStats()
+        stats.observe(node("fast"), 10 * 3600, 3600)
+        for name in ["slow1", "slow2", "slow3"]:
+            stats.observe(node(name), 1, 3600)
+
+        plan = DensityPlan(
+            START,
+            START + timedelta(days=1),
+            read_value_ids(["slow1", "fast", "slow2", "slow3"]),
+            10000,
+            stats,
+        )
+        batches = list(plan)
+
+        # 864000 points of the fast node in 87 windows, one slow batch
+        assert len(plan) == len(batches) == 88
+        fast = [
+            b
+            for b in batches
+            if b.read_value_ids == [{"NodeId": node("fast")}]
+        ]
+        assert len(fast) == 87
+        assert fast[0].start_time == START
+        assert fast[-1].end_time == START + timedelta(days=1)
+        assert all(
+            (b.end_time - b.start_time).total_seconds() * 10 <= 10000
+            for b in fast
+        )
+        assert [len(b.read_value_ids) for b in batches[87:]] == [3]
+        assert [b.index for b in batches] == list(range(88))
+
+    def test_groups_stay_within_max_data_points(self):
+        stats = NodeDensityStats()
+        for num in range(10):
+            stats.observe(node(f"N{num}"), num + 1, 1)
+
+        plan = DensityPlan(
+            START,
+            START + timedelta(seconds=100),
+            read_value_ids([f"N{num}" for num in range(10)]),
+            1000,
+            stats,
+        )
+
+        for group, windows, points in plan.groups:
+            assert points / windows <= 1000
+            rates = [stats.rate(item["NodeId"]) for item in group]
+            assert rates == sorted(rates, reverse=True)
+
+    def test_unknown_nodes_get_the_median_rate(self):
+        stats = NodeDensityStats()
+        stats.observe(node("A"), 1, 1)
+        stats.observe(node("B"), 3, 1)
+
+        plan = DensityPlan(
+            START,
+            START + timedelta(seconds=1000),
+            read_value_ids(["C"]),
+            1000,
+            stats,
+        )
+
+        assert plan.groups[0][2] == 2000
+        assert len(plan) == 2
+
+    def test_max_nodes(self):
+        plan = DensityPlan(
+            START,
+            START + timedelta(seconds=1),
+            read_value_ids([f"N{num}" for num in range(5)]),
+            1000,
+            NodeDensityStats(),
+            max_nodes=2,
+        )
+
+        assert [len(b.read_value_ids) for b in plan] == [2, 2, 1]
+
+
+@pytest.mark.asyncio
+class TestCaseHistoricalReadDensity:
+    async def test_raw_reads_learn_and_use_the_density(self, tmp_path):
+        path = str(tmp_path / "density.json")
+        transport = FakeTransport(
+            handler=partial(synthetic_history, interval=timedelta(seconds=10))
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+
+        await opc.get_historical_raw_values_asyn(
+            start_time=START,
+            end_time=START + timedelta(hours=1),
+            variable_list=[node("A")],
+            density=NodeDensityStats(path),
+        )
+
+        with open(path) as file:
+            assert json.load(file)["nodes"]["1;2;A"] == [360, 3600]
+        stats = NodeDensityStats(path)
+        assert stats.rate(node("A")) == 0.1
+
+        transport.calls.clear()
+        df = await opc.get_historical_raw_values_asyn(
+            start_time=START,
+            end_time=START + timedelta(hours=10),
+            variable_list=[node("A")],
+            max_data_points=1000,
+            density=stats,
+        )
+
+        assert len(df) == 3600
+        assert len(transport.calls) == 4
+
+    async def test_aggregated_reads_do_not_learn(self):
+        stats = NodeDensityStats()
+        opc = OPC_UA(
+            rest_url=URL,
+            opcua_url=OPC_URL,
+            transport=FakeTransport(handler=synthetic_history),
+        )
+
+        await opc.get_historical_aggregated_values_asyn(
+            start_time=START,
+            end_time=START + timedelta(minutes=1),
+            pro_interval=1000,
+            agg_name="Average",
+            variable_list=[node("A")],
+            density=stats,
+        )
+
+        assert len(stats) == 0
@@ -0,0 +1,315 @@
+import json
+from datetime import datetime
+from unittest import mock
+from unittest.mock import patch
+
+import pytest
+from conftest import AsyncMockResponse
+
+from pyprediktormapclient.instrumentation import (
+    Counter,
+    Histogram,
+    Hooks,
+    MetricsRegistry,
+    RequestEvent,
+)
+from pyprediktormapclient.model_index import ModelIndex
+from pyprediktormapclient.opc_ua import OPC_UA
+from pyprediktormapclient.shared import request_from_api
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+historical_result = {
+    "Success": True,
+    "HistoryReadResults": [
+        {
+            "NodeId": {"Id": "SOMEID", "Namespace": 1, "IdType": 2},
+            "DataValues": [
+                {
+                    "Value": {"Type": 11, "Body": 1.23},
+                    "SourceTimestamp": "2023-01-01T00:00:00Z",
+                },
+                {
+                    "Value": {"Type": 11, "Body": 2.34},
+                    "SourceTimestamp": "2023-01-01T01:00:00Z",
+                },
+            ],
+        }
+    ],
+}
+
+
+class MockResponse:
+    def __init__(self, json_data, status_code):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = {"Content-Type": "application/json"}
+        self.content = json.dumps(json_data).encode()
+        self.text = str(json_data)
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP Error: {self.status_code}")
+
+
+def sample_event(**kwargs):
+    return RequestEvent(
+        **{
+            "kind": "request",
+            "endpoint": "values/get",
+            "status": 200,
+            "bytes_sent": 10,
+            "bytes_received": 100,
+            "durations": {"network": 0.02, "decode": 0.001},
+            **kwargs,
+        }
+    )
+
+
+class TestCaseHooks:
+    def test_hooks_without_observers_are_falsy(self):
+        assert not Hooks()
+        assert Hooks(lambda event: None)
+
+    def test_emit_calls_all_observers(self):
+        first, second = mock.Mock(), mock.Mock()
+        hooks = Hooks(first)
+        hooks.subscribe(second)
+        event = sample_event()
+
+        hooks.emit(event)
+
+        first.assert_called_once_with(event)
+        second.assert_called_once_with(event)
+
+    def test_unsubscribe(self):
+        observer = mock.Mock()
+        hooks = Hooks(observer)
+        hooks.unsubscribe(observer)
+
+        hooks.emit(sample_event())
+
+        observer.assert_not_called()
+        assert not hooks
+
+    def test_failing_observer_does_not_stop_others(self):
+        failing = mock.Mock(side_effect=ValueError("broken"))
+        observer = mock.Mock()
+        hooks = Hooks(failing, observer)
+
+        hooks.emit(sample_event())
+
+        observer.assert_called_once()
+
+
+class TestCaseMetrics:
+    def test_counter(self):
+        counter = Counter("requests_total")
+        counter.inc(endpoint="a")
+        counter.inc(2, endpoint="a")
+        counter.inc(endpoint="b")
+
+        assert counter.value(endpoint="a") == 3
+        assert counter.value(endpoint="b") == 1
+        assert counter.value(endpoint="c") == 0
+
+    def test_histogram_buckets(self):
+        histogram = Histogram("latency", buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        assert histogram.count() == 3
+        assert histogram.sum() == pytest.approx(5.55)
+        assert histogram.collect()[0]["buckets"] == {
+            "0.1": 1,
+            "1": 1,
+            "inf": 1,
+        }
+
+    def test_histogram_prometheus_is_cumulative(self):
+        histogram = Histogram("latency", buckets=[0.1, 1])
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+
+        lines = histogram.to_prometheus()
+
+        assert 'latency_bucket{le="0.1"} 1' in lines
+        assert 'latency_bucket{le="1"} 2' in lines
+        assert 'latency_bucket{le="+Inf"} 2' in lines
+        assert "latency_count 2" in lines
+
+    def test_registry_records_request_events(self):
+        metrics = MetricsRegistry(prefix="test")
+        metrics(sample_event())
+        metrics(sample_event(attempt=2, status=500, error="failed"))
+
+        requests = metrics.counter("requests_total")
+        assert requests.value(endpoint="values/get", status=200) == 1
+        assert requests.value(endpoint="values/get", status=500) == 1
+        retries = metrics.counter("retries_total")
+        assert retries.value(endpoint="values/get") == 1
+        errors = metrics.counter("request_errors_total")
+        assert errors.value(endpoint="values/get") == 1
+        received = metrics.counter("bytes_received_total")
+        assert received.value(endpoint="values/get") == 200
+        phases = metrics.histogram("phase_seconds")
+        assert (
+            phases.count(
+                endpoint="values/get", kind="request", phase="network"
+            )
+            == 2
+        )
+
+    def test_registry_counts_rows_from_call_events(self):
+        metrics = MetricsRegistry()
+        metrics(sample_event(kind="batch", rows=10))
+        metrics(sample_event(kind="call", rows=10))
+
+        assert metrics.counter("rows_total").value(endpoint="values/get") == 10
+
+    def test_registry_dump_and_prometheus(self):
+        metrics = MetricsRegistry(prefix="test")
+        metrics(sample_event())
+
+        snapshot = json.loads(metrics.dump())
+        assert snapshot["test_requests_total"]["type"] == "counter"
+        assert snapshot["test_phase_seconds"]["type"] == "histogram"
+        text = metrics.to_prometheus()
+        assert "# TYPE test_requests_total counter" in text
+        assert (
+            'test_requests_total{endpoint="values/get",status="200"} 1.0'
+            in text
+        )
+
+    def test_registry_type_conflict(self):
+        metrics = MetricsRegistry()
+        metrics.counter("something")
+        with pytest.raises(ValueError):
+            metrics.histogram("something")
+
+    def test_registry_reset(self):
+        metrics = MetricsRegistry()
+        metrics(sample_event())
+        metrics.reset()
+        assert metrics.snapshot() == {}
+
+
+class TestCaseRequestHooks:
+    @mock.patch("requests.post")
+    def test_request_from_api_emits_event(self, mock_post):
+        mock_post.return_value = MockResponse({"key": "value"}, 200)
+        observer = mock.Mock()
+
+        request_from_api(
+            rest_url=URL,
+            method="POST",
+            endpoint="something",
+            data="12345",
+            hooks=Hooks(observer),
+        )
+
+        event = observer.call_args[0][0]
+        assert event.kind == "request"
+        assert event.endpoint == "something"
+        assert event.status == 200
+        assert event.bytes_sent == 5
+        assert event.bytes_received == len(b'{"key": "value"}')
+        assert set(event.durations) == {"network", "decode", "total"}
+        assert event.error is None
+
+    @mock.patch("requests.get")
+    def test_request_from_api_emits_event_on_error(self, mock_get):
+        mock_get.return_value = MockResponse({}, 500)
+        observer = mock.Mock()
+
+        with pytest.raises(RuntimeError):
+            request_from_api(
+                rest_url=URL,
+                method="GET",
+                endpoint="something",
+                hooks=Hooks(observer),
+            )
+
+        event = observer.call_args[0][0]
+        assert event.status == 500
+        assert "500" in event.error
+
+    @mock.patch("requests.Session.get")
+    def test_model_index_passes_hooks(self, mock_get):
+        mock_get.return_value = MockResponse([], 200)
+        observer = mock.Mock()
+
+        ModelIndex(url=URL, hooks=Hooks(observer))
+
+        assert observer.call_args[0][0].endpoint == "query/object-types"
+
+    @mock.patch("requests.Session.post")
+    def test_opc_ua_get_values_passes_hooks(self, mock_post):
+        mock_post.return_value = MockResponse([{"Success": True}], 200)
+        observer = mock.Mock()
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, hooks=Hooks(observer))
+
+        opc.get_values([{"Id": "SOMEID", "Namespace": 1, "IdType": 2}])
+
+        assert observer.call_args[0][0].endpoint == "values/get"
+
+
+@pytest.mark.asyncio
+class TestCaseAsyncRequestHooks:
+    @patch("aiohttp.ClientSession.post")
+    async def test_historical_values_emit_all_kinds(self, mock_post):
+        mock_post.return_value = AsyncMockResponse(historical_result)
+        events = []
+        opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, hooks=Hooks(events.append)
+        )
+
+        result = await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            variable_list=["SOMEID"],
+        )
+
+        assert len(result) == 2
+        assert [event.kind for event in events] == [
+            "request",
+            "batch",
+            "call",
+        ]
+        request, batch, call = events
+        assert request.endpoint == "values/historical"
+        assert request.attempt == 1
+        assert request.bytes_sent > 0
+        assert request.bytes_received > 0
+        assert {"network", "decode", "total"} <= set(request.durations)
+        assert batch.rows == 2
+        assert "dataframe" in batch.durations
+        assert call.rows == 2
+        assert call.requests == 1
+        assert "batching" in call.durations
+
+    @patch("asyncio.sleep", return_value=None)
+    @patch("aiohttp.ClientSession.post")
+    async def test_make_request_emits_failed_attempts(
+        self, mock_post, mock_sleep
+    ):
+        mock_post.side_effect = [
+            Exception("connection reset"),
+            AsyncMockResponse({"Success": True}),
+        ]
+        events = []
+        opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, hooks=Hooks(events.append)
+        )
+
+        await opc._make_request("values/historical", {}, 3, 1)
+
+        assert [event.attempt for event in events] == [1, 2]
+        assert events[0].error == "connection reset"
+        assert events[1].error is None
+        assert events[1].durations["retry_wait"] == 1
@@ -99,8 +99,12 @@ def mocked_requests(*args, **kwargs):
     return MockResponse(None, 404)
 
 
-requests.get = Mock(side_effect=mocked_requests)
-requests.post = Mock(side_effect=mocked_requests)
+@pytest.fixture(autouse=True)
+def mocked_session():
+    with patch("requests.Session.get", side_effect=mocked_requests), patch(
+        "requests.Session.post", side_effect=mocked_requests
+    ):
+        yield
 
 
 @pytest.fixture
@@ -1,8 +1,10 @@
 import asyncio
 import json
+import logging
+import time
 import unittest
 from copy import deepcopy
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from typing import List
 from unittest.mock import AsyncMock, Mock, patch
 
@@ -12,13 +14,28 @@ import pandas.api.types as ptypes
 import pytest
 import requests
 from aiohttp.client_exceptions import ClientResponseError
+from conftest import AsyncMockResponse, node_post
 from pydantic import AnyUrl, BaseModel, ValidationError
 from pydantic_core import Url
 from requests.exceptions import HTTPError
 from yarl import URL as YarlURL
 
 from pyprediktormapclient.auth_client import AUTH_CLIENT, Token
-from pyprediktormapclient.opc_ua import OPC_UA, TYPE_LIST
+from pyprediktormapclient.batching import BatchSpec, BisectPolicy
+from pyprediktormapclient.density import NodeDensityStats
+from pyprediktormapclient.opc_ua import (
+    OPC_UA,
+    TYPE_LIST,
+    _expires_at,
+    _is_transient_status,
+    _is_truncated,
+    _timestamp_positions,
+)
+from pyprediktormapclient.transport import (
+    FakeResponse,
+    FakeTransport,
+    synthetic_history,
+)
 
 URL = "http://someserver.somedomain.com/v1/"
 OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
@@ -662,7 +679,7 @@ class TestCaseOPCUA:
             self.opc._get_variable_list_as_list([1, 2, 3])
 
     @pytest.mark.parametrize("auth_client_class", [None, AUTH_CLIENT])
-    @patch("requests.post", side_effect=successful_mocked_requests)
+    @patch("requests.Session.post", side_effect=successful_mocked_requests)
     def test_get_live_values_successful_response_processing(
         self, mock_get, auth_client_class
     ):
@@ -730,7 +747,7 @@ class TestCaseOPCUA:
             "Authorization", ""
         ), "Session token not found in Authorization header"
 
-    @patch("requests.post", side_effect=empty_values_mocked_requests)
+    @patch("requests.Session.post", side_effect=empty_values_mocked_requests)
     def test_get_live_values_with_missing_values(self, mock_get):
         result = self.opc.get_values(list_of_ids)
         for num, row in enumerate(list_of_ids):
@@ -744,7 +761,7 @@ class TestCaseOPCUA:
                     result[num][key] is None for key in ["Value", "ValueType"]
                 )
 
-    @patch("requests.post", side_effect=no_status_code_mocked_requests)
+    @patch("requests.Session.post", side_effect=no_status_code_mocked_requests)
     def test_get_live_values_no_status_code(self, mock_get):
         result = self.opc.get_values(list_of_ids)
         assert result[0]["StatusCode"] is None
@@ -754,7 +771,7 @@ class TestCaseOPCUA:
             for key in ["Id", "Timestamp", "Value", "ValueType"]
         )
 
-    @patch("requests.post", side_effect=no_mocked_requests)
+    @patch("requests.Session.post", side_effect=no_mocked_requests)
     def test_get_live_values_no_response(self, mock_get):
         result = self.opc.get_values(list_of_ids)
         for item in result:
@@ -770,7 +787,7 @@ class TestCaseOPCUA:
             )
         assert "Success" not in result[0]
 
-    @patch("requests.post", side_effect=empty_mocked_requests)
+    @patch("requests.Session.post", side_effect=empty_mocked_requests)
     def test_get_live_values_empty_response(self, mock_get):
         result = self.opc.get_values(list_of_ids)
 
@@ -800,7 +817,7 @@ class TestCaseOPCUA:
             self.opc.get_values(list_of_ids)
         assert str(exc_info.value) == "Error in get_values: Test exception"
 
-    @patch("requests.post")
+    @patch("requests.Session.post")
     def test_get_live_values_500_error(self, mock_post):
         error_response = Mock()
         error_response.status_code = 500
@@ -812,7 +829,7 @@ class TestCaseOPCUA:
         with pytest.raises(RuntimeError):
             self.opc.get_values(list_of_ids)
 
-    @patch("requests.post", side_effect=unsuccessful_mocked_requests)
+    @patch("requests.Session.post", side_effect=unsuccessful_mocked_requests)
     def test_get_live_values_unsuccessful(self, mock_post):
         with pytest.raises(RuntimeError):
             self.opc.get_values(list_of_ids)
@@ -967,7 +984,9 @@ class TestCaseOPCUA:
             "Error in write_values: 404 Client Error"
         )
 
-    @patch("requests.post", side_effect=successful_write_mocked_requests)
+    @patch(
+        "requests.Session.post", side_effect=successful_write_mocked_requests
+    )
     def test_write_live_values_successful(self, mock_get):
         result = self.opc.write_values(list_of_write_values)
         for num, row in enumerate(list_of_write_values):
@@ -981,7 +1000,9 @@ class TestCaseOPCUA:
             )
             assert result[num]["WriteSuccess"] is True
 
-    @patch("requests.post", side_effect=empty_write_values_mocked_requests)
+    @patch(
+        "requests.Session.post", side_effect=empty_write_values_mocked_requests
+    )
     def test_write_live_values_with_missing_value_and_statuscode(
         self, mock_get
     ):
@@ -989,17 +1010,19 @@ class TestCaseOPCUA:
         for num, row in enumerate(list_of_write_values):
             assert result[num]["WriteSuccess"] is False
 
-    @patch("requests.post", side_effect=no_write_mocked_requests)
+    @patch("requests.Session.post", side_effect=no_write_mocked_requests)
     def test_get_write_live_values_no_response(self, mock_get):
         result = self.opc.write_values(list_of_write_values)
         assert result is None
 
-    @patch("requests.post", side_effect=unsuccessful_write_mocked_requests)
+    @patch(
+        "requests.Session.post", side_effect=unsuccessful_write_mocked_requests
+    )
     def test_get_write_live_values_unsuccessful(self, mock_get):
         with pytest.raises(RuntimeError):
             self.opc.write_values(list_of_write_values)
 
-    @patch("requests.post", side_effect=empty_write_mocked_requests)
+    @patch("requests.Session.post", side_effect=empty_write_mocked_requests)
     def test_get_write_live_values_empty(self, mock_get):
         with pytest.raises(ValueError):
             self.opc.write_values(list_of_write_values)
@@ -1085,7 +1108,7 @@ class TestCaseOPCUA:
         )
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=successful_write_historical_mocked_requests,
     )
     def test_write_historical_values_successful(self, mock_get):
@@ -1097,7 +1120,7 @@ class TestCaseOPCUA:
         assert all(row.get("WriteSuccess", False) for row in result)
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=successful_write_historical_mocked_requests,
     )
     def test_write_wrong_order_historical_values_successful(self, mock_get):
@@ -1108,7 +1131,10 @@ class TestCaseOPCUA:
         with pytest.raises(ValueError):
             self.opc.write_historical_values(converted_data)
 
-    @patch("requests.post", side_effect=empty_write_historical_mocked_requests)
+    @patch(
+        "requests.Session.post",
+        side_effect=empty_write_historical_mocked_requests,
+    )
     def test_write_historical_values_with_missing_value_and_statuscode(
         self, mock_get
     ):
@@ -1119,7 +1145,10 @@ class TestCaseOPCUA:
         with pytest.raises(ValueError):
             self.opc.write_historical_values(converted_data)
 
-    @patch("requests.post", side_effect=no_write_mocked_historical_requests)
+    @patch(
+        "requests.Session.post",
+        side_effect=no_write_mocked_historical_requests,
+    )
     def test_get_write_historical_values_no_response(self, mock_get):
         converted_data = [
             WriteHistoricalVariables(**item).model_dump()
@@ -1129,7 +1158,7 @@ class TestCaseOPCUA:
         assert result is None
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=unsuccessful_write_historical_mocked_requests,
     )
     def test_get_write_historical_values_unsuccessful(self, mock_get):
@@ -1141,7 +1170,7 @@ class TestCaseOPCUA:
             self.opc.write_historical_values(converted_data)
 
     @patch(
-        "requests.post",
+        "requests.Session.post",
         side_effect=successful_write_historical_with_errors_mocked_requests,
     )
     def test_get_write_historical_values_successful_with_error_codes(
@@ -1166,34 +1195,6 @@ class TestCaseOPCUA:
         )
 
 
-class AsyncMockResponse:
-    def __init__(self, json_data, status_code):
-        self.json_data = json_data
-        self.status = status_code
-        self.headers = {"Content-Type": "application/json"}
-
-    async def __aenter__(self):
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        pass
-
-    async def json(self):
-        return self.json_data
-
-    async def raise_for_status(self):
-        if self.status >= 400:
-            raise aiohttp.ClientResponseError(
-                request_info=aiohttp.RequestInfo(
-                    url=URL, method="POST", headers={}, real_url=OPC_URL
-                ),
-                history=(),
-                status=self.status,
-                message="Mocked error",
-                headers=self.headers,
-            )
-
-
 def unsuccessful_async_mock_response(*args, **kwargs):
     return AsyncMockResponse(json_data=None, status_code=400)
 
@@ -1604,5 +1605,963 @@ class TestCaseAsyncOPCUA:
             await make_raw_historical_request(opc=self.opc)
 
 
+@pytest.mark.asyncio
+class TestCaseRequestLogging:
+    @pytest.fixture(autouse=True)
+    def setup(self, caplog):
+        self.caplog = caplog
+        yield
+
+    def messages(self, level):
+        return [
+            record.getMessage()
+            for record in self.caplog.records
+            if record.levelno == level
+        ]
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_body_not_formatted_without_debug(self, mock_post):
+        mock_post.return_value = AsyncMockResponse({"Success": True}, 200)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+        self.caplog.set_level(logging.INFO, logger="pyprediktormapclient")
+
+        with patch("pyprediktormapclient.opc_ua._truncate") as mock_truncate:
+            await opc._make_request("values/historical", {"a": 1}, 1, 0)
+
+        mock_truncate.assert_not_called()
+        assert self.messages(logging.DEBUG) == []
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_body_logged_truncated_and_headers_redacted(self, mock_post):
+        mock_post.return_value = AsyncMockResponse({"Success": True}, 200)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, log_body_max_chars=10)
+        opc.headers["Authorization"] = "Bearer secret"
+        self.caplog.set_level(logging.DEBUG, logger="pyprediktormapclient")
+
+        await opc._make_request("values/historical", {"a": "b" * 100}, 1, 0)
+
+        debug = self.messages(logging.DEBUG)
+        body = next(m for m in debug if m.startswith("Request body"))
+        assert body.startswith('Request body: {"a": "bbb...')
+        assert "more characters" in body
+        headers = next(m for m in debug if m.startswith("Request headers"))
+        assert "secret" not in headers
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_body_sampling(self, mock_post):
+        mock_post.return_value = AsyncMockResponse({"Success": True}, 200)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, log_body_sample_rate=0)
+        self.caplog.set_level(logging.DEBUG, logger="pyprediktormapclient")
+
+        await opc._make_request("values/historical", {"a": 1}, 1, 0)
+
+        debug = self.messages(logging.DEBUG)
+        assert any(m.startswith("Making POST request") for m in debug)
+        assert not any(m.startswith("Request body") for m in debug)
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_slow_request_logged_with_body(self, mock_post):
+        mock_post.return_value = AsyncMockResponse({"Success": True}, 200)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, slow_request_threshold=0)
+        self.caplog.set_level(logging.WARNING, logger="pyprediktormapclient")
+
+        await opc._make_request("values/historical", {"a": 1}, 1, 0)
+
+        warning = self.messages(logging.WARNING)[0]
+        assert warning.startswith(f"Slow request to {URL}values/historical")
+        assert '{"a": 1}' in warning
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_fast_request_not_logged_as_slow(self, mock_post):
+        mock_post.return_value = AsyncMockResponse({"Success": True}, 200)
+        opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, slow_request_threshold=60
+        )
+        self.caplog.set_level(logging.WARNING, logger="pyprediktormapclient")
+
+        await opc._make_request("values/historical", {"a": 1}, 1, 0)
+
+        assert self.messages(logging.WARNING) == []
+
+
+class SlowAsyncMockResponse(AsyncMockResponse):
+    """Response that never arrives and records when it is cancelled."""
+
+    cancelled = 0
+
+    async def __aenter__(self):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            SlowAsyncMockResponse.cancelled += 1
+            raise
+        return self
+
+
+def slow_or_failing_post(url, data, headers):
+    if "FAILING" in data:
+        return AsyncMockResponse(json_data=None, status_code=400)
+    return SlowAsyncMockResponse(json_data=None, status_code=200)
+
+
+def make_batched_request(opc, variable_list, **kwargs):
+    return opc.get_historical_raw_values_asyn(
+        start_time=datetime(2023, 1, 1),
+        end_time=datetime(2023, 1, 2),
+        variable_list=variable_list,
+        max_retries=1,
+        retry_delay=0,
+        **kwargs,
+    )
+
+
+@pytest.mark.asyncio
+class TestCaseTimeBudget:
+    @pytest.fixture(autouse=True)
+    def setup(self, opc):
+        self.opc = opc
+        SlowAsyncMockResponse.cancelled = 0
+        yield
+
+    async def test_expires_at(self):
+        assert _expires_at(None, None) is None
+        now = time.monotonic()
+        assert _expires_at(10, None) == pytest.approx(now + 10, abs=1)
+        deadline = datetime.now(timezone.utc) + timedelta(seconds=5)
+        assert _expires_at(10, deadline) == pytest.approx(now + 5, abs=1)
+        assert _expires_at(1, deadline) == pytest.approx(now + 1, abs=1)
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_make_request_without_budget_left(self, mock_post):
+        with pytest.raises(TimeoutError):
+            await self.opc._make_request(
+                "values/historical", {}, 3, 0, time.monotonic() - 1
+            )
+
+        mock_post.assert_not_called()
+
+    @patch("aiohttp.ClientSession.post")
+    async def test_make_request_timeout_is_remaining_budget(self, mock_post):
+        mock_post.return_value = AsyncMockResponse({"Success": True}, 200)
+
+        with patch(
+            "pyprediktormapclient.transport.ClientSession",
+            wraps=aiohttp.ClientSession,
+        ) as mock_session:
+            await self.opc._make_request(
+                "values/historical", {}, 3, 0, time.monotonic() + 30
+            )
+
+        timeout = mock_session.call_args.kwargs["timeout"]
+        assert 0 < timeout.total <= 30
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post")
+    async def test_make_request_skips_retry_past_budget(
+        self, mock_post, mock_sleep
+    ):
+        mock_post.side_effect = Exception("connection reset")
+
+        with pytest.raises(TimeoutError):
+            await self.opc._make_request(
+                "values/historical", {}, 3, 60, time.monotonic() + 30
+            )
+
+        assert mock_post.call_count == 1
+        mock_sleep.assert_not_called()
+
+    @patch("aiohttp.ClientSession.post", side_effect=slow_or_failing_post)
+    async def test_timeout_cancels_outstanding_batches(self, mock_post):
+        started = time.monotonic()
+
+        with pytest.raises(TimeoutError):
+            await make_batched_request(self.opc, ["A", "B", "C"], timeout=0.1)
+
+        assert time.monotonic() - started < 5
+        assert SlowAsyncMockResponse.cancelled == 3
+
+    @patch("aiohttp.ClientSession.post", side_effect=slow_or_failing_post)
+    async def test_failed_batch_cancels_outstanding_batches(self, mock_post):
+        with pytest.raises(RuntimeError, match="Max retries reached"):
+            await asyncio.wait_for(
+                make_batched_request(self.opc, ["A", "B", "FAILING"]), 5
+            )
+
+        assert SlowAsyncMockResponse.cancelled == 2
+
+    @patch("aiohttp.ClientSession.post", side_effect=slow_or_failing_post)
+    async def test_caller_cancellation(self, mock_post):
+        task = asyncio.ensure_future(
+            make_batched_request(self.opc, ["A", "B"])
+        )
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert SlowAsyncMockResponse.cancelled == 2
+
+
+@pytest.mark.asyncio
+class TestCasePartialResults:
+    @pytest.fixture(autouse=True)
+    def setup(self, opc):
+        self.opc = opc
+        yield
+
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_collect_returns_rows_and_report(self, mock_post):
+        variables = [
+            {"Id": "A", "Namespace": 1, "IdType": 2},
+            {"Id": "FAILING", "Namespace": 1, "IdType": 2},
+            {"Id": "B", "Namespace": 1, "IdType": 2},
+        ]
+
+        result, report = await make_batched_request(
+            self.opc, variables, on_error="collect"
+        )
+
+        assert result["Id"].tolist() == ["A", "B"]
+        assert not report.ok
+        assert report.batches == 3
+        assert len(report.failed) == 1
+        failure = report.failed[0]
+        assert failure.spec.read_value_ids == [{"NodeId": variables[1]}]
+        assert failure.spec.start_time == datetime(2023, 1, 1)
+        assert failure.spec.end_time == datetime(2023, 1, 2)
+        assert failure.attempts == 1
+        assert failure.error == "Max retries reached"
+        assert isinstance(failure.exception, RuntimeError)
+        assert "exception" not in report.model_dump()["failed"][0]
+
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_resubmit_fetches_only_failed_batches(self, mock_post):
+        variables = [
+            {"Id": "A", "Namespace": 1, "IdType": 2},
+            {"Id": "FAILING", "Namespace": 1, "IdType": 2},
+        ]
+        _, report = await make_batched_request(
+            self.opc, variables, on_error="collect"
+        )
+        mock_post.reset_mock()
+
+        result, retried = await make_batched_request(
+            self.opc, variables, on_error="collect", plan=report.plan()
+        )
+
+        assert mock_post.call_count == 1
+        assert result.empty
+        assert retried.batches == 1
+        assert retried.failed[0].spec.index == 0
+
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_raise_is_default(self, mock_post):
+        with pytest.raises(RuntimeError):
+            await make_batched_request(
+                self.opc, [{"Id": "FAILING", "Namespace": 1, "IdType": 2}]
+            )
+
+    async def test_invalid_on_error(self):
+        with pytest.raises(ValueError):
+            await make_batched_request(self.opc, ["A"], on_error="ignore")
+
+
+def history_item(node_id, status, body=1.0):
+    return {
+        "NodeId": {"Id": node_id, "Namespace": 1, "IdType": 2},
+        "StatusCode": status,
+        "DataValues": (
+            []
+            if status["Symbol"] != "Good"
+            else [
+                {
+                    "Value": {"Type": 11, "Body": body},
+                    "SourceTimestamp": "2023-01-01T00:00:00Z",
+                }
+            ]
+        ),
+    }
+
+
+GOOD = {"Code": 0, "Symbol": "Good"}
+BAD_TIMEOUT = {"Code": 0x800A0000, "Symbol": "BadTimeout"}
+BAD_NODE_ID_UNKNOWN = {"Code": 0x80340000, "Symbol": "BadNodeIdUnknown"}
+
+
+@pytest.mark.asyncio
+class TestCaseNodeRetries:
+    @pytest.fixture(autouse=True)
+    def setup(self, opc):
+        self.opc = opc
+        yield
+
+    async def test_is_transient_status(self):
+        assert _is_transient_status(BAD_TIMEOUT)
+        assert _is_transient_status({"Code": 0x800A0000})
+        assert _is_transient_status({"Code": 0x800A0400})
+        assert not _is_transient_status(BAD_NODE_ID_UNKNOWN)
+        assert not _is_transient_status({"Code": 0x80340000})
+        assert not _is_transient_status(GOOD)
+        assert not _is_transient_status(None)
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post")
+    async def test_only_transient_nodes_are_read_again(
+        self, mock_post, mock_sleep
+    ):
+        mock_post.side_effect = [
+            AsyncMockResponse(
+                {
+                    "Success": True,
+                    "HistoryReadResults": [
+                        history_item("A", GOOD),
+                        history_item("B", BAD_TIMEOUT),
+                        history_item("C", BAD_NODE_ID_UNKNOWN),
+                        history_item("D", BAD_TIMEOUT),
+                    ],
+                },
+                200,
+            ),
+            AsyncMockResponse(
+                {
+                    "Success": True,
+                    "HistoryReadResults": [
+                        history_item("B", GOOD, 2.0),
+                        history_item("D", BAD_TIMEOUT),
+                    ],
+                },
+                200,
+            ),
+            AsyncMockResponse(
+                {
+                    "Success": True,
+                    "HistoryReadResults": [history_item("D", GOOD, 4.0)],
+                },
+                200,
+            ),
+        ]
+
+        result = await self.opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 0, 0, 1),
+            variable_list=["A", "B", "C", "D"],
+            retry_delay=1,
+        )
+
+        assert mock_post.call_count == 3
+        follow_ups = [
+            [
+                rvi["NodeId"]
+                for rvi in json.loads(c.kwargs["data"])["ReadValueIds"]
+            ]
+            for c in mock_post.call_args_list[1:]
+        ]
+        assert follow_ups == [["B", "D"], ["D"]]
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 2]
+        assert result["Id"].tolist() == ["A", "B", "D"]
+        assert result["Value"].tolist() == [1.0, 2.0, 4.0]
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post")
+    async def test_retries_are_limited(self, mock_post, mock_sleep):
+        mock_post.side_effect = lambda *args, **kwargs: AsyncMockResponse(
+            {
+                "Success": True,
+                "HistoryReadResults": [history_item("A", BAD_TIMEOUT)],
+            },
+            200,
+        )
+
+        result = await self.opc.get_historical_values(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 0, 0, 1),
+            variable_list=["A"],
+            endpoint="values/historical",
+            prepare_variables=lambda vars: [{"NodeId": var} for var in vars],
+            max_retries=3,
+        )
+
+        assert mock_post.call_count == 3
+        assert result.empty
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post")
+    async def test_failed_follow_up_keeps_batch(self, mock_post, mock_sleep):
+        mock_post.side_effect = [
+            AsyncMockResponse(
+                {
+                    "Success": True,
+                    "HistoryReadResults": [
+                        history_item("A", GOOD),
+                        history_item("B", BAD_TIMEOUT),
+                    ],
+                },
+                200,
+            ),
+            AsyncMockResponse({"Success": False}, 200),
+        ]
+
+        result = await self.opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 0, 0, 1),
+            variable_list=["A", "B"],
+            max_retries=2,
+        )
+
+        assert mock_post.call_count == 2
+        assert result["Id"].tolist() == ["A"]
+
+
+class FakeAuthClient:
+    """Auth client that hands out numbered tokens."""
+
+    def __init__(self):
+        self.token = Token(session_token="token0")
+        self.logins = 0
+
+    def request_new_ory_token(self, replaces=None):
+        time.sleep(0.05)
+        self.logins += 1
+        self.token = Token(session_token=f"token{self.logins}")
+
+
+def token_checking_post(url, data, headers):
+    if headers["Authorization"] == "Bearer token0":
+        return AsyncMockResponse(json_data=None, status_code=401)
+    return AsyncMockResponse(json_data={"Success": True}, status_code=200)
+
+
+@pytest.mark.asyncio
+class TestCaseAuthRetry:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.auth_client = FakeAuthClient()
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, auth_client=self.auth_client
+        )
+        yield
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post", side_effect=token_checking_post)
+    async def test_expired_token_is_refreshed_without_backoff(
+        self, mock_post, mock_sleep
+    ):
+        result = await self.opc._make_request("values/historical", {}, 1, 5)
+
+        assert result == {"Success": True}
+        assert self.auth_client.logins == 1
+        assert mock_post.call_count == 2
+        sent = mock_post.call_args.kwargs["headers"]["Authorization"]
+        assert sent == "Bearer token1"
+        mock_sleep.assert_not_called()
+
+    @patch("aiohttp.ClientSession.post", side_effect=token_checking_post)
+    async def test_concurrent_failures_share_one_refresh(self, mock_post):
+        results = await asyncio.gather(
+            *[
+                self.opc._make_request("values/historical", {}, 1, 0)
+                for _ in range(5)
+            ]
+        )
+
+        assert results == [{"Success": True}] * 5
+        assert self.auth_client.logins == 1
+
+    async def test_expired_session_body_is_refreshed(self):
+        def handler(request):
+            if request.headers["Authorization"] == "Bearer token0":
+                return FakeResponse(status=404, body={"error": {"code": 404}})
+            return {"Success": True}
+
+        transport = FakeTransport(handler=handler)
+        opc = OPC_UA(
+            rest_url=URL,
+            opcua_url=OPC_URL,
+            auth_client=self.auth_client,
+            transport=transport,
+        )
+
+        result = await opc._make_request("values/historical", {}, 1, 5)
+
+        assert result == {"Success": True}
+        assert self.auth_client.logins == 1
+        assert len(transport.calls) == 2
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post")
+    async def test_refresh_only_once_per_request(self, mock_post, mock_sleep):
+        mock_post.side_effect = lambda *args, **kwargs: AsyncMockResponse(
+            json_data=None, status_code=401
+        )
+
+        with pytest.raises(RuntimeError, match="Max retries reached"):
+            await self.opc._make_request("values/historical", {}, 2, 0)
+
+        assert self.auth_client.logins == 1
+        assert mock_post.call_count == 3
+
+    @patch("asyncio.sleep")
+    @patch("aiohttp.ClientSession.post")
+    async def test_no_refresh_without_auth_client(self, mock_post, mock_sleep):
+        mock_post.side_effect = lambda *args, **kwargs: AsyncMockResponse(
+            json_data=None, status_code=401
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        with pytest.raises(RuntimeError):
+            await opc._make_request("values/historical", {}, 2, 0)
+
+        assert mock_post.call_count == 2
+
+
+def window_hours(request):
+    body = request.json_body()
+    start = datetime.fromisoformat(body["StartTime"].rstrip("Z"))
+    end = datetime.fromisoformat(body["EndTime"].rstrip("Z"))
+    return (end - start).total_seconds() / 3600
+
+
+def bisect_variables(count):
+    return [
+        {"Id": f"N{num}", "Namespace": 1, "IdType": 2} for num in range(count)
+    ]
+
+
+@pytest.mark.asyncio
+class TestCaseBisection:
+    async def read(self, transport, nodes=1, hours=4, **kwargs):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+        return await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1) + timedelta(hours=hours),
+            variable_list=bisect_variables(nodes),
+            max_data_points=10**9,
+            **kwargs,
+        )
+
+    async def test_is_truncated(self):
+        assert _is_truncated({"ContinuationPoint": "abc"}, None)
+        assert _is_truncated({"StatusCode": {"Symbol": "GoodMoreData"}}, None)
+        assert _is_truncated({"StatusCode": {"Code": 0x00A60000}}, None)
+        assert not _is_truncated({"StatusCode": GOOD, "DataValues": [1]}, None)
+        assert _is_truncated({"DataValues": [1, 2]}, 2)
+        assert not _is_truncated({"DataValues": [1]}, 2)
+
+    async def test_split_nodes_on_413(self):
+        def handler(request):
+            if len(request.json_body()["ReadValueIds"]) > 2:
+                return FakeResponse(status=413, body="Too large")
+            return synthetic_history(request, timedelta(hours=1))
+
+        transport = FakeTransport(handler=handler)
+
+        df = await self.read(transport, nodes=8, bisect=BisectPolicy())
+
+        assert len(df) == 32
+        assert sorted(df["Id"].unique()) == [f"N{num}" for num in range(8)]
+        # 1 + 2 rejected, then 4 parts of 2 nodes
+        assert len(transport.calls) == 7
+
+    async def test_split_window_on_timeout(self):
+        def handler(request):
+            if window_hours(request) > 1:
+                raise asyncio.TimeoutError()
+            return synthetic_history(request, timedelta(minutes=30))
+
+        transport = FakeTransport(handler=handler)
+
+        df = await self.read(transport, bisect=BisectPolicy())
+
+        assert len(df) == 8
+        assert df["Timestamp"].is_monotonic_increasing
+        assert df["Timestamp"].is_unique
+
+    async def test_split_windows_of_a_closed_server(self):
+        def handler(request):
+            if window_hours(request) > 1:
+                raise asyncio.TimeoutError()
+            return closed_history(request)
+
+        df = await self.read(
+            FakeTransport(handler=handler), hours=2, bisect=BisectPolicy()
+        )
+
+        # The value at 01:00 ends the first part and starts the second
+        assert len(df) == 2 * 360 + 1
+        assert df["Timestamp"].is_unique
+
+    async def test_split_window_on_truncation(self):
+        def handler(request):
+            response = synthetic_history(request, timedelta(minutes=30))
+            if window_hours(request) > 2:
+                for item in response["HistoryReadResults"]:
+                    item["DataValues"] = item["DataValues"][:4]
+                    item["ContinuationPoint"] = "more"
+            return response
+
+        df = await self.read(
+            FakeTransport(handler=handler), hours=8, bisect=BisectPolicy()
+        )
+
+        assert len(df) == 16
+
+    async def test_later_batches_are_split_right_away(self):
+        def handler(request):
+            if window_hours(request) > 1:
+                return FakeResponse(status=413, body="Too large")
+            return synthetic_history(request, timedelta(hours=1))
+
+        transport = FakeTransport(handler=handler)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+        plan = [
+            BatchSpec(
+                index=num,
+                read_value_ids=[{"NodeId": variable}],
+                start_time=datetime(2023, 1, 1),
+                end_time=datetime(2023, 1, 1, 4),
+            )
+            for num, variable in enumerate(bisect_variables(3))
+        ]
+
+        df = await opc.get_historical_raw_values_asyn(
+            start_time=None,
+            end_time=None,
+            variable_list=[],
+            plan=plan,
+            max_concurrent_requests=1,
+            bisect=BisectPolicy(),
+        )
+
+        assert len(df) == 12
+        # The first batch finds the window by failing, the others do not
+        assert len(transport.calls) == 3 + 4 + 4 + 4
+
+    async def test_fails_at_the_minimum_size(self):
+        def handler(request):
+            return FakeResponse(status=413, body="Too large")
+
+        transport = FakeTransport(handler=handler)
+
+        with pytest.raises(RuntimeError, match="minimum size"):
+            await self.read(
+                transport,
+                nodes=2,
+                hours=2,
+                bisect=BisectPolicy(min_window=timedelta(hours=1)),
+            )
+
+        # Both node halves of the first window
+        assert len(transport.calls) == 3
+
+    @patch("asyncio.sleep")
+    async def test_no_split_without_policy(self, mock_sleep):
+        transport = FakeTransport(
+            handler=lambda request: FakeResponse(status=413, body="No")
+        )
+
+        with pytest.raises(RuntimeError, match="Max retries"):
+            await self.read(transport, nodes=2)
+
+        assert len(transport.calls) == 3
+
+
+class TestCaseExplain:
+    def setup_method(self):
+        self.transport = FakeTransport()
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=self.transport
+        )
+
+    def test_aggregated_read(self):
+        explanation = self.opc.explain_historical_read(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            variable_list=bisect_variables(3),
+            pro_interval=3600000,
+            agg_name="Average",
+        )
+
+        assert explanation.endpoint == "values/historicalaggregated"
+        assert explanation.requests == len(explanation.batches) == 3
+        assert explanation.nodes == 3
+        assert explanation.estimated_points == 72
+        assert explanation.estimated_bytes == 72 * 110 + 3 * 150
+        assert self.transport.calls == []
+
+    def test_batches_match_the_read_plan(self):
+        explanation = self.opc.explain_historical_read(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            variable_list=bisect_variables(1),
+            pro_interval=1000,
+            agg_name="Average",
+            max_data_points=1000,
+            align=False,
+        )
+
+        assert explanation.requests == 86
+        # Every window counts its partial last interval
+        assert 86400 <= explanation.estimated_points <= 86400 + 86
+        assert explanation.batches[0].start_time == datetime(2023, 1, 1)
+        assert explanation.batches[-1].end_time == datetime(2023, 1, 2)
+        assert explanation.largest_batch.estimated_points == 1005
+
+    def test_aligned_windows_have_no_partial_interval(self):
+        explanation = self.opc.explain_historical_read(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            variable_list=bisect_variables(1),
+            pro_interval=1000,
+            agg_name="Average",
+            max_data_points=1000,
+        )
+
+        assert explanation.estimated_points == 86400
+
+    def test_raw_read_uses_the_density(self):
+        density = NodeDensityStats()
+        density.observe({"Id": "N0", "Namespace": 1, "IdType": 2}, 10, 1)
+        density.observe({"Id": "N1", "Namespace": 1, "IdType": 2}, 2, 1)
+
+        explanation = self.opc.explain_historical_read(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 0, 1),
+            variable_list=bisect_variables(3),
+            density=density,
+        )
+
+        assert explanation.endpoint == "values/historical"
+        # N2 has no statistics and gets the median of 6 per second
+        assert explanation.estimated_points == (10 + 2 + 6) * 60
+
+    def test_raw_rate(self):
+        explanation = self.opc.explain_historical_read(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 0, 1),
+            variable_list=bisect_variables(2),
+            raw_rate=0.5,
+        )
+
+        assert explanation.estimated_points == 60
+
+    def test_given_plan(self):
+        plan = [
+            BatchSpec(
+                index=0,
+                read_value_ids=[{"NodeId": bisect_variables(1)[0]}],
+                start_time=datetime(2023, 1, 1),
+                end_time=datetime(2023, 1, 1, 1),
+            )
+        ]
+
+        explanation = self.opc.explain_historical_read(
+            start_time=None,
+            end_time=None,
+            variable_list=[],
+            pro_interval=60000,
+            agg_name="Average",
+            plan=plan,
+        )
+
+        assert explanation.requests == 1
+        assert explanation.estimated_points == 60
+
+
+def closed_history(request):
+    """History of a server that also returns the value at EndTime."""
+    content = synthetic_history(request, interval=timedelta(seconds=10))
+    end_time = request.json_body()["EndTime"]
+    for item in content["HistoryReadResults"]:
+        item["DataValues"].append(
+            {
+                "Value": {"Type": 11, "Body": -1.0},
+                "StatusCode": {"Code": 0, "Symbol": "Good"},
+                "SourceTimestamp": end_time,
+            }
+        )
+    return content
+
+
+@pytest.mark.asyncio
+class TestCaseWindowAlignment:
+    def setup_method(self):
+        self.transport = FakeTransport(handler=closed_history)
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=self.transport
+        )
+
+    def windows(self):
+        return [
+            (request.json_body()["StartTime"], request.json_body()["EndTime"])
+            for request in self.transport.calls
+        ]
+
+    async def test_raw_windows_are_calendar_aligned(self):
+        df = await self.opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 1),
+            variable_list=bisect_variables(2),
+            max_data_points=1000,
+        )
+
+        assert sorted(set(self.windows())) == [
+            ("2023-01-01T00:00:00Z", "2023-01-01T00:15:00Z"),
+            ("2023-01-01T00:15:00Z", "2023-01-01T00:45:00Z"),
+            ("2023-01-01T00:45:00Z", "2023-01-01T01:00:00Z"),
+        ]
+        # The values at the inner window ends are only kept once
+        assert len(df) == 2 * 361
+        assert not df.duplicated(subset=["Id", "Timestamp"]).any()
+        assert (df["Timestamp"] == "2023-01-01T01:00:00Z").sum() == 2
+
+    async def test_aggregated_windows_follow_the_interval(self):
+        await self.opc.get_historical_aggregated_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 1),
+            pro_interval=420000,
+            agg_name="Average",
+            variable_list=bisect_variables(1),
+            max_data_points=1000,
+        )
+
+        assert sorted(self.windows()) == [
+            ("2023-01-01T00:00:00Z", "2023-01-01T00:21:00Z"),
+            ("2023-01-01T00:21:00Z", "2023-01-01T00:42:00Z"),
+            ("2023-01-01T00:42:00Z", "2023-01-01T01:00:00Z"),
+        ]
+
+    async def test_boundaries_are_found_without_parsing(self):
+        times = pd.Series(
+            [
+                "2023-01-01T01:00:00Z",
+                "2023-01-01T01:00:00.000Z",
+                "2023-01-01T01:00:00.0000000+00:00",
+                "2023-01-01T01:00:00.5Z",
+                "2023-01-01T00:59:59Z",
+                None,
+            ]
+        )
+
+        assert _timestamp_positions(
+            times, datetime(2023, 1, 1, 1)
+        ).tolist() == [0, 1, 2]
+        assert _timestamp_positions(
+            times, datetime(2023, 1, 1, 1, 0, 0, 500000)
+        ).tolist() == [3]
+        assert _timestamp_positions(
+            pd.Series(pd.to_datetime(times, utc=True, format="ISO8601")),
+            datetime(2023, 1, 1, 1),
+        ).tolist() == [0, 1, 2]
+
+    async def test_unaligned(self):
+        await self.opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 1),
+            variable_list=bisect_variables(1),
+            max_data_points=1000,
+            align=False,
+        )
+
+        assert sorted(self.windows())[1] == (
+            "2023-01-01T00:20:00Z",
+            "2023-01-01T00:40:00Z",
+        )
+
+
+AGGREGATE_VALUES = {"Average": 1.0, "Minimum": 0.0, "Maximum": 2.0}
+
+
+def aggregate_history(request):
+    """Synthetic aggregates whose value tells which aggregate it is."""
+    body = request.json_body()
+    content = synthetic_history(
+        request, interval=timedelta(milliseconds=body["ProcessingInterval"])
+    )
+    for item, read_value_id in zip(
+        content["HistoryReadResults"], body["ReadValueIds"]
+    ):
+        for data_value in item["DataValues"]:
+            data_value["Value"]["Body"] = AGGREGATE_VALUES[
+                read_value_id["AggregateName"]
+            ]
+    return content
+
+
+@pytest.mark.asyncio
+class TestCaseMultiAggregate:
+    def setup_method(self):
+        self.transport = FakeTransport(handler=aggregate_history)
+        self.opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=self.transport
+        )
+
+    async def read(self, pro_intervals, **kwargs):
+        return await self.opc.get_historical_multi_aggregated_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 1),
+            pro_intervals=pro_intervals,
+            agg_names=["Average", "Minimum", "Maximum"],
+            variable_list=bisect_variables(2),
+            **kwargs,
+        )
+
+    async def test_aggregates_share_requests(self):
+        df = await self.read(600000)
+
+        (request,) = self.transport.calls
+        assert [
+            (rvi["NodeId"]["Id"], rvi["AggregateName"])
+            for rvi in request.json_body()["ReadValueIds"]
+        ] == [
+            ("N0", "Average"),
+            ("N0", "Minimum"),
+            ("N0", "Maximum"),
+            ("N1", "Average"),
+            ("N1", "Minimum"),
+            ("N1", "Maximum"),
+        ]
+        assert len(df) == 2 * 3 * 6
+        assert (df["Value"] == df["Aggregate"].map(AGGREGATE_VALUES)).all()
+        assert set(df["ProcessingInterval"]) == {600000}
+        assert df.groupby(["Id", "Aggregate"]).size().tolist() == [6] * 6
+
+    async def test_intervals(self):
+        df = await self.read([600000, 1800000])
+
+        assert sorted(
+            request.json_body()["ProcessingInterval"]
+            for request in self.transport.calls
+        ) == [600000, 1800000]
+        assert df.groupby("ProcessingInterval").size().to_dict() == {
+            600000: 36,
+            1800000: 12,
+        }
+
+    async def test_sorted_over_several_batches(self):
+        df = await self.read([600000, 1800000], sort=True, max_data_points=12)
+
+        assert len(self.transport.calls) > 2
+        keys = list(
+            zip(
+                df["Id"],
+                df["Aggregate"],
+                df["ProcessingInterval"],
+                df["Timestamp"],
+            )
+        )
+        assert keys == sorted(keys)
+        assert len(set(keys)) == len(df) == 48
+        assert (df["Value"] == df["Aggregate"].map(AGGREGATE_VALUES)).all()
+
+    async def test_several_intervals_need_one_result(self):
+        with pytest.raises(ValueError):
+            await self.read([600000, 1800000], on_error="collect")
+
+    async def test_nothing_to_read(self):
+        with pytest.raises(ValueError):
+            await self.read([])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,207 @@
+import gzip
+import time
+from datetime import datetime
+
+import pytest
+
+from pyprediktormapclient.auth_client import AUTH_CLIENT
+from pyprediktormapclient.opc_ua import OPC_UA
+from pyprediktormapclient.recording import (
+    REDACTED,
+    Exchange,
+    RecordingTransport,
+    ReplayTransport,
+    read_archive,
+)
+from pyprediktormapclient.transport import (
+    FakeResponse,
+    FakeTransport,
+    synthetic_history,
+)
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+VARIABLES = [{"Id": name, "Namespace": 1, "IdType": 2} for name in ["A", "B"]]
+
+
+async def read_history(transport):
+    opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+    return await opc.get_historical_raw_values_asyn(
+        start_time=datetime(2023, 1, 1),
+        end_time=datetime(2023, 1, 1, 0, 0, 30),
+        variable_list=VARIABLES,
+    )
+
+
+@pytest.mark.asyncio
+class TestCaseRecordAndReplay:
+    async def test_replay_gives_the_recorded_result(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        with RecordingTransport(
+            FakeTransport(handler=synthetic_history), path
+        ) as recorder:
+            recorded = await read_history(recorder)
+
+        replay = ReplayTransport(path, speed=None)
+        replayed = await read_history(replay)
+
+        assert recorder.exchanges == 1
+        assert len(replayed) == 60
+        assert replayed.equals(recorded)
+        assert replay.unused == 0
+
+    async def test_recorded_timings_are_replayed(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        with RecordingTransport(
+            FakeTransport(handler=synthetic_history, latency=0.1), path
+        ) as recorder:
+            await read_history(recorder)
+
+        assert read_archive(path)[0].elapsed >= 0.1
+        started = time.perf_counter()
+        await read_history(ReplayTransport(path))
+        assert time.perf_counter() - started >= 0.1
+        started = time.perf_counter()
+        await read_history(ReplayTransport(path, speed=10))
+        assert time.perf_counter() - started < 0.1
+
+    async def test_unknown_request_is_not_found(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        RecordingTransport(FakeTransport(), path).close()
+
+        async with ReplayTransport(path).async_session() as session:
+            async with session.post(f"{URL}values/historical") as response:
+                assert response.status == 404
+
+
+class TestCaseRecording:
+    def test_sync_calls_are_recorded_without_credentials(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        inner = FakeTransport(
+            responses={
+                "values/get": FakeResponse(
+                    body=[{"Success": True, "Values": []}],
+                    headers={
+                        "Content-Type": "application/json",
+                        "Set-Cookie": "session=secret",
+                    },
+                )
+            }
+        )
+        with RecordingTransport(inner, path) as recorder:
+            recorder.session.post(
+                f"{URL}values/get?x=1",
+                data='{"a": 1}',
+                headers={"Authorization": "Bearer secret"},
+            )
+
+        with gzip.open(path, "rt") as archive:
+            assert "secret" not in archive.read()
+        (exchange,) = read_archive(path)
+        assert exchange.method == "POST"
+        assert exchange.url == f"{URL}values/get"
+        assert exchange.request_body == '{"a": 1}'
+        assert exchange.headers == {"Content-Type": "application/json"}
+
+    def test_login_credentials_are_redacted(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        inner = FakeTransport(
+            responses={
+                "self-service/login/api": {"id": "flow"},
+                "self-service/login": {
+                    "session_token": "token-secret",
+                    "session": {"expires_at": "2099-01-01T00:00:00Z"},
+                },
+            }
+        )
+        with RecordingTransport(inner, path) as recorder:
+            auth = AUTH_CLIENT(
+                rest_url=URL,
+                username="user@example.com",
+                password="hunter2",
+                transport=recorder,
+            )
+            auth.request_new_ory_token()
+
+        assert auth.token.session_token == "token-secret"
+        with gzip.open(path, "rt") as archive:
+            text = archive.read()
+        for secret in ["hunter2", "token-secret", "user@example.com"]:
+            assert secret not in text
+        login = read_archive(path)[-1]
+        assert REDACTED in login.request_body
+        assert REDACTED in login.body
+        replayed = AUTH_CLIENT(
+            rest_url=URL,
+            username="user@example.com",
+            password="hunter2",
+            transport=ReplayTransport(path, speed=None),
+        )
+        replayed.request_new_ory_token()
+        assert replayed.token.session_token == REDACTED
+
+    def test_custom_redaction(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        inner = FakeTransport(responses={"x": {"api_key": "key-secret"}})
+
+        def redact(exchange):
+            return exchange.model_copy(
+                update={"body": exchange.body.replace("key-secret", "***")}
+            )
+
+        with RecordingTransport(inner, path, redact=redact) as recorder:
+            recorder.session.get(f"{URL}x")
+
+        (exchange,) = read_archive(path)
+        assert exchange.body == '{"api_key": "***"}'
+
+    def test_binary_bodies(self):
+        exchange = Exchange.create(
+            "GET", URL, None, None, 200, {}, b"\xff\x00", 0.0
+        )
+
+        assert exchange.base64
+        assert exchange.content() == b"\xff\x00"
+
+    def test_identical_requests_in_recorded_order(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        bodies = iter([{"n": 1}, {"n": 2}])
+        inner = FakeTransport(handler=lambda request: next(bodies))
+        with RecordingTransport(inner, path) as recorder:
+            recorder.session.get(f"{URL}x")
+            recorder.session.get(f"{URL}x")
+
+        replay = ReplayTransport(path, speed=None)
+
+        assert replay.get(f"{URL}x").json() == {"n": 1}
+        assert replay.get(f"{URL}x").json() == {"n": 2}
+        assert replay.get(f"{URL}x").status_code == 404
+
+    def test_fallback_to_the_same_url(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        inner = FakeTransport(responses={"login": {"token": "t"}})
+        with RecordingTransport(inner, path) as recorder:
+            recorder.session.post(f"{URL}login", params={"flow": "1"})
+
+        replay = ReplayTransport(path, speed=None)
+        response = replay.post(f"{URL}login", params={"flow": "2"})
+
+        assert response.json() == {"token": "t"}
+
+    def test_interrupted_recording(self, tmp_path):
+        path = str(tmp_path / "traffic.jsonl.gz")
+        recorder = RecordingTransport(FakeTransport(responses={"x": {}}), path)
+        recorder.session.get(f"{URL}x")
+        recorder.session.get(f"{URL}x")
+        # Simulate a crash, the archive is never closed
+        with open(path, "rb") as archive:
+            data = archive.read()
+
+        copy = tmp_path / "copy.jsonl.gz"
+        copy.write_bytes(data)
+
+        assert len(read_archive(str(copy))) == 2
+        recorder.close()
+        with pytest.raises(RuntimeError):
+            recorder.session.get(f"{URL}x")
@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyprediktormapclient.rollup import BAD, GOOD, UNCERTAIN, rollup
+
+QUARTER = 900000
+HOUR = 3600000
+START = datetime(2023, 1, 1)
+
+
+def fine_frame(values, aggregate="Average", node="A", status=None):
+    """Quarter hour aggregates of a node from START."""
+    return pd.DataFrame(
+        {
+            "Id": node,
+            "Namespace": 1,
+            "IdType": 2,
+            "Aggregate": aggregate,
+            "ProcessingInterval": QUARTER,
+            "Timestamp": [
+                (START + timedelta(minutes=15 * num)).isoformat() + "Z"
+                for num in range(len(values))
+            ],
+            "Value": values,
+            "StatusCode": status or [0] * len(values),
+        }
+    )
+
+
+def values_of(df, aggregate):
+    return df[df["Aggregate"] == aggregate]["Value"].tolist()
+
+
+class TestCaseRollup:
+    def test_average_minimum_maximum(self):
+        df = pd.concat(
+            [
+                fine_frame([1.0, 2.0, 3.0, 6.0, 4.0, 4.0, 4.0, 4.0]),
+                fine_frame([1.0, 2.0, 3.0, 6.0, 4, 4, 4, 4], "Minimum"),
+                fine_frame([2.0, 3.0, 4.0, 8.0, 5, 5, 5, 5], "Maximum"),
+            ],
+            ignore_index=True,
+        )
+
+        result = rollup(df, HOUR)
+
+        assert values_of(result, "Average") == [3.0, 4.0]
+        assert values_of(result, "Minimum") == [1.0, 4.0]
+        assert values_of(result, "Maximum") == [8.0, 5.0]
+        assert set(result["StatusCode"]) == {GOOD[0]}
+        assert result["Timestamp"].tolist()[:2] == [
+            "2023-01-01T00:00:00Z",
+            "2023-01-01T01:00:00Z",
+        ]
+        assert set(result["ProcessingInterval"]) == {HOUR}
+
+    def test_bad_values_are_left_out(self):
+        df = fine_frame(
+            [1.0, 100.0, 3.0, 5.0, 1.0, 1.0, 1.0, 1.0],
+            status=[0, 0x80000000, 0, 0] + [0x80000000] * 4,
+        )
+
+        result = rollup(df, HOUR, aggregates=["Average"])
+
+        assert result["Value"].tolist()[0] == 3.0
+        assert np.isnan(result["Value"].tolist()[1])
+        assert result["StatusCode"].tolist() == [UNCERTAIN[0], BAD[0]]
+        assert result["StatusSymbol"].tolist() == [UNCERTAIN[1], BAD[1]]
+
+    def test_uncertain_and_missing_values(self):
+        df = fine_frame([1.0, 1.0, 1.0, 1.0, 2.0, 2.0, 2.0])
+        df.loc[0, "StatusCode"] = 0x40000000
+
+        result = rollup(df, HOUR, aggregates=["Average"])
+
+        # One uncertain value, and the second hour misses a quarter
+        assert result["StatusCode"].tolist() == [UNCERTAIN[0]] * 2
+        assert result["Value"].tolist() == [1.0, 2.0]
+
+    def test_total_and_average_from_each_other(self):
+        averages = fine_frame([1.0, 2.0, 3.0, 4.0])
+        totals = fine_frame([900.0, 1800.0, 2700.0, 3600.0], "Total")
+
+        from_average = rollup(averages, HOUR, aggregates=["Total"])
+        from_total = rollup(totals, HOUR, aggregates=["Average"])
+
+        assert from_average["Value"].tolist() == [9000.0]
+        assert from_total["Value"].tolist() == [2.5]
+
+    def test_several_intervals(self):
+        df = fine_frame([float(num) for num in range(96)])
+
+        result = rollup(df, [HOUR, 24 * HOUR], aggregates=["Average"])
+
+        assert result.groupby("ProcessingInterval").size().to_dict() == {
+            HOUR: 24,
+            24 * HOUR: 1,
+        }
+        assert values_of(result, "Average")[-1] == 47.5
+
+    def test_matches_pandas(self):
+        rng = np.random.default_rng(1)
+        df = pd.concat(
+            [fine_frame(rng.random(96).tolist(), node=n) for n in "ABC"],
+            ignore_index=True,
+        )
+        df = df.sample(frac=1, random_state=1).reset_index(drop=True)
+
+        result = rollup(df, HOUR, aggregates=["Average"])
+
+        times = pd.to_datetime(df["Timestamp"]).dt.floor("h")
+        expected = df.groupby(["Id", times])["Value"].mean()
+        assert np.allclose(result["Value"], expected.to_numpy())
+        assert result["Id"].tolist() == ["A"] * 24 + ["B"] * 24 + ["C"] * 24
+
+    def test_source_without_aggregate_column(self):
+        df = fine_frame([1.0, 2.0, 3.0, 4.0]).drop(columns="Aggregate")
+
+        with pytest.raises(ValueError):
+            rollup(df, HOUR)
+        assert rollup(df, HOUR, source="Maximum")["Value"].tolist() == [4.0]
+
+    def test_invalid_rollups(self):
+        df = fine_frame([1.0, 2.0, 3.0, 4.0])
+
+        with pytest.raises(ValueError):
+            rollup(df, 1000000)
+        with pytest.raises(ValueError):
+            rollup(df, HOUR, aggregates=["Maximum"])
+        with pytest.raises(ValueError):
+            rollup(df, HOUR, origin=START + timedelta(minutes=5))
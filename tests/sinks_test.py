@@ -0,0 +1,280 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+from conftest import node_post
+
+from pyprediktormapclient.opc_ua import OPC_UA
+from pyprediktormapclient.sinks import MemorySink, SortedMemorySink
+from pyprediktormapclient.transport import FakeTransport, synthetic_history
+
+pa = pytest.importorskip("pyarrow")
+
+from pyprediktormapclient.sinks import (  # noqa: E402
+    ArrowIPCSink,
+    ParquetDatasetSink,
+)
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+
+def frame(node, values):
+    return pd.DataFrame(
+        {"Id": [node] * len(values), "Value": [float(v) for v in values]}
+    )
+
+
+class TestCaseSinks:
+    def test_memory_sink_keeps_plan_order(self):
+        sink = MemorySink()
+        sink.write(1, frame("B", [2]))
+        sink.write(0, frame("A", [1]))
+
+        assert sink.result()["Id"].tolist() == ["A", "B"]
+
+    def test_memory_sink_without_batches(self):
+        assert MemorySink().result().empty
+
+    def test_parquet_dataset_sink(self, tmp_path):
+        sink = ParquetDatasetSink(str(tmp_path / "dataset"))
+        sink.write(1, frame("B", [3, 4]))
+        sink.write(0, frame("A", [1, 2]))
+
+        dataset = sink.result()
+
+        assert dataset.count_rows() == 4
+        table = dataset.to_table()
+        assert table.column("Id").to_pylist() == ["A", "A", "B", "B"]
+        assert not list((tmp_path / "dataset").glob("*.tmp"))
+
+    def test_arrow_ipc_sink(self, tmp_path):
+        sink = ArrowIPCSink(str(tmp_path / "result.arrow"))
+        sink.write(0, frame("A", [1, 2]))
+        sink.write(1, pd.DataFrame({"Value": [3], "Id": ["B"]}))
+
+        table = sink.result()
+
+        assert table.column("Id").to_pylist() == ["A", "A", "B"]
+        assert table.column("Value").to_pylist() == [1.0, 2.0, 3.0]
+        assert table.schema.field("Value").type == pa.float64()
+
+    def test_arrow_ipc_sink_with_differing_columns(self, tmp_path):
+        sink = ArrowIPCSink(str(tmp_path / "result.arrow"))
+        sink.write(0, pd.DataFrame({"Id": ["A"], "Value": [1], "Flag": [1]}))
+        sink.write(1, pd.DataFrame({"Id": ["B"], "Value": [2]}))
+        sink.write(2, pd.DataFrame({"Id": ["C"], "Value": [2.5], "Unit": "m"}))
+        sink.write(3, pd.DataFrame({"Id": ["D"], "Value": [3]}))
+
+        table = sink.result()
+
+        assert table.column("Id").to_pylist() == ["A", "B", "C", "D"]
+        assert table.column("Value").to_pylist() == [1.0, 2.0, 2.5, 3.0]
+        assert table.column("Flag").to_pylist() == [1, None, None, None]
+        assert table.column("Unit").to_pylist() == [None, None, "m", None]
+        assert table.schema.field("Value").type == pa.float64()
+        assert [path.name for path in tmp_path.iterdir()] == ["result.arrow"]
+
+    def test_parquet_dataset_sink_with_differing_columns(self, tmp_path):
+        sink = ParquetDatasetSink(str(tmp_path / "dataset"))
+        sink.write(0, pd.DataFrame({"Id": ["A"], "Value": [1]}))
+        sink.write(1, pd.DataFrame({"Id": ["B"], "Value": [2.5], "Unit": "m"}))
+
+        table = sink.result().to_table()
+
+        assert table.column("Value").to_pylist() == [1.0, 2.5]
+        assert table.column("Unit").to_pylist() == [None, "m"]
+
+    def test_arrow_ipc_sink_without_batches(self, tmp_path):
+        assert ArrowIPCSink(str(tmp_path / "r.arrow")).result().num_rows == 0
+
+
+def timed_frame(nodes, timestamps):
+    return pd.DataFrame(
+        {
+            "Id": [node for node in nodes for _ in timestamps],
+            "Timestamp": [t for _ in nodes for t in timestamps],
+        }
+    )
+
+
+class TestCaseSortedMemorySink:
+    def test_batches_are_merged_by_node_and_time(self):
+        sink = SortedMemorySink()
+        sink.write(1, timed_frame(["B", "A"], ["2023-01-01T01:00:00Z"]))
+        sink.write(0, timed_frame(["B", "A"], ["2023-01-01T00:00:00Z"]))
+        sink.write(2, timed_frame(["C"], ["2023-01-01T00:30:00Z"]))
+
+        df = sink.result()
+
+        assert df.values.tolist() == [
+            ["A", "2023-01-01T00:00:00Z"],
+            ["A", "2023-01-01T01:00:00Z"],
+            ["B", "2023-01-01T00:00:00Z"],
+            ["B", "2023-01-01T01:00:00Z"],
+            ["C", "2023-01-01T00:30:00Z"],
+        ]
+        assert df.index.tolist() == list(range(5))
+
+    def test_times_are_compared_as_times(self):
+        sink = SortedMemorySink()
+        sink.write(0, timed_frame(["A"], ["2023-01-01T00:00:00.5Z"]))
+        sink.write(1, timed_frame(["A"], ["2023-01-01T00:00:00Z"]))
+
+        assert sink.result()["Timestamp"].tolist() == [
+            "2023-01-01T00:00:00Z",
+            "2023-01-01T00:00:00.5Z",
+        ]
+
+    def test_overlapping_batches_are_sorted(self):
+        sink = SortedMemorySink()
+        sink.write(
+            0,
+            timed_frame(["A"], ["2023-01-01T00:00:00Z", "2023-01-01T02:00Z"]),
+        )
+        sink.write(1, timed_frame(["A"], ["2023-01-01T01:00:00Z"]))
+
+        assert sink.result()["Timestamp"].tolist() == [
+            "2023-01-01T00:00:00Z",
+            "2023-01-01T01:00:00Z",
+            "2023-01-01T02:00Z",
+        ]
+
+    def test_batch_in_reverse_order_is_sorted(self):
+        sink = SortedMemorySink()
+        sink.write(0, timed_frame(["A"], ["2023-01-01T00:00:00Z"]))
+        sink.write(
+            1,
+            timed_frame(
+                ["A"],
+                [
+                    "2023-01-01T03:00:00Z",
+                    "2023-01-01T02:00:00Z",
+                    "2023-01-01T01:00:00Z",
+                ],
+            ),
+        )
+
+        assert sink.result()["Timestamp"].tolist() == [
+            "2023-01-01T00:00:00Z",
+            "2023-01-01T01:00:00Z",
+            "2023-01-01T02:00:00Z",
+            "2023-01-01T03:00:00Z",
+        ]
+
+    def test_batch_in_order_as_strings_only_is_sorted(self):
+        sink = SortedMemorySink()
+        sink.write(
+            0,
+            timed_frame(
+                ["A"], ["2023-01-01T00:00:00.5Z", "2023-01-01T00:00:00Z"]
+            ),
+        )
+
+        assert sink.result()["Timestamp"].tolist() == [
+            "2023-01-01T00:00:00Z",
+            "2023-01-01T00:00:00.5Z",
+        ]
+
+    def test_aggregates_are_separate_runs(self):
+        sink = SortedMemorySink()
+        for index, hour in enumerate(["01", "00"]):
+            df = timed_frame(["A"], [f"2023-01-01T{hour}:00:00Z"] * 2)
+            df["Aggregate"] = ["Minimum", "Average"]
+            sink.write(index, df)
+
+        df = sink.result()
+
+        assert df[["Aggregate", "Timestamp"]].values.tolist() == [
+            ["Average", "2023-01-01T00:00:00Z"],
+            ["Average", "2023-01-01T01:00:00Z"],
+            ["Minimum", "2023-01-01T00:00:00Z"],
+            ["Minimum", "2023-01-01T01:00:00Z"],
+        ]
+
+    def test_needs_a_time_column(self):
+        with pytest.raises(ValueError):
+            SortedMemorySink(by=["Id"])
+
+    def test_without_batches(self):
+        assert SortedMemorySink().result().empty
+
+
+@pytest.mark.asyncio
+class TestCaseHistoricalReadSinks:
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_read_into_parquet_dataset(self, mock_post, tmp_path):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        dataset = await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            variable_list=[
+                {"Id": name, "Namespace": 1, "IdType": 2}
+                for name in ["A", "B", "C"]
+            ],
+            sink=ParquetDatasetSink(str(tmp_path)),
+        )
+
+        table = dataset.to_table()
+        assert table.column("Id").to_pylist() == ["A", "B", "C"]
+        assert table.column("Value").to_pylist() == [1.0, 1.0, 1.0]
+        assert table.column("ValueType").to_pylist() == ["Double"] * 3
+
+    @patch("aiohttp.ClientSession.post", side_effect=node_post)
+    async def test_directory_of_an_earlier_read(self, mock_post, tmp_path):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        for names in (["A", "B", "C"], ["D"]):
+            dataset = await opc.get_historical_raw_values_asyn(
+                start_time=datetime(2023, 1, 1),
+                end_time=datetime(2023, 1, 2),
+                variable_list=[
+                    {"Id": name, "Namespace": 1, "IdType": 2} for name in names
+                ],
+                sink=ParquetDatasetSink(str(tmp_path)),
+            )
+
+        # The part files of the first read are still in the directory
+        assert len(list(tmp_path.glob("*.parquet"))) == 3
+        assert dataset.to_table().column("Id").to_pylist() == ["D"]
+        assert ParquetDatasetSink(str(tmp_path)).result().count_rows() == 0
+
+    async def test_sorted_read(self):
+        opc = OPC_UA(
+            rest_url=URL,
+            opcua_url=OPC_URL,
+            transport=FakeTransport(
+                handler=lambda request: synthetic_history(
+                    request, interval=timedelta(minutes=1)
+                )
+            ),
+        )
+        variables = [
+            {"Id": name, "Namespace": 1, "IdType": 2} for name in "CAB"
+        ]
+
+        df = await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 1),
+            variable_list=variables,
+            max_data_points=1000,
+            sort=True,
+        )
+
+        expected = df.sort_values(["Id", "Timestamp"], kind="stable")
+        assert len(df) == 180
+        assert df.equals(expected.reset_index(drop=True))
+
+    async def test_sort_with_a_sink(self, tmp_path):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        with pytest.raises(ValueError):
+            await opc.get_historical_raw_values_asyn(
+                start_time=datetime(2023, 1, 1),
+                end_time=datetime(2023, 1, 2),
+                variable_list=[],
+                sink=ParquetDatasetSink(str(tmp_path)),
+                sort=True,
+            )
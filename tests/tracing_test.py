@@ -0,0 +1,161 @@
+from datetime import datetime
+from unittest import mock
+from unittest.mock import patch
+
+import pytest
+from conftest import AsyncMockResponse
+
+from pyprediktormapclient import tracing
+from pyprediktormapclient.auth_client import AUTH_CLIENT
+from pyprediktormapclient.opc_ua import OPC_UA
+
+sdk_trace = pytest.importorskip("opentelemetry.sdk.trace")
+in_memory = pytest.importorskip(
+    "opentelemetry.sdk.trace.export.in_memory_span_exporter"
+)
+export = pytest.importorskip("opentelemetry.sdk.trace.export")
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+historical_result = {
+    "Success": True,
+    "HistoryReadResults": [
+        {
+            "NodeId": {"Id": "SOMEID", "Namespace": 1, "IdType": 2},
+            "DataValues": [
+                {
+                    "Value": {"Type": 11, "Body": 1.23},
+                    "StatusCode": {"Code": 0, "Symbol": "Good"},
+                    "SourceTimestamp": "2023-01-01T00:00:00Z",
+                }
+            ],
+        }
+    ],
+}
+
+
+@pytest.fixture
+def exporter():
+    exporter = in_memory.InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(export.SimpleSpanProcessor(exporter))
+    with patch.object(
+        tracing.trace, "get_tracer", side_effect=provider.get_tracer
+    ):
+        yield exporter
+
+
+def spans_by_name(exporter):
+    return {span.name: span for span in exporter.get_finished_spans()}
+
+
+class TestCaseTracing:
+    def test_span_attributes(self, exporter):
+        with tracing.span(
+            "test", start_time=datetime(2023, 1, 1), nodes=3, missing=None
+        ):
+            tracing.set_attributes(extra="yes")
+
+        span = spans_by_name(exporter)["test"]
+        assert span.attributes["start_time"] == "2023-01-01T00:00:00"
+        assert span.attributes["nodes"] == 3
+        assert span.attributes["extra"] == "yes"
+        assert "missing" not in span.attributes
+
+    def test_traced_records_exceptions(self, exporter):
+        @tracing.traced("failing", lambda arguments: {"value": arguments["x"]})
+        def failing(x):
+            raise ValueError("broken")
+
+        with pytest.raises(ValueError):
+            failing(4)
+
+        span = spans_by_name(exporter)["failing"]
+        assert span.attributes["value"] == 4
+        assert not span.status.is_ok
+        assert span.events[0].name == "exception"
+
+    def test_traced_ignores_failing_attributes(self, exporter):
+        @tracing.traced("call", lambda arguments: arguments["nothing"])
+        def call():
+            return 1
+
+        assert call() == 1
+        assert spans_by_name(exporter)["call"].attributes == {}
+
+    def test_no_span_without_opentelemetry(self):
+        assert tracing._no_span("name", a=1) is tracing._no_span("other")
+
+    def test_auth_refresh_span(self, exporter):
+        auth_client = AUTH_CLIENT(rest_url=URL, username="u", password="p")
+        with patch.object(auth_client, "get_login_id"), patch.object(
+            auth_client, "get_login_token"
+        ):
+            auth_client.request_new_ory_token()
+
+        assert "AUTH_CLIENT.request_new_ory_token" in spans_by_name(exporter)
+
+    @patch("requests.Session.post")
+    def test_get_values_span(self, mock_post, exporter):
+        mock_post.return_value = mock.Mock(
+            status_code=200,
+            headers={"Content-Type": "application/json"},
+            json=mock.Mock(return_value=[{"Success": True}]),
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        opc.get_values([{"Id": "SOMEID", "Namespace": 1, "IdType": 2}])
+
+        spans = spans_by_name(exporter)
+        parent = spans["OPC_UA.get_values"]
+        assert parent.attributes["nodes"] == 1
+        request = spans["request_from_api"]
+        assert request.attributes["endpoint"] == "values/get"
+        assert request.parent.span_id == parent.context.span_id
+
+
+@pytest.mark.asyncio
+class TestCaseAsyncTracing:
+    @patch("aiohttp.ClientSession.post")
+    async def test_historical_call_span_tree(self, mock_post, exporter):
+        mock_post.return_value = AsyncMockResponse(historical_result)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        await opc.get_historical_aggregated_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 2),
+            pro_interval=3600000,
+            agg_name="Average",
+            variable_list=["SOMEID"],
+        )
+
+        spans = spans_by_name(exporter)
+        parent = spans["OPC_UA.get_historical_aggregated_values"]
+        batch = spans["OPC_UA.batch"]
+        request = spans["OPC_UA.request"]
+        decode = spans["OPC_UA.decode"]
+        assert parent.attributes["nodes"] == 1
+        assert parent.attributes["agg_name"] == "Average"
+        assert parent.attributes["start_time"] == "2023-01-01T00:00:00"
+        assert parent.attributes["batches"] == 1
+        assert batch.parent.span_id == parent.context.span_id
+        assert request.parent.span_id == batch.context.span_id
+        assert decode.parent.span_id == batch.context.span_id
+        assert request.attributes["http_status_code"] == 200
+        assert batch.attributes["nodes"] == 1
+
+    @patch("asyncio.sleep", return_value=None)
+    @patch("aiohttp.ClientSession.post")
+    async def test_retry_spans(self, mock_post, mock_sleep, exporter):
+        mock_post.side_effect = [
+            Exception("connection reset"),
+            AsyncMockResponse({"Success": True}),
+        ]
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        await opc._make_request("values/historical", {}, 3, 0)
+
+        spans = spans_by_name(exporter)
+        assert not spans["OPC_UA.request"].status.is_ok
+        assert spans["OPC_UA.retry"].attributes["attempt"] == 2
@@ -0,0 +1,304 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from unittest import mock
+
+import aiohttp
+import pytest
+import requests
+from requests import HTTPError
+
+from pyprediktormapclient.auth_client import AUTH_CLIENT
+from pyprediktormapclient.model_index import ModelIndex
+from pyprediktormapclient.opc_ua import OPC_UA
+from pyprediktormapclient.transport import (
+    AiohttpTransport,
+    FakeResponse,
+    FakeTransport,
+    HTTPTransport,
+    RequestsTransport,
+    synthetic_history,
+)
+
+URL = "http://someserver.somedomain.com/v1/"
+OPC_URL = "opc.tcp://nosuchserver.nosuchdomain.com"
+
+
+class MockResponse:
+    def __init__(self, json_data, status_code=200):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.headers = {"Content-Type": "application/json"}
+        self.content = json.dumps(json_data).encode()
+        self.text = str(json_data)
+
+    def json(self):
+        return self.json_data
+
+    def raise_for_status(self):
+        pass
+
+
+class TestCaseHTTPTransport:
+    def test_adapter_pool_settings(self):
+        transport = HTTPTransport(
+            pool_connections=3, pool_maxsize=7, pool_block=True
+        )
+
+        adapter = transport.session.get_adapter("https://example.com/")
+
+        assert adapter._pool_connections == 3
+        assert adapter._pool_maxsize == 7
+        assert adapter._pool_block is True
+        assert transport.session.get_adapter("http://example.com/") is adapter
+
+    def test_keep_alive(self):
+        assert HTTPTransport().session.headers["Connection"] == "keep-alive"
+        transport = HTTPTransport(keep_alive=False)
+        assert transport.session.headers["Connection"] == "close"
+
+    def test_close(self):
+        with mock.patch("requests.Session.close") as close:
+            with HTTPTransport():
+                pass
+        close.assert_called_once()
+
+    def test_clients_share_the_session(self):
+        transport = HTTPTransport()
+        auth_client = AUTH_CLIENT(
+            rest_url=URL, username="u", password="p", transport=transport
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+        with mock.patch.object(transport.session, "get") as mock_get:
+            mock_get.return_value = MockResponse([])
+            model = ModelIndex(url=URL, transport=transport)
+
+        assert auth_client.session is transport.session
+        assert opc.session is transport.session
+        assert model.session is transport.session
+        mock_get.assert_called_once()
+
+    def test_default_transport_of_opc_ua(self):
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+
+        assert isinstance(opc.transport, AiohttpTransport)
+        assert isinstance(opc.session, requests.Session)
+        assert opc.session is opc.transport.session
+
+    def test_default_sessions_are_reused(self):
+        auth_client = AUTH_CLIENT(rest_url=URL, username="u", password="p")
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL)
+        with mock.patch.object(opc.session, "post") as mock_post:
+            mock_post.return_value = MockResponse([{"Success": True}])
+            for _ in range(2):
+                opc.get_values([{"Id": "SOMEID", "Namespace": 1, "IdType": 2}])
+        with mock.patch.object(auth_client.session, "get") as mock_get:
+            mock_get.return_value = MockResponse({"id": "flow"})
+            auth_client.get_login_id()
+        with mock.patch("requests.Session.get") as mock_get:
+            mock_get.return_value = MockResponse([])
+            model = ModelIndex(url=URL)
+
+        assert mock_post.call_count == 2
+        assert auth_client.id == "flow"
+        assert isinstance(model.session, requests.Session)
+        mock_get.assert_called_once()
+
+    def test_explicit_session_wins(self):
+        transport = HTTPTransport()
+        session = mock.Mock()
+
+        opc = OPC_UA(
+            rest_url=URL,
+            opcua_url=OPC_URL,
+            session=session,
+            transport=transport,
+        )
+
+        assert opc.session is session
+
+    def test_opc_ua_sync_calls_use_the_session(self):
+        transport = HTTPTransport()
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+        with mock.patch.object(transport.session, "post") as mock_post:
+            mock_post.return_value = MockResponse([{"Success": True}])
+            opc.get_values([{"Id": "SOMEID", "Namespace": 1, "IdType": 2}])
+
+        mock_post.assert_called_once()
+
+    def test_auth_client_logs_in_through_the_session(self):
+        transport = HTTPTransport()
+        auth_client = AUTH_CLIENT(
+            rest_url=URL, username="u", password="p", transport=transport
+        )
+        with mock.patch.object(transport.session, "get") as mock_get:
+            mock_get.return_value = MockResponse({"id": "flow-id"})
+            auth_client.get_login_id()
+
+        assert auth_client.id == "flow-id"
+        mock_get.assert_called_once()
+
+
+VARIABLES = [
+    {"Id": name, "Namespace": 1, "IdType": 2} for name in ["A", "B", "C"]
+]
+
+
+class TestCaseFakeTransport:
+    def test_canned_response_for_sync_calls(self):
+        transport = FakeTransport(
+            responses={
+                "values/get": [
+                    {
+                        "Success": True,
+                        "Values": [
+                            {
+                                "Value": {"Type": 11, "Body": 2.5},
+                                "ServerTimestamp": "2023-01-01T00:00:00Z",
+                            }
+                        ],
+                    }
+                ]
+            }
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+
+        result = opc.get_values(VARIABLES[:1])
+
+        assert result[0]["Value"] == 2.5
+        assert len(transport.calls) == 1
+        assert transport.calls[0].method == "POST"
+        assert transport.calls[0].url == f"{URL}values/get"
+        body = transport.calls[0].json_body()
+        assert body[0]["NodeIds"][0]["Id"] == "A"
+
+    def test_model_index_uses_the_transport(self):
+        transport = FakeTransport(
+            responses={"query/object-types": [{"Id": "1", "Name": "Site"}]}
+        )
+
+        model = ModelIndex(url=URL, transport=transport)
+
+        assert model.object_types == [{"Id": "1", "Name": "Site"}]
+        assert transport.calls[0].method == "GET"
+
+    def test_unknown_url_is_not_found(self):
+        opc = OPC_UA(
+            rest_url=URL, opcua_url=OPC_URL, transport=FakeTransport()
+        )
+
+        with pytest.raises(RuntimeError, match="404"):
+            opc.get_values(VARIABLES[:1])
+
+    def test_sync_latency(self):
+        transport = FakeTransport(
+            responses={"values/get": FakeResponse(body=[], latency=0.05)},
+            latency=5,
+        )
+
+        started = time.perf_counter()
+        response = transport.post(f"{URL}values/get", data="[]")
+
+        assert 0.05 <= time.perf_counter() - started < 1
+        assert response.json() == []
+
+    def test_jitter_is_repeatable_with_a_seed(self):
+        def delays(seed):
+            transport = FakeTransport(jitter=1.0, seed=seed)
+            return [
+                transport._respond("GET", URL, None, None, None)[1]
+                for _ in range(5)
+            ]
+
+        assert delays(1) == delays(1)
+        assert all(0 <= delay <= 1 for delay in delays(2))
+
+    def test_error_status(self):
+        transport = FakeTransport(
+            responses={"values/get": FakeResponse(status=500, body="down")}
+        )
+
+        response = transport.post(f"{URL}values/get")
+
+        assert response.text == "down"
+        with pytest.raises(HTTPError):
+            response.raise_for_status()
+
+
+@pytest.mark.asyncio
+class TestCaseFakeTransportAsync:
+    async def test_historical_read_with_generated_responses(self):
+        transport = FakeTransport(
+            handler=partial(synthetic_history, interval=timedelta(minutes=1)),
+            latency=0.01,
+        )
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+
+        df = await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 1),
+            variable_list=VARIABLES,
+        )
+
+        assert len(df) == 180
+        assert sorted(df["Id"].unique()) == ["A", "B", "C"]
+        assert len(transport.calls) == 1
+        assert all(
+            call.url == f"{URL}values/historical" for call in transport.calls
+        )
+
+    async def test_stream_decode(self):
+        transport = FakeTransport(handler=synthetic_history)
+        opc = OPC_UA(rest_url=URL, opcua_url=OPC_URL, transport=transport)
+
+        df = await opc.get_historical_raw_values_asyn(
+            start_time=datetime(2023, 1, 1),
+            end_time=datetime(2023, 1, 1, 0, 0, 10),
+            variable_list=VARIABLES[:1],
+            stream_decode=True,
+        )
+
+        assert df["Value"].tolist() == [float(num) for num in range(10)]
+
+    async def test_latency_longer_than_the_timeout(self):
+        transport = FakeTransport(responses={"x": {}}, latency=5)
+
+        async with transport.async_session(
+            timeout=aiohttp.ClientTimeout(total=0.01)
+        ) as session:
+            with pytest.raises(asyncio.TimeoutError):
+                async with session.post(f"{URL}x"):
+                    pass
+
+    async def test_error_status(self):
+        transport = FakeTransport(
+            responses={"x": FakeResponse(status=503, body={"error": "busy"})}
+        )
+
+        async with transport.async_session() as session:
+            async with session.post(f"{URL}x") as response:
+                assert response.status == 503
+                assert await response.json() == {"error": "busy"}
+                with pytest.raises(aiohttp.ClientResponseError):
+                    response.raise_for_status()
+
+
+@pytest.mark.asyncio
+class TestCaseRequestsTransport:
+    async def test_async_calls_run_requests_in_threads(self):
+        session = mock.Mock()
+        session.post.return_value = MockResponse({"Success": True})
+        transport = RequestsTransport(session)
+
+        async with transport.async_session(
+            timeout=aiohttp.ClientTimeout(total=3)
+        ) as client:
+            async with client.post(f"{URL}x", data="{}") as response:
+                content = await response.json()
+
+        assert content == {"Success": True}
+        session.post.assert_called_once_with(
+            f"{URL}x", params=None, headers=None, data="{}", timeout=3
+        )